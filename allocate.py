@@ -1,16 +1,23 @@
 #!/usr/bin/env python
 
 import logging
+import time
+import metrics
 from sense import Sense
 
-def allocate(memory, anti_affinity = []):
+def healthy_docker_hosts(exclude=[]):
     docker_hosts = [h for h in Sense.docker_hosts()
                     if (h['status'] == 'passing' and
-                        'im' in h['tags'])]
+                        'im' in h['tags'] and
+                        h['addr'].split(':')[0] not in exclude and
+                        h['consul_host'] not in exclude)]
 
     if not docker_hosts:
         raise RuntimeError("There are no healthy docker nodes")
 
+    return docker_hosts
+
+def memory_usage(docker_hosts):
     blueprints = Sense.blueprints()
     allocations = Sense.allocations()
 
@@ -26,6 +33,9 @@ def allocate(memory, anti_affinity = []):
             host = instance['host'].split(':')[0]
             memory_used[host] = memory_used.get(host, 0) + memsize
 
+    return memory_used
+
+def pick_host(memory, anti_affinity, docker_hosts, memory_used):
     scores = []
 
     for docker_host in docker_hosts:
@@ -60,3 +70,38 @@ def allocate(memory, anti_affinity = []):
                  addr)
 
     return addr
+
+def allocate(memory, anti_affinity = []):
+    started = time.time()
+
+    docker_hosts = healthy_docker_hosts()
+    memory_used = memory_usage(docker_hosts)
+    addr = pick_host(memory, anti_affinity, docker_hosts, memory_used)
+
+    metrics.ALLOCATE_SECONDS.observe(time.time() - started)
+    return addr
+
+def allocate_many(requests, exclude=[]):
+    """
+    Plans placement for a batch of instances in one pass.
+
+    'requests' is a list of (memory, anti_affinity) tuples. Returns a
+    list of host addresses in the same order. Memory taken by instances
+    planned earlier in the batch is accounted for, so the batch is spread
+    over healthy hosts instead of piling up on the one that looked the
+    most free before the batch started. Hosts in 'exclude' are never
+    picked.
+    """
+    started = time.time()
+
+    docker_hosts = healthy_docker_hosts(exclude)
+    memory_used = memory_usage(docker_hosts)
+
+    result = []
+    for memory, anti_affinity in requests:
+        addr = pick_host(memory, anti_affinity, docker_hosts, memory_used)
+        memory_used[addr] += memory
+        result.append(addr)
+
+    metrics.ALLOCATE_SECONDS.observe(time.time() - started)
+    return result
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+
+import global_env
+import consul
+import base64
+import datetime
+import dateutil.parser
+import json
+import logging
+
+# Consul layout of the backup catalog:
+#   taas/backups/records/<backup id>    the backup as a JSON record
+#   taas/backups/groups/<group id>/<backup id>
+#                                       index of the backups of a group,
+#                                       the value is the parent id
+#   taas/backups/archives/<archive id>  how many backups use the archive
+#
+# It is kept outside of the 'tarantool' prefix, so that group changes
+# don't fetch backups and backup changes don't fetch groups.
+PREFIX = 'taas/backups/'
+RECORDS_PREFIX = PREFIX + 'records/'
+GROUPS_PREFIX = PREFIX + 'groups/'
+ARCHIVES_PREFIX = PREFIX + 'archives/'
+
+# Where backups were kept before, one key per field
+LEGACY_PREFIX = 'tarantool_backups/'
+
+# Transactions that lost a race with another writer are retried this
+# many times
+TXN_ATTEMPTS = 10
+# Legacy backups converted in one transaction. Consul allows 64
+# operations per transaction and a backup takes up to 5.
+MIGRATE_BATCH = 12
+
+
+def connect():
+    return consul.Consul(host=global_env.consul_host,
+                         token=global_env.consul_acl_token)
+
+
+def kv_op(verb, key, value=None, index=None):
+    op = {'Verb': verb, 'Key': key}
+    if value is not None:
+        op['Value'] = base64.b64encode(value.encode('utf-8')).decode('ascii')
+    if index is not None:
+        op['Index'] = index
+    return {'KV': op}
+
+
+def transact(consul_obj, build_ops):
+    """
+    Runs the Consul transaction returned by build_ops(), which reads what
+    it depends on and guards it with 'cas' or 'check-index' operations.
+    If another writer got in between, the transaction is built and run
+    again. build_ops() returns None when there is nothing left to do.
+    """
+    for _ in range(TXN_ATTEMPTS):
+        ops = build_ops()
+        if not ops:
+            return
+
+        try:
+            consul_obj.txn.put(ops)
+            return
+        except consul.base.ClientError as ex:
+            # Failed operations roll the transaction back with a 409
+            if not str(ex).startswith('409'):
+                raise
+
+    raise RuntimeError("Backup catalog is changing too fast to be updated")
+
+
+def parse_files(value):
+    """
+    returns the {name: size} of data files in a legacy backup from the
+    form they were kept in: 'name:size,name:size'
+    """
+    files = {}
+    for item in filter(None, value.split(',')):
+        name, size = item.rsplit(':', 1)
+        files[name] = int(size)
+    return files
+
+
+def format_record(record):
+    return json.dumps(record, sort_keys=True, separators=(',', ':'))
+
+
+def parse_record(value):
+    """
+    returns a backup from its JSON record, in the form Sense.backups()
+    gives it out
+    """
+    backup = json.loads(value.decode('utf-8'))
+    # Written by isoformat(), which this parses much faster than dateutil
+    backup['creation_time'] = datetime.datetime.fromisoformat(
+        backup['creation_time'])
+    return backup
+
+
+def archive_refs(consul_obj, archive_id):
+    """
+    returns the modify index of the reference count of an archive, 0 if
+    there is none, and the count
+    """
+    item = consul_obj.kv.get(ARCHIVES_PREFIX + archive_id)[1]
+    if item is None:
+        return 0, 0
+    return item['ModifyIndex'], int(item['Value'])
+
+
+def refs_op(archive_id, index, refs):
+    key = ARCHIVES_PREFIX + archive_id
+    if refs > 0:
+        return kv_op('cas', key, str(refs), index)
+    return kv_op('delete-cas', key, index=index)
+
+
+def add_ops(backup_id, record):
+    return [
+        # Fails if the backup is in the catalog already
+        kv_op('cas', RECORDS_PREFIX + backup_id, format_record(record), 0),
+        kv_op('set', '%s%s/%s' % (GROUPS_PREFIX, record['group_id'],
+                                  backup_id),
+              record['parent_id'] or '')]
+
+
+def add(backup_id, record):
+    """
+    Adds a backup to the catalog and counts it as a user of its archive
+    """
+    consul_obj = connect()
+    archive_id = record['archive_id']
+
+    def build_ops():
+        if consul_obj.kv.get(RECORDS_PREFIX + backup_id)[1] is not None:
+            return None
+
+        index, refs = archive_refs(consul_obj, archive_id)
+        return add_ops(backup_id, record) + \
+            [refs_op(archive_id, index, refs + 1)]
+
+    transact(consul_obj, build_ops)
+
+
+def children(group_id, backup_id):
+    """
+    returns the ids of the incremental backups made on top of a backup,
+    which are always of the same group
+    """
+    consul_obj = connect()
+    prefix = '%s%s/' % (GROUPS_PREFIX, group_id)
+    items = consul_obj.kv.get(prefix, recurse=True)[1] or []
+
+    return sorted(item['Key'][len(prefix):] for item in items
+                  if item['Value'] and
+                  item['Value'].decode('utf-8') == backup_id)
+
+
+def remove(backup_id):
+    """
+    Removes a backup from the catalog. Returns whether its archive is
+    still used by other backups.
+    """
+    consul_obj = connect()
+    result = {'archive_used': True}
+
+    def build_ops():
+        item = consul_obj.kv.get(RECORDS_PREFIX + backup_id)[1]
+        if item is None:
+            return None
+
+        record = json.loads(item['Value'].decode('utf-8'))
+        archive_id = record['archive_id']
+        index, refs = archive_refs(consul_obj, archive_id)
+        # Not counted if it was made by a version that didn't count them
+        refs = max(refs - 1, 0)
+        result['archive_used'] = refs > 0
+
+        ops = [kv_op('delete-cas', RECORDS_PREFIX + backup_id,
+                     index=item['ModifyIndex']),
+               kv_op('delete', '%s%s/%s' % (GROUPS_PREFIX,
+                                            record['group_id'], backup_id))]
+        if index:
+            ops.append(refs_op(archive_id, index, refs))
+        return ops
+
+    transact(consul_obj, build_ops)
+    return result['archive_used']
+
+
+def legacy_backups(items):
+    """
+    returns {backup id: record} of backups kept the way they were before
+    the catalog, with 'ModifyIndex' of their 'type' key
+    """
+    fields = {}
+    for item in items:
+        backup_id, _, field = item['Key'][len(LEGACY_PREFIX):].rpartition('/')
+        value = item['Value'].decode('utf-8') if item['Value'] else ''
+        fields.setdefault(backup_id, {})[field] = value
+        if field == 'type':
+            fields[backup_id]['ModifyIndex'] = item['ModifyIndex']
+
+    backups = {}
+    for backup_id, backup in fields.items():
+        # Partly registered or partly deleted
+        if not all(field in backup for field in
+                   ('type', 'group_id', 'archive_id', 'creation_time')):
+            continue
+
+        level = backup.get('compression_level')
+        files = backup.get('files')
+        backups[backup_id] = {
+            'type': backup['type'],
+            'group_id': backup['group_id'],
+            'archive_id': backup['archive_id'],
+            # In the form the catalog parses quickly
+            'creation_time': dateutil.parser.parse(
+                backup['creation_time']).isoformat(),
+            'storage': backup.get('storage'),
+            'size': int(backup.get('size') or 0),
+            'mem_used': int(backup.get('mem_used') or 0),
+            # Backups made before the codec was recorded are all gzipped
+            'codec': backup.get('codec', 'gzip'),
+            'compression_level': int(level) if level else None,
+            # Full backups have no parent. The contents of backups made
+            # before they were recorded are unknown.
+            'parent_id': backup.get('parent_id') or None,
+            'files': parse_files(files) if files is not None else None,
+            'ModifyIndex': backup['ModifyIndex']}
+
+    return backups
+
+
+def migrate():
+    """
+    Moves backups kept one Consul key per field under 'tarantool_backups/'
+    into the catalog. Each batch is converted and its old keys deleted
+    in one transaction, so that several servers can run it at once and
+    an interrupted run can be started over.
+    """
+    consul_obj = connect()
+    items = consul_obj.kv.get(LEGACY_PREFIX, recurse=True)[1] or []
+    backups = legacy_backups(items)
+    if not backups:
+        return
+
+    logging.info("Moving %d backups to the backup catalog", len(backups))
+
+    backup_ids = sorted(backups)
+    for start in range(0, len(backup_ids), MIGRATE_BATCH):
+        batch = backup_ids[start:start + MIGRATE_BATCH]
+        state = {'backups': backups}
+
+        def build_ops():
+            current = state.pop('backups', None)
+            if current is None:
+                # Another writer got in between, read the batch again
+                current = {}
+                for backup_id in batch:
+                    current.update(legacy_backups(consul_obj.kv.get(
+                        LEGACY_PREFIX + backup_id + '/',
+                        recurse=True)[1] or []))
+
+            ops = []
+            refs = {}
+            for backup_id in batch:
+                if backup_id not in current:
+                    continue
+                record = dict(current[backup_id])
+                ops.append(kv_op('check-index',
+                                 LEGACY_PREFIX + backup_id + '/type',
+                                 index=record.pop('ModifyIndex')))
+                ops.extend(add_ops(backup_id, record))
+                ops.append(kv_op('delete-tree',
+                                 LEGACY_PREFIX + backup_id + '/'))
+                refs[record['archive_id']] = \
+                    refs.get(record['archive_id'], 0) + 1
+
+            for archive_id, count in refs.items():
+                index, refs_now = archive_refs(consul_obj, archive_id)
+                ops.append(refs_op(archive_id, index, refs_now + count))
+            return ops
+
+        try:
+            transact(consul_obj, build_ops)
+        except (consul.base.ClientError, RuntimeError):
+            # What is left is picked up by the next run
+            logging.exception("Failed to move backups %s to the catalog",
+                              ', '.join(batch))
+
+    logging.info("Moved backups to the backup catalog")
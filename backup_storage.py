@@ -1,20 +1,130 @@
 #!/usr/bin/env python3
 
 import global_env
+import gevent
 import consul
 import uuid
 import os
-import gzip
 import hashlib
+import json
 import datetime
+import time
+import collections
+import tarfile
 import task
 import sense
+import backup_catalog
+import compression
+import chunking
+import offload
 import logging
-import fabric.api
-import tempfile
+import sftp_pool
+import s3_transfer
 
 CHUNK_SIZE = 1024 ** 2
 
+# Consul prefix of archived xlog records, see archived_xlogs()
+XLOG_PREFIX = 'taas/xlogs/'
+
+
+class HashingWriter(object):
+    """
+    Computes sha256 and size of what is written to a file as it is
+    written, so the file doesn't have to be read back. Large chunks are
+    hashed off the gevent hub.
+    """
+    def __init__(self, fobj):
+        self.fobj = fobj
+        self.sha256 = hashlib.new('sha256')
+        self.size = 0
+
+    def write(self, data):
+        offload.update_hash(self.sha256, data)
+        self.size += len(data)
+        return self.fobj.write(data)
+
+    def flush(self):
+        self.fobj.flush()
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+
+def write_archive(stream, fobj, compress, codec=compression.GZIP, level=None):
+    """
+    Writes a stream to 'fobj', compressed if asked to. Returns sha256 and
+    size of the bytes written.
+    """
+    sink = HashingWriter(fobj)
+
+    if compress:
+        with compression.writer(sink, codec, level) as compressed:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                compressed.write(chunk)
+    else:
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+            sink.write(chunk)
+
+    return sink.hexdigest(), sink.size
+
+
+class ArchiveValidator(object):
+    """
+    Checks that a stream is a compressed tar archive as it is read: it
+    must decompress cleanly to the end and start with a valid tar header.
+    The decompressed data is thrown away.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.codec = None
+        self.decompressor = None
+        self.header = b''
+        self.error = None
+
+    def read(self, size=-1):
+        chunk = self.stream.read(size)
+
+        if chunk and self.error is None:
+            try:
+                # Decompression is the expensive part of an upload
+                offload.call(self.feed, chunk)
+            except compression.DECOMPRESSION_ERRORS + \
+                    (tarfile.TarError, RuntimeError) as ex:
+                self.error = str(ex)
+
+        return chunk
+
+    def feed(self, chunk):
+        if self.decompressor is None:
+            self.codec = compression.detect(chunk) or compression.GZIP
+            self.decompressor = compression.decompressobj(self.codec)
+
+        while chunk:
+            if self.decompressor.eof:
+                # Concatenated members or frames make a valid archive
+                self.decompressor = compression.decompressobj(self.codec)
+
+            data = self.decompressor.decompress(chunk)
+            chunk = self.decompressor.unused_data
+
+            if len(self.header) < tarfile.BLOCKSIZE:
+                self.header += data[:tarfile.BLOCKSIZE - len(self.header)]
+                if len(self.header) == tarfile.BLOCKSIZE:
+                    tarfile.TarInfo.frombuf(self.header, tarfile.ENCODING,
+                                            'surrogateescape')
+
+    def validate(self):
+        """
+        returns an error message, or None if the archive is valid
+        """
+        if self.error is not None:
+            return "Archive is corrupt: %s" % self.error
+        if self.decompressor is None or not self.decompressor.eof:
+            return "Archive is truncated"
+        if len(self.header) < tarfile.BLOCKSIZE:
+            return "Archive is not a tar file"
+        return None
+
 
 class BackupTask(task.Task):
     backup_task_type = None
@@ -51,8 +161,92 @@ class BackupRegistry(object):
         pass
 
 
+def backup_chain(backups, backup_id, max_length=None):
+    """
+    returns the ids of the backups needed to restore 'backup_id': its
+    full ancestor first and the backup itself last
+    """
+    chain = [backup_id]
+    while backups[chain[-1]]['parent_id'] is not None:
+        parent_id = backups[chain[-1]]['parent_id']
+        if parent_id not in backups:
+            raise RuntimeError("Backup '%s' needs missing parent backup '%s'" %
+                               (chain[-1], parent_id))
+        if parent_id in chain or \
+           (max_length is not None and len(chain) >= max_length):
+            raise RuntimeError("Backup chain of '%s' is too long" % backup_id)
+        chain.append(parent_id)
+
+    return chain[::-1]
+
+
+def chain_files(backups, chain):
+    """
+    returns {name: size} of the data files restored from 'chain'
+    """
+    files = {}
+    for backup_id in chain:
+        files.update(backups[backup_id]['files'] or {})
+    return files
+
+
+def replay_xlogs(xlogs, files):
+    """
+    returns the names of archived xlogs to replay on top of a backup
+    chain with data files 'files', oldest first. 'xlogs' are the records
+    of the group, see archived_xlogs(). Replay starts with the newest
+    xlog of the backup, which may have been written to after the backup
+    was made, and stops at the first xlog that wasn't archived.
+    """
+    backed_up = [f for f in files if f.endswith('.xlog')]
+    if not backed_up:
+        return []
+
+    name = max(backed_up)
+    # A shorter archived copy is from an instance restored since
+    if name not in xlogs or xlogs[name]['size'] < files[name]:
+        return []
+
+    replay = []
+    while name in xlogs and name not in replay:
+        replay.append(name)
+        name = xlogs[name]['next']
+
+    return replay
+
+
+def archived_xlogs(group_id=None):
+    """
+    returns {group_id: {xlog name: record}} of the xlogs archived by the
+    xlog archiver, of all groups or of 'group_id' only
+
+    They are kept outside of the 'tarantool' prefix that Sense watches,
+    so that archiving doesn't make it refresh all of its state.
+    """
+    consul_obj = consul.Consul(host=global_env.consul_host,
+                               token=global_env.consul_acl_token)
+    prefix = XLOG_PREFIX + (group_id + '/' if group_id else '')
+    items = consul_obj.kv.get(prefix, recurse=True)[1] or []
+
+    xlogs = collections.defaultdict(dict)
+    for item in items:
+        if not item['Value']:
+            continue
+        xlog_group_id, name = item['Key'][len(XLOG_PREFIX):].split('/', 1)
+        xlogs[xlog_group_id][name] = json.loads(item['Value'].decode('utf-8'))
+
+    return dict(xlogs)
+
+
 class BackupStorage(object):
     backup_storage_type = None
+    # Whether put_archive() with compress=False stores the archive in
+    # its own codec rather than as it was given
+    recompresses = False
+
+    # How put_archive() compresses archives, see compression.writer()
+    codec = compression.GZIP
+    compression_level = None
 
     def put_archive(self, stream):
         raise NotImplementedError()
@@ -63,47 +257,63 @@ class BackupStorage(object):
     def delete_archive(self, digest):
         raise NotImplementedError()
 
+    def archive_path(self, digest):
+        """
+        returns the local path of an archive, or None if the storage
+        doesn't keep archives on the local filesystem
+        """
+        return None
+
     def register_backup(self, backup_id, archive_id, group_id, instance_type,
-                        size, mem_used):
-        consul_obj = consul.Consul(host=global_env.consul_host,
-                                   token=global_env.consul_acl_token)
-        kv = consul_obj.kv
+                        size, mem_used, codec=None, compression_level=None,
+                        parent_id=None, files=None):
+        """
+        Records a backup in Consul. 'codec' and 'compression_level' describe
+        the archive and default to the storage settings it was written with.
+
+        An incremental backup names the backup it builds on in 'parent_id'.
+        'files' maps names of the data files in the archive to their sizes.
+        """
+        if codec is None:
+            codec = self.codec
+            compression_level = self.compression_level or \
+                compression.DEFAULT_LEVELS[codec]
 
         creation_time = datetime.datetime.now(
             datetime.timezone.utc).isoformat()
 
-        kv.put('tarantool_backups/%s/group_id' % backup_id, group_id)
-        kv.put('tarantool_backups/%s/type' % backup_id, instance_type)
-        kv.put('tarantool_backups/%s/archive_id' % backup_id, archive_id)
-        kv.put('tarantool_backups/%s/creation_time' % backup_id, creation_time)
-        kv.put('tarantool_backups/%s/storage' % backup_id,
-               self.backup_storage_type)
-        kv.put('tarantool_backups/%s/size' % backup_id,
-               str(size))
-        kv.put('tarantool_backups/%s/mem_used' % backup_id,
-               str(mem_used))
+        backup_catalog.add(backup_id, {
+            'group_id': group_id,
+            'type': instance_type,
+            'archive_id': archive_id,
+            'creation_time': creation_time,
+            'storage': self.backup_storage_type,
+            'size': size,
+            'mem_used': mem_used,
+            'codec': codec,
+            'compression_level': compression_level,
+            'parent_id': parent_id,
+            'files': files})
 
         return backup_id
 
     def unregister_backup(self, backup_id, delete_task):
         try:
-            consul_obj = consul.Consul(host=global_env.consul_host,
-                                       token=global_env.consul_acl_token)
-            kv = consul_obj.kv
-
             delete_task.log("Unregistring backup '%s'", backup_id)
 
             backup = sense.Sense.backups()[backup_id]
             archive_id = backup['archive_id']
 
-            kv.delete('tarantool_backups/%s' % backup_id, recurse=True)
+            children = backup_catalog.children(backup['group_id'], backup_id)
+            if children:
+                raise RuntimeError(
+                    "Backup '%s' is the parent of incremental backups %s. " %
+                    (backup_id, ', '.join(children)) +
+                    "Delete them first.")
 
-            sense.Sense.update()
+            archive_used = backup_catalog.remove(backup_id)
 
-            archive_used = False
-            for backup in sense.Sense.backups().values():
-                if backup['archive_id'] == archive_id:
-                    archive_used = True
+            sense.Sense.update()
 
             if archive_used:
                 delete_task.log(
@@ -122,6 +332,33 @@ class BackupStorage(object):
             raise
 
 
+    def register_xlog(self, group_id, name, archive_id, size, next_name):
+        """
+        Records an archived xlog of a group. 'next_name' is the xlog that
+        followed it on the instance, which replay continues with.
+        """
+        consul_obj = consul.Consul(host=global_env.consul_host,
+                                   token=global_env.consul_acl_token)
+
+        record = {'archive_id': archive_id,
+                  'size': size,
+                  'next': next_name,
+                  'storage': self.backup_storage_type,
+                  'codec': self.codec,
+                  'creation_time': datetime.datetime.now(
+                      datetime.timezone.utc).isoformat()}
+
+        consul_obj.kv.put('%s%s/%s' % (XLOG_PREFIX, group_id, name),
+                          json.dumps(record, sort_keys=True))
+
+    def unregister_xlog(self, group_id, name, record):
+        consul_obj = consul.Consul(host=global_env.consul_host,
+                                   token=global_env.consul_acl_token)
+
+        consul_obj.kv.delete('%s%s/%s' % (XLOG_PREFIX, group_id, name))
+        self.delete_archive(record['archive_id'])
+
+
 class FilesystemBackupStorage(BackupStorage):
     backup_storage_type = "filesystem"
 
@@ -142,26 +379,10 @@ class FilesystemBackupStorage(BackupStorage):
 
         tmp_path = os.path.join(self.base_dir, archive_id + '_pending.tar.gz')
 
-        sha256 = hashlib.new('sha256')
-
-        if compress:
-            # Files must have predictable hashes, so timestamp has to be
-            # set to a constant. It is written to the gzip stream.
-            with gzip.GzipFile(tmp_path, mode='wb', mtime=0) as fobj:
-                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
-                    fobj.write(chunk)
-        else:
-            with open(tmp_path, 'wb') as fobj:
-                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
-                    fobj.write(chunk)
-
-        total_size = 0
-        with open(tmp_path, 'rb') as fobj:
-            for chunk in iter(lambda: fobj.read(CHUNK_SIZE), b""):
-                total_size += len(chunk)
-                sha256.update(chunk)
-
-        digest = sha256.hexdigest()
+        with open(tmp_path, 'wb') as fobj:
+            digest, total_size = write_archive(stream, fobj, compress,
+                                               self.codec,
+                                               self.compression_level)
 
         fullpath = os.path.join(self.base_dir, digest + '.tar.gz')
         os.rename(tmp_path, fullpath)
@@ -172,20 +393,249 @@ class FilesystemBackupStorage(BackupStorage):
         fullpath = os.path.join(self.base_dir, digest + '.tar.gz')
 
         if decompress:
-            return gzip.GzipFile(fullpath, 'rb')
+            return compression.reader(open(fullpath, 'rb'))
         else:
             return open(fullpath, 'rb')
 
+    def archive_path(self, digest):
+        return os.path.join(self.base_dir, digest + '.tar.gz')
+
     def delete_archive(self, digest):
         fullpath = os.path.join(self.base_dir, digest + '.tar.gz')
 
         try:
-            os.remove(fullpath)
+            # Freeing the blocks of a large file takes a while
+            offload.call(os.remove, fullpath)
+        except OSError:
+            pass
+
+
+def chunk_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class ChunkBackupStorage(BackupStorage):
+    """
+    Keeps archives on the local filesystem split into content-defined
+    chunks, each of which is stored once however many archives share
+    it. Consecutive backups of a group mostly differ in a few chunks of
+    the snapshot and in new xlogs, so they take little extra space.
+
+    An archive is a manifest of its chunks, named by its own hash.
+    Chunks are compressed separately, so concatenating them in manifest
+    order gives a valid compressed archive.
+    """
+    backup_storage_type = "chunk"
+    recompresses = True
+
+    # Unreferenced chunks younger than this are kept on deletion, as an
+    # archive that is being stored may be about to reference them
+    GRACE_PERIOD = 24 * 3600  # seconds
+    # Time from a deletion to the sweep of the chunks it left behind, so
+    # that deleting many archives reads the manifests only once
+    SWEEP_DELAY = 600  # seconds
+
+    def __init__(self, config):
+        if 'base_dir' not in config:
+            raise RuntimeError(
+                "ChunkBackupStorage needs 'base_dir' in config")
+
+        if not os.path.exists(config['base_dir']):
+            raise RuntimeError(
+                "ChunkBackupStorage needs '%s' to exist" %
+                config['base_dir'])
+
+        self.base_dir = config['base_dir']
+        self.chunk_dir = os.path.join(self.base_dir, 'chunks')
+        self.manifest_dir = os.path.join(self.base_dir, 'manifests')
+
+        os.makedirs(self.chunk_dir, exist_ok=True)
+        os.makedirs(self.manifest_dir, exist_ok=True)
+
+        self.sweep_scheduled = False
+
+    def chunk_path(self, codec, digest):
+        extension = {compression.GZIP: 'gz', compression.ZSTD: 'zst'}[codec]
+        return os.path.join(self.chunk_dir, digest[:2],
+                            '%s.%s' % (digest, extension))
+
+    def manifest_path(self, digest):
+        return os.path.join(self.manifest_dir, digest + '.json')
+
+    def put_chunk(self, data):
+        """
+        stores a chunk unless it is already there, returns its hash and
+        compressed size, and whether it was new
+        """
+        digest = offload.call(chunk_hash, data)
+        path = self.chunk_path(self.codec, digest)
+
+        try:
+            # Refreshing the time keeps deletions from sweeping it away
+            os.utime(path)
+            return digest, os.path.getsize(path), False
+        except FileNotFoundError:
+            pass
+
+        compressed = offload.call(compression.compress_frame, data,
+                                  self.codec, self.compression_level)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '%s_%s_pending' % (path, uuid.uuid4().hex)
+        with open(tmp_path, 'wb') as fobj:
+            fobj.write(compressed)
+        os.rename(tmp_path, path)
+
+        return digest, len(compressed), True
+
+    def put_archive(self, stream, compress=True):
+        # Compressed data doesn't deduplicate, chunks are cut from the
+        # archive itself
+        if not compress:
+            stream = compression.StreamReader(stream)
+
+        chunks = []
+        total_size = 0
+        new_chunks = 0
+        new_size = 0
+
+        for data in chunking.chunks(stream):
+            digest, size, is_new = self.put_chunk(data)
+            chunks.append([digest, len(data), size])
+            total_size += size
+            if is_new:
+                new_chunks += 1
+                new_size += size
+
+        manifest = json.dumps({'codec': self.codec, 'chunks': chunks},
+                              sort_keys=True,
+                              separators=(',', ':')).encode('utf-8')
+        digest = chunk_hash(manifest)
+
+        tmp_path = '%s_%s_pending' % (self.manifest_path(digest),
+                                      uuid.uuid4().hex)
+        with open(tmp_path, 'wb') as fobj:
+            fobj.write(manifest)
+        os.rename(tmp_path, self.manifest_path(digest))
+
+        logging.info("Stored archive '%s': %d of %d chunks new, " +
+                     "%d of %d bytes", digest, new_chunks, len(chunks),
+                     new_size, total_size)
+
+        return digest, total_size
+
+    def read_manifest(self, digest):
+        with open(self.manifest_path(digest), 'rb') as fobj:
+            return json.loads(fobj.read().decode('utf-8'))
+
+    def get_archive(self, digest, decompress=True):
+        return ChunkReader(self, self.read_manifest(digest), decompress)
+
+    def delete_archive(self, digest):
+        try:
+            os.remove(self.manifest_path(digest))
         except OSError:
             pass
 
+        if not self.sweep_scheduled:
+            self.sweep_scheduled = True
+            gevent.spawn_later(self.SWEEP_DELAY, self.sweep)
+
+    def sweep(self):
+        # Deletions from now on need a sweep of their own
+        self.sweep_scheduled = False
+        try:
+            offload.call(self.sweep_chunks)
+        except Exception:
+            logging.exception("Failed to sweep chunks in '%s'",
+                              self.chunk_dir)
+
+    def sweep_chunks(self):
+        """
+        removes chunks that no manifest references any more
+        """
+        referenced = set()
+        for name in os.listdir(self.manifest_dir):
+            if not name.endswith('.json'):
+                continue
+            try:
+                manifest = self.read_manifest(name[:-len('.json')])
+            except FileNotFoundError:
+                continue
+            referenced.update(self.chunk_path(manifest['codec'], chunk[0])
+                              for chunk in manifest['chunks'])
+
+        deadline = time.time() - self.GRACE_PERIOD
+        for dirpath, _, filenames in os.walk(self.chunk_dir):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if path in referenced:
+                    continue
+                try:
+                    if os.path.getmtime(path) < deadline:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+
+class ChunkReader(object):
+    """
+    Reads an archive of a ChunkBackupStorage chunk by chunk, either as
+    stored or decompressed and checked against the chunk hashes
+    """
+    def __init__(self, storage, manifest, decompress):
+        self.storage = storage
+        self.codec = manifest['codec']
+        self.chunks = collections.deque(manifest['chunks'])
+        self.decompress = decompress
+        self.buffer = b''
+        self.offset = 0
+
+    def next_chunk(self):
+        digest = self.chunks.popleft()[0]
+        path = self.storage.chunk_path(self.codec, digest)
+        with open(path, 'rb') as fobj:
+            data = fobj.read()
+
+        if self.decompress:
+            data = offload.call(compression.decompress_frame, data,
+                                self.codec)
+            if offload.call(chunk_hash, data) != digest:
+                raise RuntimeError("Chunk '%s' is corrupt" % digest)
+
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            result = [self.buffer[self.offset:]]
+            while self.chunks:
+                result.append(self.next_chunk())
+            self.buffer = b''
+            self.offset = 0
+            return b''.join(result)
+
+        while self.offset == len(self.buffer):
+            if not self.chunks:
+                return b''
+            self.buffer = self.next_chunk()
+            self.offset = 0
+
+        result = self.buffer[self.offset:self.offset + size]
+        self.offset += len(result)
+        return result
+
+    def close(self):
+        self.chunks.clear()
+        self.buffer = b''
+        self.offset = 0
+
 
 class SSHBackupStorage(BackupStorage):
+    """
+    Keeps archives in a directory of a remote host, accessed over SFTP.
+    Archives are streamed to and from the host as they are written and
+    read, over sessions that are kept open between archives.
+    """
     backup_storage_type = "ssh"
 
     def __init__(self, config):
@@ -203,103 +653,159 @@ class SSHBackupStorage(BackupStorage):
         self.host = config['host']
         self.password = config.get('password', None)
 
+        self.pool = sftp_pool.SFTPSessionPool(
+            self.host, self.user, self.identity, self.password,
+            known_hosts=config.get('known_hosts', None),
+            host_key_policy=config.get('host_key_policy', None) or
+            sftp_pool.DEFAULT_HOST_KEY_POLICY)
+
+    def remote_path(self, name):
+        # Remote paths are POSIX, whatever the local OS is
+        return self.base_dir.rstrip('/') + '/' + name
+
     def put_archive(self, stream, compress=True):
-        with tempfile.TemporaryFile(mode='wb+') as tmp_file:
-            sha256 = hashlib.new('sha256')
-
-            if compress:
-                # Files must have predictable hashes, so timestamp has to be
-                # set to a constant. It is written to the gzip stream.
-                with gzip.GzipFile(fileobj=tmp_file, mode='wb', mtime=0) as fobj:
-                    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
-                        fobj.write(chunk)
-            else:
-                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
-                    tmp_file.write(chunk)
-
-            tmp_file.seek(0)
-            total_size = 0
-            for chunk in iter(lambda: tmp_file.read(CHUNK_SIZE), b""):
-                total_size += len(chunk)
-                sha256.update(chunk)
-            tmp_file.seek(0)
-            digest = sha256.hexdigest()
-
-            settings = {'abort_on_prompts': False, 'host_string': self.host,
-                        'abort_exception': RuntimeError, 'remote_interrupt': False,
-                        'always_use_pty': False, 'warn_only': True}
-            if self.user:
-                settings['user'] = self.user
-            if self.identity:
-                settings['key_filename'] = self.identity
-            if self.password:
-                settings['password'] = self.password
-
-            with fabric.api.settings(**settings):
-                fullpath = os.path.join(self.base_dir, digest + '.tar.gz')
-                status = fabric.api.put(local_path = tmp_file,
-                                        remote_path = fullpath)
-            if not status.succeeded:
-                raise RuntimeError("Failed to upload archive: '%s'" %
-                                   fullpath)
+        tmp_path = self.remote_path(uuid.uuid4().hex + '_pending.tar.gz')
 
+        try:
+            with self.pool.open(tmp_path, 'wb', CHUNK_SIZE) as fobj:
+                digest, total_size = write_archive(stream, fobj, compress,
+                                                   self.codec,
+                                                   self.compression_level)
+
+            fullpath = self.remote_path(digest + '.tar.gz')
+            self.pool.run(lambda sftp: sftp.posix_rename(tmp_path, fullpath))
+        except Exception as ex:
+            try:
+                self.pool.run(lambda sftp: sftp.remove(tmp_path))
+            except Exception:
+                pass
+            raise RuntimeError("Failed to upload archive: '%s': %s" %
+                               (tmp_path, ex))
 
         return digest, total_size
 
     def get_archive(self, digest, decompress=True):
-        tmp_file = tempfile.TemporaryFile(mode='wb+')
-
-        settings = {'abort_on_prompts': False, 'host_string': self.host,
-                    'abort_exception': RuntimeError, 'remote_interrupt': False,
-                    'always_use_pty': False, 'warn_only': True}
-        if self.user:
-            settings['user'] = self.user
-        if self.identity:
-            settings['key_filename'] = self.identity
-        if self.password:
-            settings['password'] = self.password
-
-        with fabric.api.settings(**settings):
-            fullpath = os.path.join(self.base_dir, digest + '.tar.gz')
-            status = fabric.api.get(local_path = tmp_file,
-                                    remote_path = fullpath)
-        if not status.succeeded:
-            raise RuntimeError("Failed to download archive: '%s'" %
-                               fullpath)
-
-        tmp_file.seek(0)
+        fullpath = self.remote_path(digest + '.tar.gz')
+
+        try:
+            fobj = self.pool.open(fullpath, 'rb', CHUNK_SIZE)
+        except sftp_pool.SESSION_ERRORS + (IOError,) as ex:
+            raise RuntimeError("Failed to download archive: '%s': %s" %
+                               (fullpath, ex))
 
         if decompress:
-            return gzip.GzipFile(fileobj=tmp_file, mode='rb')
+            return compression.reader(fobj)
         else:
-            return tmp_file
+            return fobj
 
     def delete_archive(self, digest):
-        settings = {'abort_on_prompts': False, 'host_string': self.host,
-                    'abort_exception': RuntimeError, 'remote_interrupt': False,
-                    'always_use_pty': False, 'warn_only': True}
-        if self.user:
-            settings['user'] = self.user
-        if self.identity:
-            settings['key_filename'] = self.identity
-        if self.password:
-            settings['password'] = self.password
-
-        with fabric.api.settings(**settings):
-            fullpath = os.path.join(self.base_dir, digest + '.tar.gz')
-            status = fabric.api.run("rm -rf '%s'" % fullpath)
-        if not status.succeeded:
-            raise RuntimeError("Failed to delete archive: '%s'" %
-                               fullpath)
+        fullpath = self.remote_path(digest + '.tar.gz')
+
+        def remove(sftp):
+            try:
+                sftp.remove(fullpath)
+            except FileNotFoundError:
+                pass
+
+        try:
+            self.pool.run(remove)
+        except sftp_pool.SESSION_ERRORS + (IOError,) as ex:
+            raise RuntimeError("Failed to delete archive: '%s': %s" %
+                               (fullpath, ex))
+
+
+class S3BackupStorage(BackupStorage):
+    """
+    Keeps archives in an S3 bucket, or in anything that speaks the S3
+    protocol. Archives are uploaded in parts as they are written and
+    downloaded with ranged GETs, several parts at a time, so a transfer
+    isn't limited to what one connection can do.
+    """
+    backup_storage_type = "s3"
+
+    def __init__(self, config):
+        if not config.get('bucket'):
+            raise RuntimeError(
+                "S3BackupStorage needs 'bucket' in config")
+
+        self.bucket = config['bucket']
+        # Archives go under this key prefix
+        self.prefix = (config.get('base_dir') or '').strip('/')
+        if self.prefix:
+            self.prefix += '/'
+        self.concurrency = int(config.get('concurrency') or
+                               s3_transfer.DEFAULT_CONCURRENCY)
+
+        self.s3 = s3_transfer.client(config.get('endpoint'),
+                                     config.get('region'),
+                                     config.get('access_key'),
+                                     config.get('secret_key'),
+                                     self.concurrency)
+
+    def archive_key(self, digest):
+        return self.prefix + digest + '.tar.gz'
+
+    def put_archive(self, stream, compress=True):
+        # The digest is only known at the end, so the archive is uploaded
+        # under a temporary key and copied to its own on the server
+        tmp_key = self.prefix + 'pending/' + uuid.uuid4().hex + '.tar.gz'
+        writer = s3_transfer.MultipartWriter(self.s3, self.bucket, tmp_key,
+                                             self.concurrency)
+
+        try:
+            digest, total_size = write_archive(stream, writer, compress,
+                                               self.codec,
+                                               self.compression_level)
+            writer.close()
+        except Exception:
+            writer.abort()
+            raise
+
+        try:
+            s3_transfer.copy(self.s3, self.bucket, tmp_key,
+                             self.archive_key(digest), total_size,
+                             self.concurrency)
+        finally:
+            self.s3.delete_object(Bucket=self.bucket, Key=tmp_key)
+
+        return digest, total_size
+
+    def get_archive(self, digest, decompress=True):
+        try:
+            fobj = s3_transfer.RangeReader(self.s3, self.bucket,
+                                           self.archive_key(digest),
+                                           self.concurrency)
+        except Exception as ex:
+            if s3_transfer.is_missing(ex):
+                raise RuntimeError("No such archive: '%s'" % digest)
+            raise
+
+        if decompress:
+            return compression.reader(fobj)
+        else:
+            return fobj
+
+    def delete_archive(self, digest):
+        # Deleting a missing object is not an error in S3
+        self.s3.delete_object(Bucket=self.bucket, Key=self.archive_key(digest))
 
 
 def create(storage_type, config):
     storages = {'filesystem': FilesystemBackupStorage,
-                'ssh': SSHBackupStorage}
+                'chunk': ChunkBackupStorage,
+                'ssh': SSHBackupStorage,
+                's3': S3BackupStorage}
 
     if storage_type not in storages:
         raise RuntimeError("No such backup storage type: '%s'" % storage_type)
 
     storage = storages[storage_type](config)
 
+    if config.get('compression'):
+        compression.check_codec(config['compression'])
+        storage.codec = config['compression']
+
+    if config.get('compression_level') is not None:
+        storage.compression_level = int(config['compression_level'])
+
     return storage
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Measures how long small API requests take while a backup upload is
+being stored: the archive is validated, hashed and written the way
+BackupList.post() does it, in the same process as the API server.
+
+    python3 benchmarks/api_latency.py [--size-mb 1024] [--clients 4]
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import tarfile
+import argparse
+import tempfile
+import subprocess
+import http.client
+import gevent
+from gevent.pywsgi import WSGIServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import backup_storage
+import compression
+from backup_put import SyntheticStream
+
+BODY = json.dumps([{'id': str(i), 'type': 'memcached', 'status': 'passing'}
+                   for i in range(20)]).encode('utf-8')
+
+
+def app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'application/json'),
+                              ('Content-Length', str(len(BODY)))])
+    return [BODY]
+
+
+def make_archive(path, size):
+    tarinfo = tarfile.TarInfo('00000000000000000000.snap')
+    tarinfo.size = size
+
+    with open(path, 'wb') as fobj:
+        with compression.writer(fobj) as compressed:
+            compressed.write(tarinfo.tobuf())
+            stream = SyntheticStream(size)
+            for chunk in iter(lambda: stream.read(), b""):
+                compressed.write(chunk)
+            # Size is a multiple of the block size, only the end is left
+            compressed.write(b'\0' * 2 * tarfile.BLOCKSIZE)
+
+
+def run_clients(port, clients):
+    """
+    Sends requests until SIGTERM, then prints their latencies. Runs in a
+    process of its own, so a blocked server hub doesn't stall the clients
+    and the time requests spend waiting for it is counted.
+    """
+    latencies = []
+    stop = []
+    gevent.signal_handler(signal.SIGTERM, stop.append, True)
+
+    def client():
+        while not stop:
+            started = time.time()
+            conn = http.client.HTTPConnection('127.0.0.1', port)
+            conn.request('GET', '/')
+            conn.getresponse().read()
+            conn.close()
+            latencies.append(time.time() - started)
+            gevent.sleep(0.005)
+
+    gevent.joinall([gevent.spawn(client) for _ in range(clients)])
+    print(json.dumps(latencies))
+
+
+def upload(storage, path):
+    with open(path, 'rb') as fobj:
+        validator = backup_storage.ArchiveValidator(fobj)
+        digest, _ = storage.put_archive(validator, compress=False)
+    assert validator.validate() is None
+    storage.delete_archive(digest)
+
+
+def measure(port, clients, job):
+    proc = subprocess.Popen([sys.executable, __file__, '--client', str(port),
+                             '--clients', str(clients)],
+                            stdout=subprocess.PIPE)
+    # Let the clients start sending requests
+    gevent.sleep(0.5)
+
+    started = time.time()
+    job()
+    elapsed = time.time() - started
+
+    proc.terminate()
+    latencies = sorted(json.loads(proc.communicate()[0].decode('utf-8')))
+
+    percentile = lambda p: latencies[min(len(latencies) - 1,
+                                         int(len(latencies) * p))] * 1000
+    return (elapsed, len(latencies), percentile(0.5), percentile(0.99),
+            latencies[-1] * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-mb', type=int, default=1024)
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--client', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.client:
+        run_clients(args.client, args.clients)
+        return
+
+    base_dir = tempfile.mkdtemp()
+    try:
+        archive = os.path.join(base_dir, 'upload.tar.gz')
+        make_archive(archive, args.size_mb * 1024 ** 2)
+        storage = backup_storage.create('filesystem',
+                                        {'base_dir': base_dir})
+
+        server = WSGIServer(('127.0.0.1', 0), app, log=None)
+        server.start()
+
+        for name, job in (('idle', lambda: gevent.sleep(3)),
+                          ('upload', lambda: upload(storage, archive))):
+            result = measure(server.server_port, args.clients, job)
+            print("%-6s %6.2fs %6d requests  p50 %7.2f ms  p99 %7.2f ms  "
+                  "max %7.2f ms" % ((name,) + result))
+
+        server.stop()
+    finally:
+        shutil.rmtree(base_dir)
+
+
+if __name__ == '__main__':
+    main()
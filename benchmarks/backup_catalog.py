@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Compares the backup catalog with the way backups used to be kept in
+Consul, one key per field under 'tarantool_backups/', for a large number
+of backups. Times the work done in the server on what Consul returns:
+building Sense.backups() after a refresh, and deleting a backup, which
+used to scan every backup twice and refresh all of them in between.
+Also counts the keys read from Consul for each.
+
+    python3 benchmarks/backup_catalog.py [--backups 100000] [--groups 1000]
+"""
+
+import os
+import re
+import sys
+import time
+import argparse
+import datetime
+import collections
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import global_env
+import backup_catalog
+import sense
+
+
+def make_backups(count, groups):
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    backups = {}
+    for i in range(count):
+        group = i % groups
+        # Every group's backups form chains of 7, like incremental ones
+        parent = i - groups if (i // groups) % 7 else None
+        backups['backup%06d' % i] = {
+            'type': 'tarantool',
+            'group_id': 'group%04d' % group,
+            'archive_id': '%064x' % i,
+            'creation_time': (start + datetime.timedelta(
+                minutes=i)).isoformat(),
+            'storage': 'filesystem',
+            'size': 1024 ** 2,
+            'mem_used': 1024 ** 2,
+            'codec': 'gzip',
+            'compression_level': 6,
+            'parent_id': 'backup%06d' % parent if parent is not None
+                         else None,
+            'files': {'%020d.snap' % i: 1024 ** 2, '%020d.xlog' % i: 4096}}
+    return backups
+
+
+def legacy_items(backups):
+    items = []
+    for backup_id, backup in backups.items():
+        for field in ('group_id', 'type', 'archive_id', 'creation_time',
+                      'storage', 'size', 'mem_used'):
+            items.append({'Key': 'tarantool_backups/%s/%s' %
+                                 (backup_id, field),
+                          'Value': str(backup[field]).encode('utf-8')})
+    return items
+
+
+def catalog_items(backups):
+    return [{'Key': backup_catalog.RECORDS_PREFIX + backup_id,
+             'Value': backup_catalog.format_record(backup).encode('utf-8'),
+             'ModifyIndex': index + 1}
+            for index, (backup_id, backup) in enumerate(backups.items())]
+
+
+def legacy_parse(items):
+    """
+    What Sense.backups() did with the keys under 'tarantool_backups/'
+    """
+    backups_kv = sense.consul_kv_to_dict(items)
+    backups = collections.defaultdict(dict)
+
+    for key, value in backups_kv.items():
+        for field, parse in (('type', str), ('group_id', str),
+                             ('archive_id', str),
+                             ('creation_time', sense.dateutil.parser.parse),
+                             ('storage', str), ('size', int),
+                             ('mem_used', int), ('codec', str),
+                             ('compression_level', int),
+                             ('parent_id', str), ('files', str)):
+            match = re.match('tarantool_backups/(.*)/%s' % field, key)
+            if match:
+                backups[match.group(1)][field] = parse(value)
+
+    return dict(backups)
+
+
+def legacy_delete(items, backup_id):
+    """
+    What unregister_backup() did in the server: look for children among
+    all backups, refresh and parse all of them again, and look for other
+    users of the archive among all of them
+    """
+    backups = legacy_parse(items)
+    archive_id = backups[backup_id]['archive_id']
+    children = [b for b, backup in backups.items()
+                if backup.get('parent_id') == backup_id]
+
+    items = [item for item in items if
+             not item['Key'].startswith('tarantool_backups/%s/' % backup_id)]
+    backups = legacy_parse(items)
+    used = any(backup['archive_id'] == archive_id
+               for backup in backups.values())
+    return children, used
+
+
+def catalog_parse(items):
+    global_env.backups = items
+    return sense.Sense.backups()
+
+
+def catalog_delete(items, groups_items, record_item):
+    """
+    The same in the catalog: the group index is read for children, the
+    record and reference count are read and changed in one transaction,
+    and only the records that changed are parsed after the refresh
+    """
+    backup_id = record_item['Key'][len(backup_catalog.RECORDS_PREFIX):]
+    record = backup_catalog.parse_record(record_item['Value'])
+    prefix = backup_catalog.GROUPS_PREFIX + record['group_id'] + '/'
+    children = [item['Key'][len(prefix):]
+                for item in groups_items[record['group_id']]
+                if item['Value'].decode('utf-8') == backup_id]
+
+    catalog_parse([item for item in items if item is not record_item])
+    return children
+
+
+def timed(func, *args):
+    started = time.time()
+    func(*args)
+    return time.time() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backups', type=int, default=100000)
+    parser.add_argument('--groups', type=int, default=1000)
+    args = parser.parse_args()
+
+    backups = make_backups(args.backups, args.groups)
+    legacy = legacy_items(backups)
+    catalog = catalog_items(backups)
+
+    groups_items = collections.defaultdict(list)
+    for backup_id, backup in backups.items():
+        groups_items[backup['group_id']].append({
+            'Key': '%s%s/%s' % (backup_catalog.GROUPS_PREFIX,
+                                backup['group_id'], backup_id),
+            'Value': (backup['parent_id'] or '').encode('utf-8')})
+
+    # The last backup of a group has no children, so it can be deleted
+    victim = 'backup%06d' % (args.backups - 1)
+    victim_item = catalog[-1]
+
+    print("%d backups in %d groups" % (args.backups, args.groups))
+    # The 'tarantool' prefix of group keys matched the legacy keys too
+    print("Keys read per refresh while nothing changes: "
+          "legacy %d, catalog 1" % (2 * len(legacy)))
+
+    print("Parse all backups:     legacy %7.2f s   catalog %7.2f s" %
+          (timed(legacy_parse, legacy), timed(catalog_parse, catalog)))
+
+    # One new backup: only its record is parsed
+    added = catalog + [{'Key': backup_catalog.RECORDS_PREFIX + 'new',
+                        'Value': catalog[0]['Value'],
+                        'ModifyIndex': len(catalog) + 1}]
+    print("Parse after one backup:                    catalog %7.2f s" %
+          timed(catalog_parse, added))
+
+    catalog_parse(catalog)
+    print("Delete a backup:       legacy %7.2f s   catalog %7.2f s" %
+          (timed(legacy_delete, legacy, victim),
+           timed(catalog_delete, catalog, groups_items, victim_item)))
+    print("Keys read per delete:  legacy %d, catalog %d" %
+          (2 * len(legacy), len(catalog) +
+           len(groups_items[backups[victim]['group_id']]) + 2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Compares the space taken by a series of daily backups of one tarantool
+instance in filesystem and chunk storage. Each day 1% of the rows
+change, mostly recent ones, 1% are added and the day's xlog appears.
+The application code stays the same.
+
+    python3 benchmarks/backup_dedup.py [--rows 200000] [--days 7]
+"""
+
+import os
+import io
+import sys
+import time
+import random
+import shutil
+import struct
+import tarfile
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import backup_storage
+
+
+def make_row(rnd, key):
+    payload = bytes(rnd.choice(b'abcdefghijklmnop') for _ in range(60))
+    return struct.pack('<4sIQ', b'\xd5\xba\x0b\xab', 64 + 12, key) + payload
+
+
+def make_archive(files):
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode='w') as tar:
+        for name, data in files:
+            tarinfo = tarfile.TarInfo(name)
+            tarinfo.size = len(data)
+            tar.addfile(tarinfo, io.BytesIO(data))
+    out.seek(0)
+    return out
+
+
+def disk_usage(path):
+    return sum(os.path.getsize(os.path.join(dirpath, name))
+               for dirpath, _, names in os.walk(path) for name in names)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--days', type=int, default=7)
+    args = parser.parse_args()
+
+    rnd = random.Random(42)
+    rows = {key: make_row(rnd, key) for key in range(args.rows)}
+    code = [('code/app/%d.lua' % i,
+             (''.join('local x%d = %d\n' % (j, rnd.randrange(1000))
+                      for j in range(2000))).encode('utf-8'))
+            for i in range(20)]
+    xlogs = []
+
+    base_dir = tempfile.mkdtemp()
+    try:
+        storages = {}
+        for storage_type in ('filesystem', 'chunk'):
+            path = os.path.join(base_dir, storage_type)
+            os.mkdir(path)
+            storages[storage_type] = (
+                path, backup_storage.create(storage_type, {'base_dir': path}))
+
+        for day in range(args.days):
+            if day > 0:
+                # Like in most databases, recent rows are the hot ones
+                hot = sorted(rows)[-len(rows) // 10:]
+                changed = sorted(rnd.sample(hot, len(rows) // 100))
+                for key in changed:
+                    rows[key] = make_row(rnd, key)
+                for key in range(len(rows), len(rows) + len(rows) // 100):
+                    rows[key] = make_row(rnd, key)
+                xlogs.append(('data/%020d.xlog' % day,
+                              b''.join(rows[key] for key in changed)))
+
+            snapshot = b''.join(rows[key] for key in sorted(rows))
+            files = [('data/%020d.snap' % day, snapshot)] + xlogs + code
+
+            for storage_type, (path, storage) in sorted(storages.items()):
+                before = disk_usage(path)
+                started = time.time()
+                storage.put_archive(make_archive(files))
+                elapsed = time.time() - started
+                print("day %d %-10s +%8.1f MiB  total %8.1f MiB  %5.2fs" %
+                      (day, storage_type,
+                       (disk_usage(path) - before) / 1024 ** 2,
+                       disk_usage(path) / 1024 ** 2, elapsed))
+    finally:
+        shutil.rmtree(base_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Measures how fast a backup archive is served over HTTP: read through
+Python in chunks like before, and with sendfile() as BackupData does for
+filesystem storage, fetched whole and in parallel ranges.
+
+    python3 benchmarks/backup_download.py [--size-mb 1024] [--segments 4]
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import http.client
+import gevent
+import gevent.pool
+from gevent.pywsgi import WSGIServer, WSGIHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import fileserve
+
+READ_SIZE = 1024 ** 2
+
+
+def make_app(path, mode):
+    size = os.path.getsize(path)
+
+    def app(environ, start_response):
+        start, end = 0, size
+        status = '200 OK'
+
+        if 'HTTP_RANGE' in environ:
+            first, last = environ['HTTP_RANGE'][len('bytes='):].split('-')
+            start, end = int(first), int(last) + 1
+            status = '206 Partial Content'
+
+        start_response(status, [('Content-Length', str(end - start))])
+        fobj = open(path, 'rb')
+
+        if mode == 'sendfile':
+            return fileserve.FileRange(fobj, start, end - start)
+
+        def chunks():
+            with fobj:
+                fobj.seek(start)
+                remaining = end - start
+                while remaining > 0:
+                    chunk = fobj.read(min(8192, remaining))
+                    remaining -= len(chunk)
+                    yield chunk
+
+        return chunks()
+
+    return app
+
+
+def fetch(port, start=None, end=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    headers = {}
+    if start is not None:
+        headers['Range'] = 'bytes=%d-%d' % (start, end - 1)
+
+    conn.request('GET', '/', headers=headers)
+    response = conn.getresponse()
+
+    received = 0
+    while True:
+        chunk = response.read(READ_SIZE)
+        if not chunk:
+            break
+        received += len(chunk)
+
+    conn.close()
+    return received
+
+
+def run(path, mode, segments):
+    handler = fileserve.SendfileHandler if mode == 'sendfile' else WSGIHandler
+    server = WSGIServer(('127.0.0.1', 0), make_app(path, mode),
+                        handler_class=handler, log=None)
+    server.start()
+    port = server.server_port
+    size = os.path.getsize(path)
+
+    started = time.time()
+    if segments == 1:
+        received = fetch(port)
+    else:
+        step = -(-size // segments)
+        pool = gevent.pool.Pool(segments)
+        received = sum(pool.map(
+            lambda start: fetch(port, start, min(start + step, size)),
+            range(0, size, step)))
+    elapsed = time.time() - started
+
+    server.stop()
+    assert received == size
+
+    return size / elapsed / 1024 ** 2
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-mb', type=int, default=1024)
+    parser.add_argument('--segments', type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile() as archive:
+        block = os.urandom(READ_SIZE)
+        for _ in range(args.size_mb):
+            archive.write(block)
+        archive.flush()
+
+        for mode in ('chunked', 'sendfile'):
+            for segments in sorted(set([1, args.segments])):
+                # Warm up the page cache so disk speed doesn't matter
+                run(archive.name, mode, segments)
+                print("%-8s segments=%d: %8.1f MiB/s" %
+                      (mode, segments, run(archive.name, mode, segments)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Measures backup throughput of FilesystemBackupStorage.put_archive() for
+uncompressed archives and each available compression codec.
+
+    python3 benchmarks/backup_put.py [--size-mb 512] [--base-dir DIR]
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import backup_storage
+import compression
+
+BLOCK_SIZE = 1024 ** 2
+
+
+class SyntheticStream(object):
+    """
+    Produces 'size' bytes that compress about 3:1, like a typical snapshot
+    """
+    def __init__(self, size):
+        random_part = os.urandom(BLOCK_SIZE // 3)
+        self.block = (random_part + b'\0' * BLOCK_SIZE)[:BLOCK_SIZE]
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > BLOCK_SIZE:
+            size = BLOCK_SIZE
+        size = min(size, self.remaining)
+        self.remaining -= size
+        return self.block[:size]
+
+
+def run(base_dir, size, compress, codec=compression.GZIP):
+    storage = backup_storage.create('filesystem', {'base_dir': base_dir,
+                                                   'compression': codec})
+
+    started = time.time()
+    digest, _ = storage.put_archive(SyntheticStream(size), compress=compress)
+    elapsed = time.time() - started
+
+    storage.delete_archive(digest)
+    return size / elapsed / 1024 ** 2
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-mb', type=int, default=512)
+    parser.add_argument('--base-dir')
+    args = parser.parse_args()
+
+    base_dir = args.base_dir or tempfile.mkdtemp()
+    try:
+        size = args.size_mb * BLOCK_SIZE
+        print("%-6s %8.1f MiB/s of input" %
+              ('none', run(base_dir, size, False)))
+
+        for codec in compression.CODECS:
+            if codec == compression.ZSTD and compression.zstandard is None:
+                continue
+            print("%-6s %8.1f MiB/s of input" %
+                  (codec, run(base_dir, size, True, codec)))
+    finally:
+        if not args.base_dir:
+            shutil.rmtree(base_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Measures backup and restore throughput of S3BackupStorage for different
+numbers of parts transferred at a time.
+
+Runs against a moto server on localhost unless --endpoint is given. On
+localhost a single connection isn't limited the way one is over a real
+network, so connections go through a proxy that caps each of them at
+--stream-mbps, like the bandwidth-delay product caps a TCP stream.
+
+    python3 benchmarks/backup_s3.py [--endpoint URL] [--size-mb 256]
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import sys
+import time
+import socket
+import argparse
+import subprocess
+import gevent
+import gevent.server
+import gevent.socket
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import backup_storage
+import s3_transfer
+from backup_put import SyntheticStream
+
+BUCKET = 'taas-benchmark'
+
+
+def throttle_proxy(upstream_port, rate):
+    """
+    starts a TCP proxy to 'upstream_port' that passes at most 'rate'
+    bytes per second each way on each connection, returns its port
+    """
+    def pump(source, dest):
+        # Idle time doesn't build up credit for a burst later
+        free_at = time.time()
+        try:
+            for data in iter(lambda: source.recv(64 * 1024), b''):
+                dest.sendall(data)
+                free_at = max(free_at, time.time()) + len(data) / rate
+                gevent.sleep(max(0, free_at - time.time()))
+        except OSError:
+            pass
+        finally:
+            dest.close()
+
+    def handle(client, _):
+        upstream = gevent.socket.create_connection(('127.0.0.1',
+                                                    upstream_port))
+        gevent.spawn(pump, upstream, client)
+        pump(client, upstream)
+
+    server = gevent.server.StreamServer(('127.0.0.1', 0), handle)
+    server.start()
+    return server.server_port
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def measure(config, size):
+    storage = backup_storage.create('s3', config)
+
+    started = time.time()
+    digest, _ = storage.put_archive(SyntheticStream(size), compress=False)
+    put_time = time.time() - started
+
+    started = time.time()
+    fobj = storage.get_archive(digest, decompress=False)
+    try:
+        for _ in iter(lambda: fobj.read(backup_storage.CHUNK_SIZE), b""):
+            pass
+    finally:
+        fobj.close()
+    get_time = time.time() - started
+
+    storage.delete_archive(digest)
+    return put_time, get_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--endpoint')
+    parser.add_argument('--bucket', default=BUCKET)
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--stream-mbps', type=float, default=20,
+                        help='MiB/s per connection, 0 for no limit')
+    parser.add_argument('--concurrency', default='1,2,4,8')
+    args = parser.parse_args()
+
+    proc = None
+    try:
+        endpoint = args.endpoint
+        if not endpoint:
+            port = free_port()
+            proc = subprocess.Popen(
+                [sys.executable, '-m', 'moto.server', '-p', str(port)],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            time.sleep(3)
+            endpoint = 'http://127.0.0.1:%d' % port
+            os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+            os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+
+        if args.stream_mbps:
+            upstream = int(endpoint.rsplit(':', 1)[1].rstrip('/'))
+            port = throttle_proxy(upstream, args.stream_mbps * 1024 ** 2)
+            endpoint = 'http://127.0.0.1:%d' % port
+
+        config = {'bucket': args.bucket, 'endpoint': endpoint,
+                  'region': 'us-east-1'}
+        s3 = s3_transfer.client(endpoint, 'us-east-1')
+        try:
+            s3.create_bucket(Bucket=args.bucket)
+        except s3.exceptions.BucketAlreadyOwnedByYou:
+            pass
+
+        size = args.size_mb * 1024 ** 2
+        for concurrency in map(int, args.concurrency.split(',')):
+            config['concurrency'] = concurrency
+            put_time, get_time = measure(config, size)
+            print("%2d parts at a time: put %7.1f MiB/s  get %7.1f MiB/s" %
+                  (concurrency, args.size_mb / put_time,
+                   args.size_mb / get_time))
+    finally:
+        if proc is not None:
+            proc.kill()
+
+
+if __name__ == '__main__':
+    main()
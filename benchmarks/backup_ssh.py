@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+Compares SSH backup storage the way it used to work, a new SSH session
+and a temp file per archive, with SSHBackupStorage, which streams over
+pooled sessions. Measures the latency of small archives and the
+throughput of a large one in both directions.
+
+Runs against an SFTP server of its own on localhost unless --host is
+given, e.g. --host user@localhost --identity ~/.ssh/id_rsa for sshd.
+
+    python3 benchmarks/backup_ssh.py [--host HOST] [--size-mb 256]
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import sys
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import paramiko
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import backup_storage
+import sftp_pool
+from backup_put import SyntheticStream
+
+SMALL_SIZE = 64 * 1024
+PASSWORD = 'benchmark'
+
+
+class Server(paramiko.ServerInterface):
+    def check_auth_password(self, username, password):
+        if password == PASSWORD:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+class SFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+class SFTPServer(paramiko.SFTPServerInterface):
+    """
+    Serves the local filesystem, enough of SFTP for the storage
+    """
+    def canonicalize(self, path):
+        return os.path.normpath(os.path.join('/', path))
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(path, flags, 0o644)
+        except OSError as ex:
+            return paramiko.SFTPServer.convert_errno(ex.errno)
+
+        handle = SFTPHandle(flags)
+        mode = 'wb' if flags & (os.O_WRONLY | os.O_RDWR) else 'rb'
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError as ex:
+            return paramiko.SFTPServer.convert_errno(ex.errno)
+
+    lstat = stat
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as ex:
+            return paramiko.SFTPServer.convert_errno(ex.errno)
+        return paramiko.SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        try:
+            os.rename(oldpath, newpath)
+        except OSError as ex:
+            return paramiko.SFTPServer.convert_errno(ex.errno)
+        return paramiko.SFTP_OK
+
+
+def serve(port):
+    """
+    Runs an SFTP server until killed, one thread per connection
+    """
+    host_key = paramiko.RSAKey.generate(2048)
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', port))
+    listener.listen(100)
+
+    def handle(conn):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(host_key)
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer,
+                                        SFTPServer)
+        transport.start_server(server=Server())
+        transport.join()
+
+    while True:
+        conn, _ = listener.accept()
+        threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+
+class SessionPerArchive(object):
+    """
+    What SSHBackupStorage did before sessions were pooled: connect for
+    each archive and go through a local temp file both ways
+    """
+    def __init__(self, storage):
+        self.storage = storage
+
+    def connect(self):
+        pool = self.storage.pool
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(pool.host, port=pool.port, username=pool.user,
+                       password=pool.password, key_filename=pool.identity)
+        return sftp_pool.Session(client)
+
+    def put_archive(self, stream, compress=True):
+        with tempfile.TemporaryFile() as tmp_file:
+            digest, size = backup_storage.write_archive(stream, tmp_file,
+                                                        compress)
+            tmp_file.seek(0)
+            session = self.connect()
+            try:
+                session.sftp.putfo(tmp_file, self.storage.remote_path(
+                    digest + '.tar.gz'))
+            finally:
+                session.close()
+        return digest, size
+
+    def get_archive(self, digest, decompress=True):
+        tmp_file = tempfile.TemporaryFile()
+        session = self.connect()
+        try:
+            session.sftp.getfo(self.storage.remote_path(digest + '.tar.gz'),
+                               tmp_file)
+        finally:
+            session.close()
+        tmp_file.seek(0)
+        return tmp_file
+
+
+def read_all(fobj):
+    try:
+        for _ in iter(lambda: fobj.read(backup_storage.CHUNK_SIZE), b""):
+            pass
+    finally:
+        fobj.close()
+
+
+def measure(storage, count, size):
+    """
+    returns seconds per put and per get of 'count' archives of 'size'.
+    Archives are stored as they are, so that only the transfer is timed.
+    """
+    digests = []
+    started = time.time()
+    for _ in range(count):
+        digest, _ = storage.put_archive(SyntheticStream(size),
+                                        compress=False)
+        digests.append(digest)
+    put_time = (time.time() - started) / count
+
+    started = time.time()
+    for digest in digests:
+        read_all(storage.get_archive(digest, decompress=False))
+    get_time = (time.time() - started) / count
+
+    return put_time, get_time
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host')
+    parser.add_argument('--identity')
+    parser.add_argument('--base-dir')
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--count', type=int, default=50)
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve)
+        return
+
+    proc = None
+    base_dir = args.base_dir or tempfile.mkdtemp()
+    try:
+        config = {'base_dir': base_dir, 'host': args.host,
+                  'identity': args.identity}
+        if not args.host:
+            port = free_port()
+            proc = subprocess.Popen([sys.executable, __file__,
+                                     '--serve', str(port)])
+            # The server makes up a new host key every run
+            config.update(host='benchmark@127.0.0.1:%d' % port,
+                          password=PASSWORD, host_key_policy='accept')
+            time.sleep(1)
+
+        storage = backup_storage.create('ssh', config)
+
+        for name, impl in (('session per archive', SessionPerArchive(storage)),
+                           ('pooled, streamed', storage)):
+            put_time, get_time = measure(impl, args.count, SMALL_SIZE)
+            print("%-20s %d KiB archives: put %6.1f ms  get %6.1f ms" %
+                  (name, SMALL_SIZE // 1024, put_time * 1000, get_time * 1000))
+
+            size = args.size_mb * 1024 ** 2
+            put_time, get_time = measure(impl, 1, size)
+            print("%-20s %d MiB archive:  put %6.1f MiB/s  get %6.1f MiB/s" %
+                  (name, args.size_mb, args.size_mb / put_time,
+                   args.size_mb / get_time))
+
+        storage.pool.close()
+    finally:
+        if proc is not None:
+            proc.kill()
+        if not args.base_dir:
+            shutil.rmtree(base_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import random
+import offload
+
+# Chunks are cut between these sizes, about 192 KiB apart on average
+MIN_SIZE = 128 * 1024
+MAX_SIZE = 4 * 1024 ** 2
+
+READ_SIZE = 1024 ** 2
+# Cuts are looked for in this much data at a time
+SCAN_SIZE = 4 * MAX_SIZE
+
+# Whether to cut after a byte depends on the WINDOW bytes up to it. Each
+# byte of the window is mapped through its own random permutation and
+# the results are XORed together, once for each of two sets of tables.
+# A cut is made where both come out as zero, 1 in 65536 positions on
+# average whatever the data looks like. Byte-wise table lookups and
+# XORs of whole buffers as big integers keep this at C speed.
+WINDOW = 8
+
+
+def make_tables(rnd):
+    tables = []
+    for _ in range(WINDOW):
+        table = list(range(256))
+        rnd.shuffle(table)
+        tables.append(bytes(table))
+    return tables
+
+
+# Fixed seed: cuts must be the same in every process and on every run
+_RANDOM = random.Random(0x7a7a)
+TABLES = (make_tables(_RANDOM), make_tables(_RANDOM))
+
+
+def window_hash(data, tables):
+    result = 0
+    for shift, table in enumerate(tables):
+        result ^= int.from_bytes(data.translate(table), 'little') << \
+            (8 * shift)
+    return result
+
+
+def find_cuts(data, final):
+    """
+    returns the ends of the chunks that 'data' splits into. The data
+    after the last one is left for the next call, unless 'final' is set.
+
+    Whether a position is a cut only depends on the bytes just before
+    it, so inserting or removing data only changes the chunks around
+    the edit. The chunks after it line up again and deduplicate.
+    """
+    combined = window_hash(data, TABLES[0]) | window_hash(data, TABLES[1])
+    hashes = combined.to_bytes(len(data) + WINDOW, 'little')
+
+    cuts = []
+    start = 0
+    while start < len(data):
+        end = min(start + MAX_SIZE, len(data))
+        pos = hashes.find(b'\0', start + MIN_SIZE - 1, end)
+
+        if pos >= 0:
+            start = pos + 1
+        elif end - start == MAX_SIZE or final:
+            start = end
+        else:
+            break
+
+        cuts.append(start)
+
+    return cuts
+
+
+def chunks(stream, read_size=READ_SIZE):
+    """
+    splits a stream into content-defined chunks, yielding their data
+    """
+    buffer = bytearray()
+    eof = False
+
+    while True:
+        while not eof and len(buffer) < SCAN_SIZE:
+            data = stream.read(read_size)
+            if not data:
+                eof = True
+            buffer += data
+
+        if not buffer:
+            return
+
+        # Hashing whole buffers is heavy, it runs off the hub
+        start = 0
+        for cut in offload.call(find_cuts, buffer, eof):
+            yield bytes(buffer[start:cut])
+            start = cut
+        del buffer[:start]
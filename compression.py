@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+import gzip
+import zlib
+import struct
+import collections
+import offload
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+CODECS = (GZIP, ZSTD)
+
+DEFAULT_LEVELS = {GZIP: 6, ZSTD: 3}
+
+# Input is compressed in blocks of this size, like pigz does
+BLOCK_SIZE = 1024 ** 2
+# Each block is primed with this much of the previous one
+DICT_SIZE = 32 * 1024
+
+# Errors raised on corrupt compressed data
+DECOMPRESSION_ERRORS = (zlib.error, EOFError, OSError)
+if zstandard is not None:
+    DECOMPRESSION_ERRORS += (zstandard.ZstdError,)
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def check_codec(codec):
+    if codec not in CODECS:
+        raise RuntimeError("Unknown compression codec: '%s'" % codec)
+
+    if codec == ZSTD and zstandard is None:
+        raise RuntimeError("zstd compression needs the 'zstandard' module")
+
+
+def detect(header):
+    """
+    returns the codec of compressed data by its first bytes, or None
+    """
+    if header.startswith(GZIP_MAGIC):
+        return GZIP
+    if header.startswith(ZSTD_MAGIC):
+        return ZSTD
+    return None
+
+
+def compress_block(data, level, zdict, last):
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                      zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    result = compressor.compress(data)
+    # A sync flush ends the block on a byte boundary, so independently
+    # compressed blocks can be concatenated into one deflate stream
+    result += compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return result
+
+
+def compress_frame(data, codec=GZIP, level=None):
+    """
+    returns 'data' compressed into a standalone gzip member or zstd
+    frame. Frames of the same codec concatenate into a valid stream.
+    """
+    check_codec(codec)
+    if level is None:
+        level = DEFAULT_LEVELS[codec]
+
+    if codec == ZSTD:
+        compressor = zstandard.ZstdCompressor(level=level, write_checksum=True)
+        return compressor.compress(data)
+
+    # Unlike gzip.compress(), zlib writes no timestamp into the header,
+    # so the same data always compresses to the same bytes
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompressobj(codec):
+    """
+    returns an incremental decompressor of a single member or frame
+    """
+    check_codec(codec)
+    if codec == ZSTD:
+        return zstandard.ZstdDecompressor().decompressobj()
+
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def decompress_frame(data, codec):
+    decompressor = decompressobj(codec)
+    result = decompressor.decompress(data)
+    if not decompressor.eof or decompressor.unused_data:
+        raise EOFError("Compressed frame is truncated or has trailing data")
+    return result
+
+
+class ParallelGzipWriter(object):
+    """
+    Compresses into a single-member gzip stream with blocks compressed in
+    parallel, in the style of pigz. Each block is primed with the tail
+    of the previous one, so the ratio is close to that of plain gzip.
+    The output only depends on the input, level and block size.
+    """
+    def __init__(self, fobj, level=DEFAULT_LEVELS[GZIP], threads=None,
+                 block_size=BLOCK_SIZE):
+        self.fobj = fobj
+        self.level = level
+        self.block_size = block_size
+        self.max_pending = 2 * (threads or offload.POOL.maxsize)
+
+        self.buffer = bytearray()
+        self.zdict = b''
+        self.crc = 0
+        self.size = 0
+        self.pending = collections.deque()
+        self.closed = False
+
+        # Header with no file name, zero mtime and unknown OS, the same as
+        # gzip.GzipFile writes with mtime=0 and no name
+        self.fobj.write(struct.pack('<2sBBIBB', GZIP_MAGIC, 8, 0, 0, 0, 255))
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.buffer += data
+
+        while len(self.buffer) >= self.block_size:
+            block = bytes(self.buffer[:self.block_size])
+            del self.buffer[:self.block_size]
+            self.submit(block, last=False)
+
+        return len(data)
+
+    def submit(self, block, last):
+        self.pending.append(offload.spawn(compress_block, block, self.level,
+                                          self.zdict, last))
+        self.zdict = block[-DICT_SIZE:]
+
+        while len(self.pending) > (0 if last else self.max_pending):
+            self.fobj.write(self.pending.popleft().get())
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        self.submit(bytes(self.buffer), last=True)
+        self.fobj.write(struct.pack('<II', self.crc & 0xffffffff,
+                                    self.size & 0xffffffff))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Blocks still being compressed are thrown away
+            self.closed = True
+            self.pending.clear()
+
+
+class ZstdWriter(object):
+    """
+    Compresses into a zstd frame. zstd spreads the work over its own
+    threads; the calls into it are offloaded so that they don't block the
+    gevent hub. The output is written from the calling greenlet, so
+    'fobj' may be a socket.
+    """
+    def __init__(self, fobj, level=DEFAULT_LEVELS[ZSTD], threads=None):
+        compressor = zstandard.ZstdCompressor(
+            level=level, threads=threads or offload.POOL.maxsize,
+            write_checksum=True)
+        self.fobj = fobj
+        self.compressor = compressor.compressobj()
+        self.closed = False
+
+    def write(self, data):
+        result = offload.call(self.compressor.compress, data)
+        if result:
+            self.fobj.write(result)
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        self.fobj.write(offload.call(self.compressor.flush))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+
+class GzipReader(gzip.GzipFile):
+    """
+    Reads a gzip stream, multi-block or not, and closes the underlying
+    file when closed
+    """
+    def __init__(self, fobj):
+        super().__init__(fileobj=fobj, mode='rb')
+        self.source = fobj
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self.source.close()
+
+
+class StreamReader(object):
+    """
+    Decompresses a stream that can only be read forward, such as an
+    upload, whatever codec it was compressed with. Concatenated members
+    or frames read as one stream.
+    """
+    def __init__(self, fobj, read_size=BLOCK_SIZE):
+        self.fobj = fobj
+        self.read_size = read_size
+        self.codec = None
+        self.decompressor = None
+        self.unused = b''
+        self.buffer = bytearray()
+        self.eof = False
+
+    def fill(self):
+        chunk = self.unused or self.fobj.read(self.read_size)
+        self.unused = b''
+
+        if not chunk:
+            if self.decompressor is None or not self.decompressor.eof:
+                raise EOFError("Compressed stream is truncated")
+            self.eof = True
+            return
+
+        if self.decompressor is None:
+            self.codec = detect(chunk) or GZIP
+            self.decompressor = decompressobj(self.codec)
+        elif self.decompressor.eof:
+            self.decompressor = decompressobj(self.codec)
+
+        self.buffer += offload.call(self.decompressor.decompress, chunk)
+        self.unused = self.decompressor.unused_data
+
+    def read(self, size=-1):
+        while not self.buffer and not self.eof:
+            self.fill()
+
+        if size is None or size < 0:
+            size = len(self.buffer)
+
+        result = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return result
+
+
+def writer(fobj, codec=GZIP, level=None, threads=None):
+    """
+    returns a file-like object that compresses what is written to it
+    with the given codec into 'fobj'
+    """
+    check_codec(codec)
+    if level is None:
+        level = DEFAULT_LEVELS[codec]
+
+    if codec == ZSTD:
+        return ZstdWriter(fobj, level, threads)
+
+    return ParallelGzipWriter(fobj, level, threads)
+
+
+def reader(fobj):
+    """
+    returns a file-like object that decompresses 'fobj', whatever codec
+    it was compressed with. 'fobj' must support peeking at its start,
+    either by seeking back or via peek().
+    """
+    if hasattr(fobj, 'peek'):
+        header = fobj.peek(len(ZSTD_MAGIC))[:len(ZSTD_MAGIC)]
+    else:
+        header = fobj.read(len(ZSTD_MAGIC))
+        fobj.seek(0)
+
+    if detect(header) == ZSTD:
+        check_codec(ZSTD)
+        return zstandard.ZstdDecompressor().stream_reader(fobj,
+                                                          closefd=True)
+
+    return GzipReader(fobj)
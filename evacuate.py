@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+import time
+import logging
+import gevent.pool
+from gevent.lock import BoundedSemaphore
+import allocate
+import memcached
+import tarantool
+import task
+from sense import Sense
+
+# How many groups are healed at the same time during evacuation
+DEFAULT_CONCURRENCY = 16
+# How many of them may create containers on the same target host
+DEFAULT_HOST_CONCURRENCY = 2
+
+GROUP_TYPES = {'memcached': (memcached.Memcached, memcached.UpdateTask),
+               'tarantool': (tarantool.Tarantool, tarantool.UpdateTask)}
+
+# Seconds it took the most recent evacuation to bring all groups back
+LAST_TIME_TO_RECOVER = None
+
+
+class EvacuateTask(task.Task):
+    task_type = "evacuate_server"
+
+    def __init__(self, docker_host):
+        super().__init__(self.task_type)
+        self.docker_host = docker_host
+        self.groups = {}
+        self.time_to_recover = None
+
+    def get_dict(self, index=None):
+        obj = super().get_dict(index)
+        obj['docker_host'] = self.docker_host
+        obj['groups'] = self.groups
+        obj['time_to_recover'] = self.time_to_recover
+        return obj
+
+
+def find_docker_host(addr):
+    for host in Sense.docker_hosts():
+        if host['addr'] == addr or \
+           host['addr'].split(':')[0] == addr or \
+           host['consul_host'] == addr:
+            return host['addr'].split(':')[0]
+
+    return None
+
+
+def plan(docker_host):
+    """
+    returns a list of new placements for instances allocated to the host:
+    [('<group id>', '<instance num>', '<group type>', '<target host>'), ...]
+
+    Target hosts are picked in one batch, avoiding hosts where other
+    instances of the same group already live.
+    """
+    blueprints = Sense.blueprints()
+    allocations = Sense.allocations()
+
+    instances = []
+    requests = []
+    for group_id, instance_num in Sense.host_instances().get(docker_host, []):
+        if group_id not in blueprints:
+            continue
+
+        blueprint = blueprints[group_id]
+        anti_affinity = [i['host'].split(':')[0] for num, i in
+                         allocations[group_id]['instances'].items()
+                         if num != instance_num]
+
+        instances.append((group_id, instance_num, blueprint['type']))
+        requests.append((blueprint['memsize'], anti_affinity))
+
+    if not instances:
+        return []
+
+    targets = allocate.allocate_many(requests, exclude=[docker_host])
+
+    return [instance + (target,) for instance, target in
+            zip(instances, targets)]
+
+
+def remove_instance(evacuate_task, docker_host, group_id, instance_num,
+                    group_type):
+    """
+    Removes the container of an instance from the evacuated host, if it
+    is still there
+    """
+    try:
+        group = GROUP_TYPES[group_type][0].get(group_id)
+
+        containers = group.containers['instances']
+        if instance_num in containers and \
+           containers[instance_num]['host'] == docker_host:
+            evacuate_task.log("Removing container '%s_%s' from '%s'",
+                              group_id, instance_num, docker_host)
+            group.remove_container(instance_num)
+    except Exception:
+        # Heal copes with a container that is still there
+        logging.exception("Failed to remove container '%s_%s' from '%s'",
+                          group_id, instance_num, docker_host)
+
+
+def heal_instance(evacuate_task, group_id, instance_num, group_type, target,
+                  semaphore):
+    state = evacuate_task.groups[group_id]
+    group_cls, update_task_cls = GROUP_TYPES[group_type]
+
+    with semaphore:
+        try:
+            evacuate_task.check_cancelled()
+            group = group_cls.get(group_id)
+            heal_task = update_task_cls(group_id)
+
+            evacuate_task.log("Healing '%s_%s' on '%s'",
+                              group_id, instance_num, target)
+            group.heal(heal_task, host=target)
+
+            state['status'] = task.STATUS_SUCCESS
+            evacuate_task.log("Healed group '%s'", group_id)
+        except task.TaskCancelled:
+            # Not a failure of the group, evacuate() marks it cancelled
+            raise
+        except Exception as ex:
+            logging.exception("Failed to evacuate group '%s'", group_id)
+            state['status'] = task.STATUS_CRITICAL
+            state['message'] = str(ex)
+            evacuate_task.log("Failed to heal group '%s': %s",
+                              group_id, str(ex))
+
+
+def evacuate(evacuate_task, docker_host,
+             concurrency=DEFAULT_CONCURRENCY,
+             host_concurrency=DEFAULT_HOST_CONCURRENCY):
+    global LAST_TIME_TO_RECOVER
+
+    started = time.time()
+
+    try:
+        evacuate_task.log("Evacuating instances from '%s'", docker_host)
+
+        placements = []
+        for group_id, instance_num, group_type, target in plan(docker_host):
+            evacuate_task.groups[group_id] = {'instance_num': instance_num,
+                                              'host': target,
+                                              'status': task.STATUS_RUNNING,
+                                              'message': ''}
+
+            if group_type not in GROUP_TYPES:
+                state = evacuate_task.groups[group_id]
+                state['status'] = task.STATUS_WARNING
+                state['message'] = \
+                    "Groups of type '%s' can't be healed" % group_type
+                evacuate_task.log("Skipping group '%s': %s", group_id,
+                                  state['message'])
+                continue
+
+            placements.append((group_id, instance_num, group_type, target))
+
+        if not evacuate_task.groups:
+            evacuate_task.log("No instances allocated to '%s'", docker_host)
+        else:
+            evacuate_task.log("Moving %d instances", len(placements))
+
+        pool = gevent.pool.Pool(concurrency)
+        try:
+            # Old containers go first, so that one refresh shows every
+            # group short of an instance
+            for group_id, instance_num, group_type, _ in placements:
+                pool.spawn(remove_instance, evacuate_task, docker_host,
+                           group_id, instance_num, group_type)
+            pool.join()
+            Sense.update()
+
+            semaphores = {}
+            for group_id, instance_num, group_type, target in placements:
+                # Heals that haven't started yet are dropped on cancel
+                evacuate_task.check_cancelled()
+
+                if target not in semaphores:
+                    semaphores[target] = BoundedSemaphore(host_concurrency)
+
+                pool.spawn(heal_instance, evacuate_task, group_id,
+                           instance_num, group_type, target,
+                           semaphores[target])
+
+            pool.join(raise_error=True)
+        finally:
+            pool.kill()
+        Sense.update()
+
+        evacuate_task.time_to_recover = time.time() - started
+        LAST_TIME_TO_RECOVER = evacuate_task.time_to_recover
+
+        failed = [group_id for group_id, state in evacuate_task.groups.items()
+                  if state['status'] != task.STATUS_SUCCESS]
+
+        evacuate_task.log("Evacuation of '%s' completed in %.1f seconds",
+                          docker_host, evacuate_task.time_to_recover)
+
+        if failed:
+            evacuate_task.set_status(
+                task.STATUS_WARNING,
+                "Failed to heal %d groups: %s" % (len(failed),
+                                                  ', '.join(failed)))
+        else:
+            evacuate_task.set_status(task.STATUS_SUCCESS)
+    except task.TaskCancelled:
+        for state in evacuate_task.groups.values():
+            if state['status'] == task.STATUS_RUNNING:
+                state['status'] = task.STATUS_WARNING
+                state['message'] = "Evacuation cancelled"
+
+        evacuate_task.log("Evacuation of '%s' cancelled", docker_host)
+        raise
+    except Exception as ex:
+        logging.exception("Failed to evacuate '%s'", docker_host)
+        evacuate_task.set_status(task.STATUS_CRITICAL, str(ex))
+
+        raise
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+import os
+import ssl
+import errno
+import gevent.socket
+from gevent.pywsgi import WSGIHandler
+
+CHUNK_SIZE = 1024 ** 2
+# Largest piece handed to one sendfile() call
+SENDFILE_SIZE = 16 * 1024 ** 2
+
+
+class FileRange(object):
+    """
+    WSGI response body made of 'length' bytes of a file starting at
+    'offset'. SendfileHandler sends it with os.sendfile(), so the data
+    goes from the page cache to the socket without passing through
+    Python. Other servers iterate it in chunks.
+    """
+    def __init__(self, fobj, offset, length):
+        self.fobj = fobj
+        self.offset = offset
+        self.length = length
+
+    def __iter__(self):
+        self.fobj.seek(self.offset)
+        remaining = self.length
+
+        while remaining > 0:
+            chunk = self.fobj.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                return
+            remaining -= len(chunk)
+            yield chunk
+
+    def sendfile(self, sock):
+        """
+        sends the range to a socket, returns the number of bytes sent
+        """
+        offset = self.offset
+        end = self.offset + self.length
+
+        while offset < end:
+            try:
+                sent = os.sendfile(sock.fileno(), self.fobj.fileno(), offset,
+                                   min(SENDFILE_SIZE, end - offset))
+            except OSError as ex:
+                if ex.errno != errno.EAGAIN:
+                    raise
+                gevent.socket.wait_write(sock.fileno())
+                continue
+
+            if sent == 0:
+                break
+            offset += sent
+
+        return offset - self.offset
+
+    def close(self):
+        self.fobj.close()
+
+
+class SendfileHandler(WSGIHandler):
+    """
+    gevent WSGI handler that sends FileRange bodies with os.sendfile().
+    TLS connections can't use it and fall back to the usual iteration.
+    """
+    def process_result(self):
+        if not isinstance(self.result, FileRange) or \
+           isinstance(self.socket, ssl.SSLSocket):
+            return super().process_result()
+
+        # Writing nothing sends the status line and headers
+        self.write(b'')
+        self.response_length += self.result.sendfile(self.socket)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+import re
+
+CHUNK_SIZE = 1024 ** 2
+# Part headers longer than this are rejected
+MAX_HEADER_SIZE = 64 * 1024
+
+
+class FormError(ValueError):
+    pass
+
+
+class Part(object):
+    """
+    One part of a multipart/form-data body. Its data is read from the
+    request body as the part is read.
+    """
+    def __init__(self, reader, headers):
+        self.reader = reader
+        self.headers = headers
+        self.done = False
+
+        disposition = headers.get('content-disposition', '')
+        self.name = disposition_param(disposition, 'name')
+        self.filename = disposition_param(disposition, 'filename')
+
+    def read(self, size=-1):
+        if self.done:
+            return b''
+
+        chunk, self.done = self.reader.read_part(size)
+        return chunk
+
+    def read_value(self, limit=MAX_HEADER_SIZE):
+        """
+        returns the whole data of a small part, such as a form field
+        """
+        value = b''
+        while True:
+            chunk = self.read(CHUNK_SIZE)
+            if not chunk:
+                return value
+
+            value += chunk
+            if len(value) > limit:
+                raise FormError("Form field '%s' is too long" % self.name)
+
+    def drain(self):
+        while self.read(CHUNK_SIZE):
+            pass
+
+
+def disposition_param(disposition, name):
+    match = re.search(r';\s*%s="((?:[^"\\]|\\.)*)"' % name, disposition)
+    if match is None:
+        return None
+    return re.sub(r'\\(.)', r'\1', match.group(1))
+
+
+class MultipartReader(object):
+    """
+    Reads a multipart/form-data body part by part straight from the
+    request stream, so file parts can be consumed without spooling them
+    to a temporary file first. Parts must be read in order: asking for
+    the next part skips what is left of the current one.
+    """
+    def __init__(self, stream, boundary, chunk_size=CHUNK_SIZE):
+        if not boundary:
+            raise FormError("No multipart boundary")
+
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.delimiter = b'\r\n--' + boundary.encode('latin-1')
+        # The first delimiter isn't preceded by a line break
+        self.buffer = bytearray(b'\r\n')
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            return False
+
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+
+        self.buffer += chunk
+        return True
+
+    def read_until(self, marker, limit):
+        while True:
+            pos = self.buffer.find(marker)
+            if pos >= 0:
+                result = bytes(self.buffer[:pos])
+                del self.buffer[:pos + len(marker)]
+                return result
+
+            if len(self.buffer) > limit:
+                raise FormError("Multipart header is too long")
+
+            if not self.fill():
+                raise FormError("Unexpected end of multipart body")
+
+    def read_part(self, size):
+        """
+        returns up to 'size' bytes of the current part and whether the
+        part has ended
+        """
+        if size is None or size < 0:
+            size = self.chunk_size
+
+        while True:
+            pos = self.buffer.find(self.delimiter)
+            if pos >= 0:
+                length = min(pos, size)
+                chunk = bytes(self.buffer[:length])
+                del self.buffer[:length]
+                return chunk, pos == 0
+
+            # A delimiter may start at the end of the buffer, so keep
+            # enough bytes to recognise it when more data arrives
+            safe = len(self.buffer) - len(self.delimiter) + 1
+            if safe >= size or (safe > 0 and self.eof):
+                chunk = bytes(self.buffer[:min(safe, size)])
+                del self.buffer[:len(chunk)]
+                return chunk, False
+
+            if not self.fill():
+                raise FormError("Unexpected end of multipart body")
+
+    def parts(self):
+        # Skip the preamble
+        self.read_until(self.delimiter, float('inf'))
+
+        while True:
+            while len(self.buffer) < 2 and self.fill():
+                pass
+
+            if self.buffer[:2] == b'--':
+                return
+            if self.buffer[:2] != b'\r\n':
+                raise FormError("Malformed multipart delimiter")
+            del self.buffer[:2]
+
+            headers = {}
+            for line in self.read_until(b'\r\n\r\n', MAX_HEADER_SIZE) \
+                    .decode('utf-8').split('\r\n'):
+                if ':' in line:
+                    key, value = line.split(':', 1)
+                    headers[key.strip().lower()] = value.strip()
+
+            part = Part(self, headers)
+            yield part
+
+            part.drain()
+            # Drop the delimiter that ended the part
+            del self.buffer[:len(self.delimiter)]
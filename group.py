@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import consul
+import logging
 import global_env
 from sense import Sense
 
@@ -56,3 +57,29 @@ class Group(object):
             return containers[self.group_id]
         else:
             return {"instances": {}}
+
+    def reallocate_instance(self, instance_num, host):
+        logging.info("Reallocating '%s_%s' to '%s'",
+                     self.group_id, instance_num, host)
+
+        self.consul.kv.put('tarantool/%s/allocation/instances/%s/host' %
+                           (self.group_id, instance_num), host)
+
+    def remove_temp_dir(self, docker_obj, instance_num, path):
+        """
+        Removes a temporary directory inside a container. It runs on
+        failure and cancellation paths, so errors are logged, not raised.
+        """
+        instance_id = self.group_id + '_' + instance_num
+
+        try:
+            exec_id = docker_obj.exec_create(instance_id, "rm -rf '%s'" % path)
+            out = docker_obj.exec_start(exec_id)
+            ret = docker_obj.exec_inspect(exec_id)
+
+            if ret['ExitCode'] != 0:
+                logging.warning("Failed to remove temp dir '%s' of '%s': %s",
+                                path, instance_id, out.decode('utf-8'))
+        except Exception:
+            logging.exception("Failed to remove temp dir '%s' of '%s'",
+                              path, instance_id)
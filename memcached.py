@@ -22,6 +22,9 @@ import gzip
 import io
 import shutil
 
+# How long to wait for a started instance to report that it is up
+INSTANCE_UP_TIMEOUT = 1800  # seconds
+
 class MemcachedTask(task.Task):
     memcached_task_type = None
     def __init__(self, group_id):
@@ -85,6 +88,7 @@ class Memcached(group.Group):
 
             create_task.log("Creating group '%s'", group_id)
 
+            create_task.begin_stage("blueprint")
             ip1 = ip_pool.allocate_ip()
             ip2 = ip_pool.allocate_ip()
             creation_time = datetime.datetime.now(datetime.timezone.utc).isoformat()
@@ -101,21 +105,26 @@ class Memcached(group.Group):
 
             memc = Memcached(global_env.consul_host, group_id)
 
+            create_task.begin_stage("allocate")
             create_task.log("Allocating instance to physical nodes")
 
             memc.allocate()
             Sense.update()
 
+            create_task.begin_stage("register")
             create_task.log("Registering services")
             memc.register()
             Sense.update()
 
+            create_task.begin_stage("create_containers")
             create_task.log("Creating containers")
             memc.create_containers(password)
             Sense.update()
 
+            create_task.begin_stage("wait_for_instances")
             create_task.log("Enabling replication")
             memc.wait_for_instances(create_task)
+            create_task.begin_stage("enable_replication")
             memc.enable_replication()
 
             create_task.log("Completed creating group")
@@ -133,15 +142,19 @@ class Memcached(group.Group):
         try:
             group_id = self.group_id
 
+            delete_task.begin_stage("unallocate")
             delete_task.log("Unallocating instance")
             self.unallocate()
 
+            delete_task.begin_stage("unregister")
             delete_task.log("Unregistering services")
             self.unregister()
 
+            delete_task.begin_stage("remove_containers")
             delete_task.log("Removing containers")
             self.remove_containers()
 
+            delete_task.begin_stage("remove_blueprint")
             delete_task.log("Removing blueprint")
             self.remove_blueprint()
 
@@ -204,7 +217,7 @@ class Memcached(group.Group):
 
             raise
 
-    def heal(self, update_task):
+    def heal(self, update_task, host=None):
         blueprint = self.blueprint
         allocation = self.allocation
         containers = self.containers
@@ -226,16 +239,26 @@ class Memcached(group.Group):
         if password_base64 is not None:
             update_task.log("Will set password for %s", instance_num)
 
+        update_task.begin_stage("heal_unregister")
         update_task.log("Unregistering container %s", instance_num)
         self.unregister_instance(instance_num)
 
+        update_task.begin_stage("heal_disconnect")
         update_task.log("Disconnecting container %s", instance_num)
         self.disconnect_instance(instance_num)
 
+        if host:
+            update_task.begin_stage("heal_reallocate")
+            update_task.log("Moving container %s to '%s'", instance_num, host)
+            self.reallocate_instance(instance_num, host)
+            Sense.update()
+
+        update_task.begin_stage("heal_create_container")
         self.create_container(instance_num, other_instance_num,
                               password=None,
                               password_base64=password_base64)
 
+        update_task.begin_stage("heal_register")
         update_task.log("Registring container %s", instance_num)
         self.register_instance(instance_num)
 
@@ -333,6 +356,7 @@ class Memcached(group.Group):
             docker_obj = docker.Client(base_url=docker_addr,
                                        tls=global_env.docker_tls_config)
 
+            backup_task.begin_stage("list_files")
             cmd = 'ls /var/lib/tarantool'
             exec_id = docker_obj.exec_create(self.group_id + '_' + instance_num,
                                          cmd)
@@ -368,45 +392,43 @@ class Memcached(group.Group):
 
             backup_task.log("Backing up data: %s", ', '.join(files_to_backup))
 
+            backup_task.begin_stage("prepare")
             tmp_backup_dir = '/var/lib/tarantool/backup-' + uuid.uuid4().hex
 
-            cmd = "mkdir '%s'" % tmp_backup_dir
-            exec_id = docker_obj.exec_create(self.group_id + '_' + instance_num,
-                                             cmd)
-            out = docker_obj.exec_start(exec_id)
-            ret = docker_obj.exec_inspect(exec_id)
-
-            if ret['ExitCode'] != 0:
-                raise RuntimeError(
-                    "Failed to create temp backup dir for container " +
-                    instance_id)
-
-            for file_to_backup in files_to_backup:
-                cmd = "ln /var/lib/tarantool/%s %s/%s" % (
-                    file_to_backup, tmp_backup_dir, file_to_backup)
-                exec_id = docker_obj.exec_create(
-                    self.group_id + '_' + instance_num, cmd)
+            try:
+                cmd = "mkdir '%s'" % tmp_backup_dir
+                exec_id = docker_obj.exec_create(self.group_id + '_' + instance_num,
+                                                 cmd)
                 out = docker_obj.exec_start(exec_id)
                 ret = docker_obj.exec_inspect(exec_id)
 
                 if ret['ExitCode'] != 0:
                     raise RuntimeError(
-                        "Failed to hardlink backup file: " + out.decode('utf-8'))
-
-            strm, _ = docker_obj.get_archive(instance_id, tmp_backup_dir+'/.')
-            archive_id, size = storage.put_archive(strm)
-
-            cmd = "rm -rf /var/lib/tarantool/backup-*"
-            exec_id = docker_obj.exec_create(self.group_id + '_' + instance_num,
-                                             cmd)
-            out = docker_obj.exec_start(exec_id)
-            ret = docker_obj.exec_inspect(exec_id)
-
-            if ret['ExitCode'] != 0:
-                raise RuntimeError(
-                    "Failed to remove temp backup dir for container " +
-                    instance_id)
-
+                        "Failed to create temp backup dir for container " +
+                        instance_id)
+
+                for file_to_backup in files_to_backup:
+                    cmd = "ln /var/lib/tarantool/%s %s/%s" % (
+                        file_to_backup, tmp_backup_dir, file_to_backup)
+                    exec_id = docker_obj.exec_create(
+                        self.group_id + '_' + instance_num, cmd)
+                    out = docker_obj.exec_start(exec_id)
+                    ret = docker_obj.exec_inspect(exec_id)
+
+                    if ret['ExitCode'] != 0:
+                        raise RuntimeError(
+                            "Failed to hardlink backup file: " + out.decode('utf-8'))
+
+                backup_task.begin_stage("stream_archive")
+                backup_task.check_cancelled()
+                strm, _ = docker_obj.get_archive(instance_id, tmp_backup_dir+'/.')
+                archive_id, size = storage.put_archive(
+                    task.CancellableStream(strm, backup_task))
+            finally:
+                self.remove_temp_dir(docker_obj, instance_num,
+                                     tmp_backup_dir)
+
+            backup_task.begin_stage("register_backup")
             mem_used = services['instances'][instance_num]['mem_used']
             storage.register_backup(backup_id, archive_id, group_id,
                                     'memcached', size, mem_used)
@@ -436,6 +458,7 @@ class Memcached(group.Group):
                 docker_host = allocation['instances'][instance_num]['host']
                 docker_hosts = Sense.docker_hosts()
 
+                restore_task.check_cancelled()
                 restore_task.log("Restoring instance: '%s'", instance_id)
 
                 docker_addr = None
@@ -454,80 +477,84 @@ class Memcached(group.Group):
                     err = ("Backed up instance used {} MiB of RAM, but " +
                            "instance {} only has {} MiB max").format(
                                mem_used, group_id, blueprint['memsize'])
-                    restore_task.set_status(task.STATUS_CRITICAL, err)
-                    return
+                    raise RuntimeError(err)
 
+                restore_task.begin_stage("restore_prepare")
                 tmp_restore_dir = '/var/lib/tarantool/restore-' + uuid.uuid4().hex
 
-                cmd = "mkdir '%s'" % tmp_restore_dir
-                exec_id = docker_obj.exec_create(
-                    self.group_id + '_' + instance_num, cmd)
-                out = docker_obj.exec_start(exec_id)
-                ret = docker_obj.exec_inspect(exec_id)
-
-                if ret['ExitCode'] != 0:
-                    raise RuntimeError(
-                        "Failed to create temp restore dir for container " +
-                        instance_id + ": " + out.decode('utf-8'))
-
-                stream = storage.get_archive(archive_id)
-
-                docker_obj.put_archive(instance_id, tmp_restore_dir, stream)
-
-                cmd = "sh -c 'rm -rf /var/lib/tarantool/*.snap'"
-                exec_id = docker_obj.exec_create(
-                    self.group_id + '_' + instance_num, cmd)
-                out = docker_obj.exec_start(exec_id)
-                ret = docker_obj.exec_inspect(exec_id)
-
-                if ret['ExitCode'] != 0:
-                    raise RuntimeError(
-                        "Failed to remove existing snap files of " +
-                        instance_id + ": " + out.decode('utf-8'))
-
-                cmd = "sh -c 'rm -rf /var/lib/tarantool/*.xlog'"
-                exec_id = docker_obj.exec_create(
-                    self.group_id + '_' + instance_num, cmd)
-                out = docker_obj.exec_start(exec_id)
-                ret = docker_obj.exec_inspect(exec_id)
-
-                if ret['ExitCode'] != 0:
-                    raise RuntimeError(
-                        "Failed to remove existing xlog files of " +
-                        instance_id + ": " + out.decode('utf-8'))
-
-                cmd = "sh -c 'mv %s/* /var/lib/tarantool'" % tmp_restore_dir
-                exec_id = docker_obj.exec_create(
-                    self.group_id + '_' + instance_num, cmd)
-                out = docker_obj.exec_start(exec_id)
-                ret = docker_obj.exec_inspect(exec_id)
-
-                if ret['ExitCode'] != 0:
-                    raise RuntimeError(
-                        "Failed to restore files of" +
-                        instance_id + ": " + out.decode('utf-8'))
-
-                cmd = "rm -rf '%s'" % tmp_restore_dir
-                exec_id = docker_obj.exec_create(
-                    self.group_id + '_' + instance_num, cmd)
-                out = docker_obj.exec_start(exec_id)
-                ret = docker_obj.exec_inspect(exec_id)
-
-                if ret['ExitCode'] != 0:
-                    raise RuntimeError(
-                        "Failed to remove tmp restore dir of " +
-                        instance_id + ": " + out.decode('utf-8'))
-
-
+                try:
+                    cmd = "mkdir '%s'" % tmp_restore_dir
+                    exec_id = docker_obj.exec_create(
+                        self.group_id + '_' + instance_num, cmd)
+                    out = docker_obj.exec_start(exec_id)
+                    ret = docker_obj.exec_inspect(exec_id)
+
+                    if ret['ExitCode'] != 0:
+                        raise RuntimeError(
+                            "Failed to create temp restore dir for container " +
+                            instance_id + ": " + out.decode('utf-8'))
+
+                    restore_task.begin_stage("restore_stream_archive")
+                    stream = task.CancellableStream(
+                        storage.get_archive(archive_id), restore_task)
+                    try:
+                        docker_obj.put_archive(instance_id, tmp_restore_dir, stream)
+                    finally:
+                        stream.close()
+
+                    restore_task.begin_stage("restore_replace_files")
+                    cmd = "sh -c 'rm -rf /var/lib/tarantool/*.snap'"
+                    exec_id = docker_obj.exec_create(
+                        self.group_id + '_' + instance_num, cmd)
+                    out = docker_obj.exec_start(exec_id)
+                    ret = docker_obj.exec_inspect(exec_id)
+
+                    if ret['ExitCode'] != 0:
+                        raise RuntimeError(
+                            "Failed to remove existing snap files of " +
+                            instance_id + ": " + out.decode('utf-8'))
+
+                    cmd = "sh -c 'rm -rf /var/lib/tarantool/*.xlog'"
+                    exec_id = docker_obj.exec_create(
+                        self.group_id + '_' + instance_num, cmd)
+                    out = docker_obj.exec_start(exec_id)
+                    ret = docker_obj.exec_inspect(exec_id)
+
+                    if ret['ExitCode'] != 0:
+                        raise RuntimeError(
+                            "Failed to remove existing xlog files of " +
+                            instance_id + ": " + out.decode('utf-8'))
+
+                    cmd = "sh -c 'mv %s/* /var/lib/tarantool'" % tmp_restore_dir
+                    exec_id = docker_obj.exec_create(
+                        self.group_id + '_' + instance_num, cmd)
+                    out = docker_obj.exec_start(exec_id)
+                    ret = docker_obj.exec_inspect(exec_id)
+
+                    if ret['ExitCode'] != 0:
+                        raise RuntimeError(
+                            "Failed to restore files of" +
+                            instance_id + ": " + out.decode('utf-8'))
+                finally:
+                    self.remove_temp_dir(docker_obj, instance_num,
+                                         tmp_restore_dir)
+
+
+                restore_task.begin_stage("restart")
                 restore_task.log("Restarting instance: '%s'", instance_id)
                 docker_obj.restart(container=instance_id)
 
+            restore_task.begin_stage("wait_for_instances")
             restore_task.log("Enabling replication")
             self.wait_for_instances(restore_task)
+            restore_task.begin_stage("enable_replication")
             self.enable_replication()
-        except Exception as ex:
+
+            restore_task.log("Completed restoring group")
+        except Exception:
+            # Restore runs as a step of update(), which sets the status
             logging.exception("Failed to restore backup '%s'", group_id)
-            restore_task.set_status(task.STATUS_CRITICAL, str(ex))
+            raise
 
 
     def create_containers(self, password):
@@ -579,6 +606,7 @@ class Memcached(group.Group):
 
             cmd = "tarantool_is_up"
             attempts = 0
+            started = time.time()
             while True:
                 exec_id = docker_obj.exec_create(instance_id,
                                                  cmd)
@@ -586,16 +614,22 @@ class Memcached(group.Group):
 
                 for line in stream:
                     logging.info("Exec: %s", str(line))
+                    wait_task.check_cancelled()
 
                 ret = docker_obj.exec_inspect(exec_id)
 
                 if ret['ExitCode'] == 0:
                     break
 
+                if time.time() - started > INSTANCE_UP_TIMEOUT:
+                    raise RuntimeError(
+                        "Instance '%s' didn't go up in %d seconds" %
+                        (instance_id, INSTANCE_UP_TIMEOUT))
+
                 wait_task.log("Waiting for '%s' to go up. Attempt %d.",
                               instance_id, attempts)
 
-                time.sleep(1)
+                wait_task.sleep(1)
                 attempts += 1
 
 
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+import bisect
+import collections
+import urllib.parse
+import consul
+import docker
+from gevent.lock import RLock
+
+# Upper bounds of histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 120, 300, 600, 1800)
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                0.05, 0.1, 0.25, 0.5, 1)
+
+REGISTRY = []
+
+
+class Histogram(object):
+    """
+    Distribution of observed values in cumulative buckets, labeled the
+    same way as Prometheus histograms.
+    """
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+        # label values -> [per-bucket counts..., +Inf count], sum
+        self.counts = collections.OrderedDict()
+        self.sums = {}
+        self.lock = RLock()
+
+        REGISTRY.append(self)
+
+    def observe(self, value, *labelvalues):
+        labelvalues = tuple(str(v) for v in labelvalues)
+
+        with self.lock:
+            if labelvalues not in self.counts:
+                self.counts[labelvalues] = [0] * (len(self.buckets) + 1)
+                self.sums[labelvalues] = 0.0
+
+            self.counts[labelvalues][
+                bisect.bisect_left(self.buckets, value)] += 1
+            self.sums[labelvalues] += value
+
+    def samples(self):
+        """
+        returns (<suffix>, <labels dict>, <value>) tuples
+        """
+        result = []
+
+        with self.lock:
+            for labelvalues, counts in self.counts.items():
+                labels = dict(zip(self.labelnames, labelvalues))
+
+                total = 0
+                bounds = [str(b) for b in self.buckets] + ['+Inf']
+                for bound, count in zip(bounds, counts):
+                    total += count
+                    result.append(('_bucket', dict(labels, le=bound), total))
+
+                result.append(('_sum', labels, self.sums[labelvalues]))
+                result.append(('_count', labels, total))
+
+        return result
+
+
+class Gauge(object):
+    """
+    A value computed when metrics are collected. 'func' returns either a
+    number or, for labeled gauges, a dict of label values -> number.
+    """
+    metric_type = 'gauge'
+
+    def __init__(self, name, documentation, func, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+        self.labelnames = tuple(labelnames)
+
+        REGISTRY.append(self)
+
+    def samples(self):
+        values = self.func()
+
+        if values is None:
+            return []
+
+        if not self.labelnames:
+            return [('', {}, values)]
+
+        return [('', dict(zip(self.labelnames, labelvalues)), value)
+                for labelvalues, value in values.items()]
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+def render():
+    """
+    returns all registered metrics in Prometheus text exposition format
+    """
+    lines = []
+
+    for metric in REGISTRY:
+        lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+        lines.append('# TYPE %s %s' % (metric.name, metric.metric_type))
+
+        for suffix, labels, value in metric.samples():
+            if labels:
+                label_str = '{%s}' % ','.join(
+                    '%s="%s"' % (k, escape_label(v))
+                    for k, v in sorted(labels.items()))
+            else:
+                label_str = ''
+
+            if isinstance(value, int):
+                value_str = str(value)
+            else:
+                value_str = repr(float(value))
+
+            lines.append('%s%s%s %s' % (metric.name, suffix, label_str,
+                                        value_str))
+
+    return '\n'.join(lines) + '\n'
+
+
+def response_hook(histogram):
+    def hook(response, *args, **kwargs):
+        host = urllib.parse.urlparse(response.url).netloc
+        histogram.observe(response.elapsed.total_seconds(), host)
+
+    return hook
+
+
+class InstrumentedDockerClient(docker.Client):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.hooks['response'].append(response_hook(DOCKER_REQUEST_SECONDS))
+
+
+class InstrumentedConsul(consul.Consul):
+    def connect(self, *args, **kwargs):
+        client = super().connect(*args, **kwargs)
+        client.session.hooks['response'].append(
+            response_hook(CONSUL_REQUEST_SECONDS))
+        return client
+
+
+def instrument_clients():
+    """
+    Makes every Docker and Consul client created from now on report
+    request latency. Modules look up docker.Client and consul.Consul
+    when they create clients, so replacing them is enough.
+    """
+    docker.Client = InstrumentedDockerClient
+    consul.Consul = InstrumentedConsul
+
+
+TASK_STAGE_SECONDS = Histogram(
+    'im_task_stage_seconds',
+    'Time spent in each stage of lifecycle tasks',
+    ('task_type', 'stage'))
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'im_http_request_seconds',
+    'Time to handle API and UI requests, until the response starts',
+    ('resource', 'method', 'status'))
+
+SENSE_UPDATE_SECONDS = Histogram(
+    'im_sense_update_seconds',
+    'Time to refresh the snapshot of Consul and Docker state')
+
+DOCKER_REQUEST_SECONDS = Histogram(
+    'im_docker_request_seconds',
+    'Latency of Docker API requests, until response headers',
+    ('host',), buckets=FAST_BUCKETS + DEFAULT_BUCKETS[-9:])
+
+CONSUL_REQUEST_SECONDS = Histogram(
+    'im_consul_request_seconds',
+    'Latency of Consul API requests, until response headers',
+    ('host',), buckets=FAST_BUCKETS + DEFAULT_BUCKETS[-9:])
+
+ALLOCATE_SECONDS = Histogram(
+    'im_allocate_seconds',
+    'Time the allocator takes to place a batch of instances',
+    buckets=FAST_BUCKETS)
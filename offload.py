@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+import os
+import contextvars
+import gevent.threadpool
+
+# Hashing, compression, tar packing and serialization of large responses
+# are handed to native threads so the gevent hub keeps serving requests
+# while they run. zlib, zstd and hashlib release the GIL for large
+# buffers; pure Python code, such as yaml or tarfile, gives it back to
+# the hub every sys.getswitchinterval().
+POOL = gevent.threadpool.ThreadPool(os.cpu_count() or 1)
+
+# Hashing less than this is cheaper than handing it over to a thread
+MIN_SIZE = 64 * 1024
+
+
+def call(func, *args, **kwargs):
+    """
+    runs 'func' in the pool and returns its result, blocking only the
+    calling greenlet. Context variables of the caller are visible to it.
+    Nothing it does may touch gevent objects such as sockets.
+    """
+    context = contextvars.copy_context()
+    return POOL.apply(context.run, (func,) + args, kwargs)
+
+
+def spawn(func, *args, **kwargs):
+    """
+    starts 'func' in the pool, returns an AsyncResult to get() it from
+    """
+    context = contextvars.copy_context()
+    return POOL.spawn(context.run, func, *args, **kwargs)
+
+
+def update_hash(hash_obj, data):
+    if len(data) < MIN_SIZE:
+        hash_obj.update(data)
+    else:
+        POOL.apply(hash_obj.update, (data,))
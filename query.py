@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import bisect
+import collections
+
+
+class Index(object):
+    """
+    Secondary indexes over a listing of entries (a dict of id -> entry)
+    used to filter and page through it without scanning every entry.
+
+    'keys' maps index names to functions returning the list of values an
+    entry is indexed under, e.g. all docker hosts of a group. 'ordered'
+    maps index names to functions returning one sortable value, which
+    can then be looked up by prefix or range. Entries are paged in the
+    order of their ids.
+    """
+    def __init__(self, entries, keys=None, ordered=None):
+        self.entries = entries
+        self.ids = sorted(entries)
+
+        self.keys = {}
+        for name, func in (keys or {}).items():
+            index = collections.defaultdict(set)
+            for entry_id, entry in entries.items():
+                for value in func(entry):
+                    index[value].add(entry_id)
+            self.keys[name] = index
+
+        self.ordered = {}
+        for name, func in (ordered or {}).items():
+            values = [(func(entry), entry_id)
+                      for entry_id, entry in entries.items()]
+            self.ordered[name] = sorted(v for v in values if v[0] is not None)
+
+    def lookup(self, name, value):
+        return self.keys[name].get(value, set())
+
+    def prefix(self, name, prefix):
+        values = self.ordered[name]
+        result = set()
+
+        pos = bisect.bisect_left(values, (prefix,))
+        while pos < len(values) and values[pos][0].startswith(prefix):
+            result.add(values[pos][1])
+            pos += 1
+
+        return result
+
+    def range(self, name, low=None, high=None):
+        """
+        returns ids of entries with low <= value < high
+        """
+        values = self.ordered[name]
+
+        start = 0 if low is None else bisect.bisect_left(values, (low,))
+        end = len(values) if high is None else \
+            bisect.bisect_left(values, (high,))
+
+        return set(entry_id for _, entry_id in values[start:end])
+
+    def select(self, matches=None, cursor=None, limit=None):
+        """
+        Returns a page of ids that come after 'cursor', and the cursor of
+        the next page (None on the last one). 'matches' is the set of ids
+        that pass the filters, or None if there are no filters.
+        """
+        if matches is None:
+            ids = self.ids
+        else:
+            ids = sorted(matches)
+
+        start = 0 if cursor is None else bisect.bisect_right(ids, cursor)
+        end = len(ids) if not limit else min(start + limit, len(ids))
+
+        page = ids[start:end]
+        next_cursor = page[-1] if page and end < len(ids) else None
+
+        return page, next_cursor
+
+
+def intersect(matches):
+    """
+    Intersects id sets of several filters, starting with the smallest.
+    Returns None when no filters are given.
+    """
+    if not matches:
+        return None
+
+    matches = sorted(matches, key=len)
+    result = set(matches[0])
+    for other in matches[1:]:
+        result &= other
+
+    return result
+
+
+def project(entry, fields):
+    """
+    returns only the requested top-level fields of an entry
+    """
+    if not fields:
+        return entry
+
+    return {key: value for key, value in entry.items()
+            if key in fields or key == 'id'}
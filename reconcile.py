@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+
+import time
+import logging
+import itertools
+import datetime
+import gevent.pool
+import gevent.queue
+import allocate
+import memcached
+import tarantino
+import tarantool
+import task
+import scheduler
+from sense import Sense
+
+# Seconds between sweeps when RECONCILE_INTERVAL turns the reconciler on
+DEFAULT_INTERVAL = 30
+DEFAULT_CONCURRENCY = 4  # repairs running at the same time
+DEFAULT_RATE = 10  # repairs started per minute
+
+# Groups younger than this are still being created and are left alone
+GRACE_PERIOD = 300  # seconds
+# A problem has to be seen on this many sweeps in a row to be repaired
+CONFIRM_SWEEPS = 2
+
+BACKOFF_BASE = 60  # seconds
+BACKOFF_MAX = 3600  # seconds
+
+# Groups with no healthy instances are repaired first
+PRIORITY_DOWN = scheduler.PRIORITY_HIGH
+PRIORITY_DEGRADED = scheduler.PRIORITY_NORMAL
+
+MISSING_CONTAINER = 'missing_container'
+UNREGISTERED_SERVICE = 'unregistered_service'
+BROKEN_REPLICATION = 'broken_replication'
+
+GROUP_TYPES = {'memcached': memcached.Memcached,
+               'tarantino': tarantino.Tarantino,
+               'tarantool': tarantool.Tarantool}
+
+
+class RepairTask(task.Task):
+    task_type = "repair_group"
+
+    def __init__(self, group_id, problems):
+        super().__init__(self.task_type)
+        self.group_id = group_id
+        self.problems = problems
+
+    def get_dict(self, index=None):
+        obj = super().get_dict(index)
+        obj['group_id'] = self.group_id
+        obj['problems'] = [{'type': problem, 'instance_num': instance_num}
+                           for problem, instance_num in self.problems]
+        return obj
+
+
+def diagnose(blueprint, allocation, services, containers):
+    """
+    Compares desired and observed state of a group. Returns a list of
+    (<problem>, <instance num>) tuples and the number of healthy instances.
+    """
+    problems = []
+    healthy = 0
+
+    for instance_num in sorted(blueprint['instances']):
+        if instance_num not in allocation['instances']:
+            # Allocation is written before anything else is created, so
+            # a group without it is broken beyond what healing can fix.
+            continue
+
+        service = services['instances'].get(instance_num)
+
+        if instance_num not in containers['instances']:
+            problems.append((MISSING_CONTAINER, instance_num))
+        elif service is None:
+            problems.append((UNREGISTERED_SERVICE, instance_num))
+        elif service['status'] == 'passing':
+            healthy += 1
+        elif blueprint['type'] != 'tarantino' and \
+                service['replication_status'] == 'critical':
+            # Warnings, such as a lagging replica, usually pass on their own
+            problems.append((BROKEN_REPLICATION, instance_num))
+
+    return problems, healthy
+
+
+class Reconciler(object):
+    """
+    Finds groups whose observed state has drifted from their blueprint
+    and repairs them. Repairs are queued by priority and rate limited
+    here, then run as tasks through the scheduler, so its global and per
+    host limits apply and they can be cancelled like any other task.
+    """
+    def __init__(self, tasks, scheduler_obj, interval=DEFAULT_INTERVAL,
+                 concurrency=DEFAULT_CONCURRENCY, rate=DEFAULT_RATE):
+        self.tasks = tasks
+        self.scheduler = scheduler_obj
+        self.interval = interval
+        self.concurrency = concurrency
+        self.rate = rate
+
+        self.queue = gevent.queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.queued = {}
+        self.in_progress = set()
+        self.suspects = {}
+        self.backoff = {}
+
+        self.tokens = rate
+        self.tokens_updated = time.time()
+
+    def busy_groups(self):
+        return set(getattr(t, 'group_id', None)
+                   for t in self.tasks.active_tasks())
+
+    def sweep(self):
+        blueprints = Sense.blueprints()
+        allocations = Sense.allocations()
+        services = Sense.services()
+        containers = Sense.containers()
+
+        now = time.time()
+        young = datetime.datetime.now(datetime.timezone.utc) - \
+            datetime.timedelta(seconds=GRACE_PERIOD)
+        busy = self.busy_groups() | self.in_progress
+        empty = {'instances': {}}
+
+        suspects = {}
+
+        for group_id, blueprint in blueprints.items():
+            if group_id in busy or group_id in self.queued:
+                continue
+
+            if blueprint.get('creation_time', young) > young:
+                continue
+
+            if self.backoff.get(group_id, (0, 0))[1] > now:
+                continue
+
+            problems, healthy = diagnose(blueprint,
+                                         allocations.get(group_id, empty),
+                                         services.get(group_id, empty),
+                                         containers.get(group_id, empty))
+            if not problems:
+                continue
+
+            seen = self.suspects.get(group_id, 0) + 1
+            if seen < CONFIRM_SWEEPS:
+                suspects[group_id] = seen
+                continue
+
+            priority = PRIORITY_DOWN if healthy == 0 else PRIORITY_DEGRADED
+            self.enqueue(group_id, problems, priority)
+
+        self.suspects = suspects
+
+    def enqueue(self, group_id, problems, priority):
+        logging.info("Scheduling repair of group '%s': %s", group_id,
+                     ', '.join('%s (%s)' % p for p in problems))
+
+        self.queued[group_id] = (problems, priority)
+        self.queue.put((priority, next(self.counter), group_id))
+
+    def take_token(self):
+        while True:
+            now = time.time()
+            self.tokens = min(
+                self.rate,
+                self.tokens + (now - self.tokens_updated) * self.rate / 60.0)
+            self.tokens_updated = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            time.sleep((1 - self.tokens) * 60.0 / self.rate)
+
+    def worker(self):
+        while True:
+            _, _, group_id = self.queue.get()
+            problems, priority = self.queued.pop(group_id)
+
+            self.in_progress.add(group_id)
+            try:
+                self.take_token()
+
+                repair_task = RepairTask(group_id, problems)
+                self.tasks[repair_task.task_id] = repair_task
+
+                allocation = Sense.allocations().get(group_id,
+                                                     {'instances': {}})
+                hosts = [i['host'] for i in allocation['instances'].values()]
+
+                self.scheduler.submit(repair_task, self.repair, repair_task,
+                                      hosts=hosts, priority=priority)
+                repair_task.wait_for_completion()
+            except Exception:
+                logging.exception("Failed to schedule repair of group '%s'",
+                                  group_id)
+            finally:
+                self.in_progress.discard(group_id)
+
+    def repair(self, repair_task):
+        group_id = repair_task.group_id
+        problems = repair_task.problems
+
+        try:
+            blueprint = Sense.blueprints().get(group_id)
+            if blueprint is None:
+                repair_task.log("Group '%s' no longer exists", group_id)
+                repair_task.set_status(task.STATUS_SUCCESS)
+                return
+
+            group = GROUP_TYPES[blueprint['type']].get(group_id)
+
+            missing = [num for problem, num in problems
+                       if problem == MISSING_CONTAINER]
+            unregistered = [num for problem, num in problems
+                            if problem == UNREGISTERED_SERVICE]
+            broken = [num for problem, num in problems
+                      if problem == BROKEN_REPLICATION]
+
+            for instance_num in missing:
+                if not hasattr(group, 'heal'):
+                    raise RuntimeError("Groups of type '%s' can't be healed" %
+                                       blueprint['type'])
+
+                repair_task.check_cancelled()
+                repair_task.log("Re-creating container of '%s_%s'",
+                                group_id, instance_num)
+                group.heal(repair_task, host=self.relocation_host(
+                    group, instance_num))
+                Sense.update()
+
+            for instance_num in unregistered:
+                repair_task.check_cancelled()
+                repair_task.log("Registering service '%s_%s'",
+                                group_id, instance_num)
+                if hasattr(group, 'register_instance'):
+                    group.register_instance(instance_num)
+                else:
+                    group.register()
+
+            if broken:
+                repair_task.check_cancelled()
+                repair_task.log("Re-enabling replication of '%s'", group_id)
+                group.enable_replication()
+
+            Sense.update()
+
+            self.backoff.pop(group_id, None)
+            repair_task.log("Completed repairing group '%s'", group_id)
+            repair_task.set_status(task.STATUS_SUCCESS)
+        except task.TaskCancelled:
+            # A cancelled repair isn't tried again right away either
+            self.delay_repair(group_id)
+            raise
+        except Exception as ex:
+            delay = self.delay_repair(group_id)
+
+            logging.exception("Failed to repair group '%s', next attempt " +
+                              "in %d seconds", group_id, delay)
+            repair_task.set_status(task.STATUS_CRITICAL, str(ex))
+
+    def delay_repair(self, group_id):
+        failures = self.backoff.get(group_id, (0, 0))[0] + 1
+        delay = min(BACKOFF_BASE * 2 ** (failures - 1), BACKOFF_MAX)
+        self.backoff[group_id] = (failures, time.time() + delay)
+        return delay
+
+    def relocation_host(self, group, instance_num):
+        """
+        Returns a new host for an instance if its docker host is gone,
+        and None if the container can be re-created where it was.
+        """
+        allocation = group.allocation['instances']
+        host = allocation[instance_num]['host'].split(':')[0]
+
+        healthy = [h for h in Sense.docker_hosts()
+                   if h['status'] == 'passing']
+        if any(h['addr'].split(':')[0] == host or h['consul_host'] == host
+               for h in healthy):
+            return None
+
+        anti_affinity = [i['host'].split(':')[0] for num, i in
+                         allocation.items() if num != instance_num]
+
+        return allocate.allocate(group.blueprint['memsize'],
+                                 anti_affinity=anti_affinity)
+
+    def run(self):
+        pool = gevent.pool.Pool(self.concurrency)
+        for _ in range(self.concurrency):
+            pool.spawn(self.worker)
+
+        while True:
+            try:
+                self.sweep()
+            except Exception:
+                logging.exception("Failed to reconcile groups")
+
+            time.sleep(self.interval)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+import logging
+import collections
+import gevent
+import gevent.pool
+
+try:
+    import boto3
+    import botocore.config
+    import botocore.exceptions
+except ImportError:
+    boto3 = None
+
+# Archives are uploaded and downloaded in parts of this size. S3 needs
+# parts of at least 5 MiB, except for the last one.
+PART_SIZE = 16 * 1024 ** 2
+# Parts transferred at the same time for each archive
+DEFAULT_CONCURRENCY = 8
+# An upload can have at most 10000 parts. Part size doubles every this
+# many parts, so archives of up to about 1 TB fit.
+PARTS_PER_SIZE = 2000
+
+# Objects up to this size are copied in one request
+MAX_COPY_SIZE = 5 * 1024 ** 3
+
+
+def client(endpoint=None, region=None, access_key=None, secret_key=None,
+           concurrency=DEFAULT_CONCURRENCY):
+    """
+    returns an S3 client. Credentials that aren't given are looked up
+    the way the AWS tools do it, in the environment or ~/.aws.
+    """
+    if boto3 is None:
+        raise RuntimeError("S3 backup storage needs the 'boto3' module")
+
+    config = botocore.config.Config(max_pool_connections=concurrency * 2,
+                                    retries={'mode': 'standard'})
+    return boto3.session.Session().client(
+        's3', endpoint_url=endpoint, region_name=region,
+        aws_access_key_id=access_key, aws_secret_access_key=secret_key,
+        config=config)
+
+
+def is_missing(ex):
+    return isinstance(ex, botocore.exceptions.ClientError) and \
+        ex.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound')
+
+
+class MultipartWriter(object):
+    """
+    Uploads what is written to it as an S3 object. Full parts are
+    uploaded in the background, up to 'concurrency' at a time, while
+    the next part is being written. A write blocks when all of them are
+    busy. Objects smaller than a part are put in a single request.
+    """
+    def __init__(self, s3, bucket, key, concurrency=DEFAULT_CONCURRENCY):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+
+        self.pool = gevent.pool.Pool(concurrency)
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.error = None
+        self.closed = False
+
+    def part_size(self):
+        return PART_SIZE << (len(self.parts) // PARTS_PER_SIZE)
+
+    def write(self, data):
+        self.buffer += data
+
+        while len(self.buffer) >= self.part_size():
+            part = bytes(self.buffer[:self.part_size()])
+            del self.buffer[:len(part)]
+            self.submit(part)
+
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def submit(self, part):
+        if self.upload_id is None:
+            self.upload_id = self.s3.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key)['UploadId']
+
+        # A failed part fails the upload as soon as it is noticed
+        if self.error is not None:
+            raise self.error
+
+        part_number = len(self.parts) + 1
+        greenlet = self.pool.spawn(self.upload_part, part_number, part)
+        greenlet.link_exception(self.part_failed)
+        self.parts.append(greenlet)
+
+    def part_failed(self, greenlet):
+        if self.error is None:
+            self.error = greenlet.exception
+
+    def upload_part(self, part_number, part):
+        result = self.s3.upload_part(Bucket=self.bucket, Key=self.key,
+                                     UploadId=self.upload_id,
+                                     PartNumber=part_number, Body=part)
+        return {'PartNumber': part_number, 'ETag': result['ETag']}
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        if self.upload_id is None:
+            self.s3.put_object(Bucket=self.bucket, Key=self.key,
+                               Body=bytes(self.buffer))
+            return
+
+        if self.buffer:
+            self.submit(bytes(self.buffer))
+            self.buffer = bytearray()
+
+        self.pool.join(raise_error=True)
+        parts = [greenlet.get() for greenlet in self.parts]
+        self.s3.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': parts})
+
+    def abort(self):
+        self.closed = True
+        self.pool.kill()
+
+        if self.upload_id is not None:
+            try:
+                self.s3.abort_multipart_upload(
+                    Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            except Exception:
+                # Parts of an unfinished upload can also be expired with
+                # a bucket lifecycle rule
+                logging.exception("Failed to abort upload of '%s'", self.key)
+
+
+def copy(s3, bucket, source_key, key, size, concurrency=DEFAULT_CONCURRENCY):
+    """
+    copies an object within a bucket without downloading it. Large
+    objects are copied in parts, several at a time.
+    """
+    source = {'Bucket': bucket, 'Key': source_key}
+
+    if size <= MAX_COPY_SIZE:
+        s3.copy_object(Bucket=bucket, Key=key, CopySource=source)
+        return
+
+    upload_id = s3.create_multipart_upload(Bucket=bucket,
+                                           Key=key)['UploadId']
+
+    def copy_part(part_number, start, end):
+        result = s3.upload_part_copy(
+            Bucket=bucket, Key=key, UploadId=upload_id,
+            PartNumber=part_number, CopySource=source,
+            CopySourceRange='bytes=%d-%d' % (start, end - 1))
+        return {'PartNumber': part_number,
+                'ETag': result['CopyPartResult']['ETag']}
+
+    # Parts as large as allowed keep the number of requests low
+    part_size = max(MAX_COPY_SIZE // 5, -(-size // 10000))
+    pool = gevent.pool.Pool(concurrency)
+    try:
+        parts = pool.map(lambda args: copy_part(*args),
+                         [(number + 1, start, min(start + part_size, size))
+                          for number, start in
+                          enumerate(range(0, size, part_size))])
+    except Exception:
+        s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+
+    s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                 MultipartUpload={'Parts': parts})
+
+
+class RangeReader(object):
+    """
+    Reads an S3 object with ranged GETs of a part each, up to
+    'concurrency' of them ahead of the reader, and returns the data in
+    order. Only the parts in flight are held in memory.
+    """
+    def __init__(self, s3, bucket, key, concurrency=DEFAULT_CONCURRENCY):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.concurrency = concurrency
+
+        self.size = s3.head_object(Bucket=bucket, Key=key)['ContentLength']
+        self.next_offset = 0
+        self.pending = collections.deque()
+        # Reads are served from 'buffer' starting at 'offset', so small
+        # reads don't copy the rest of a part each time
+        self.buffer = b''
+        self.offset = 0
+        self.closed = False
+
+    def get_range(self, start, end):
+        result = self.s3.get_object(Bucket=self.bucket, Key=self.key,
+                                    Range='bytes=%d-%d' % (start, end - 1))
+        body = result['Body']
+        try:
+            return body.read()
+        finally:
+            body.close()
+
+    def fill(self):
+        while len(self.pending) < self.concurrency and \
+              self.next_offset < self.size:
+            end = min(self.next_offset + PART_SIZE, self.size)
+            self.pending.append(gevent.spawn(self.get_range,
+                                             self.next_offset, end))
+            self.next_offset = end
+
+    def next_part(self):
+        self.fill()
+        if not self.pending:
+            return b''
+
+        greenlet = self.pending.popleft()
+        self.fill()
+        return greenlet.get()
+
+    def peek(self, size=1):
+        if len(self.buffer) - self.offset < size:
+            self.buffer = self.buffer[self.offset:] + self.next_part()
+            self.offset = 0
+        return self.buffer[self.offset:]
+
+    def read(self, size=-1):
+        if size < 0:
+            chunks = [self.buffer[self.offset:]]
+            chunks.extend(iter(self.next_part, b''))
+            self.buffer = b''
+            self.offset = 0
+            return b''.join(chunks)
+
+        if self.offset >= len(self.buffer):
+            self.buffer = self.next_part()
+            self.offset = 0
+
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        gevent.killall(list(self.pending))
+        self.pending.clear()
+        self.buffer = b''
+        self.offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
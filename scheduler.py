@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+import bisect
+import collections
+import itertools
+import logging
+import time
+import gevent
+from gevent.lock import RLock
+import task
+
+DEFAULT_CONCURRENCY = 32  # tasks running at the same time
+DEFAULT_HOST_CONCURRENCY = 4  # tasks touching the same docker host
+# How long a cancelled task may keep running before it is killed
+CANCEL_GRACE_PERIOD = 30  # seconds
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+class Job(object):
+    def __init__(self, seq, task_obj, func, args, hosts, priority):
+        self.seq = seq
+        self.task = task_obj
+        self.func = func
+        self.args = args
+        self.hosts = hosts
+        self.priority = priority
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class Scheduler(object):
+    """
+    Runs task functions with bounded concurrency.
+
+    Jobs wait in one queue per task type, ordered by priority and then by
+    submission time. A job starts when there is a free global slot and
+    every docker host it touches has a free slot too. When several task
+    types have runnable jobs of the same priority, the type with fewer
+    running jobs goes first, so a burst of one kind of work doesn't starve
+    the others.
+
+    Tasks can be given a timeout. When it runs out after the task has
+    started, the task is cancelled the same way as with cancel().
+    """
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY,
+                 host_concurrency=DEFAULT_HOST_CONCURRENCY, task_timeout=None):
+        self.concurrency = concurrency
+        self.host_concurrency = host_concurrency
+        self.task_timeout = task_timeout
+
+        self.queues = collections.defaultdict(list)
+        self.counter = itertools.count()
+        self.running = 0
+        self.running_by_type = collections.Counter()
+        self.running_by_host = collections.Counter()
+        self.greenlets = {}
+        self.lock = RLock()
+
+    def submit(self, task_obj, func, *args, hosts=None, priority=PRIORITY_NORMAL,
+               timeout=None):
+        hosts = sorted(set(h.split(':')[0] for h in hosts or []))
+        job = Job(next(self.counter), task_obj, func, args, hosts, priority)
+
+        task_obj.timeout = timeout or self.task_timeout
+        task_obj.mark_queued()
+
+        with self.lock:
+            bisect.insort(self.queues[task_obj.task_type], job)
+            self.dispatch()
+
+        return task_obj
+
+    def runnable(self, job):
+        return all(self.running_by_host[h] < self.host_concurrency
+                   for h in job.hosts)
+
+    def next_job(self):
+        best = None
+
+        for task_type, queue in self.queues.items():
+            for job in queue:
+                if self.runnable(job):
+                    key = (job.priority, self.running_by_type[task_type],
+                           job.seq)
+                    if best is None or key < best[0]:
+                        best = (key, job)
+                    break
+
+        return best[1] if best else None
+
+    def dispatch(self):
+        with self.lock:
+            while self.running < self.concurrency:
+                job = self.next_job()
+                if job is None:
+                    return
+
+                task_type = job.task.task_type
+                self.queues[task_type].remove(job)
+                if not self.queues[task_type]:
+                    del self.queues[task_type]
+
+                self.running += 1
+                self.running_by_type[task_type] += 1
+                for host in job.hosts:
+                    self.running_by_host[host] += 1
+
+                job.task.mark_started()
+                self.greenlets[job.task.task_id] = gevent.spawn(self.run, job)
+
+    def run(self, job):
+        watchdog = None
+        if job.task.deadline is not None:
+            watchdog = gevent.spawn_later(
+                max(0, job.task.deadline - time.time()),
+                self.cancel, job.task, "Deadline exceeded")
+
+        try:
+            job.func(*job.args)
+        except task.TaskCancelled as ex:
+            logging.warning("Task '%s' was cancelled: %s",
+                            job.task.task_id, ex)
+        except Exception:
+            logging.exception("Task '%s' failed", job.task.task_id)
+        finally:
+            if watchdog is not None:
+                watchdog.kill(block=False)
+
+            if job.task.status == task.STATUS_RUNNING and \
+               job.task.cancel_reason is not None:
+                job.task.set_status(task.STATUS_CRITICAL,
+                                    job.task.cancel_reason)
+
+            with self.lock:
+                task_type = job.task.task_type
+                self.greenlets.pop(job.task.task_id, None)
+
+                self.running -= 1
+                self.running_by_type[task_type] -= 1
+                if not self.running_by_type[task_type]:
+                    del self.running_by_type[task_type]
+
+                for host in job.hosts:
+                    self.running_by_host[host] -= 1
+                    if not self.running_by_host[host]:
+                        del self.running_by_host[host]
+
+            self.dispatch()
+
+    def cancel(self, task_obj, reason="Task cancelled"):
+        """
+        Cancels a task. A queued task is dropped right away. A running one
+        is asked to stop at its next cancellation point, and is killed if
+        it is still running after CANCEL_GRACE_PERIOD.
+
+        Returns False if the task has already completed.
+        """
+        if task_obj.status != task.STATUS_RUNNING:
+            return False
+
+        with self.lock:
+            queue = self.queues.get(task_obj.task_type, [])
+            for job in queue:
+                if job.task is task_obj:
+                    queue.remove(job)
+                    if not queue:
+                        del self.queues[task_obj.task_type]
+
+                    task_obj.cancel(reason)
+                    task_obj.set_status(task.STATUS_CRITICAL, reason)
+                    return True
+
+            greenlet = self.greenlets.get(task_obj.task_id)
+
+        task_obj.cancel(reason)
+
+        if greenlet is not None:
+            gevent.spawn_later(CANCEL_GRACE_PERIOD, self.kill,
+                               greenlet, task_obj)
+
+        return True
+
+    def kill(self, greenlet, task_obj):
+        if greenlet.dead:
+            return
+
+        logging.warning("Task '%s' didn't stop in %d seconds, killing it",
+                        task_obj.task_id, CANCEL_GRACE_PERIOD)
+        greenlet.kill(task.TaskCancelled(task_obj.cancel_reason), block=False)
+
+    def stats(self):
+        with self.lock:
+            queued = {t: len(q) for t, q in self.queues.items()}
+            return {'concurrency': self.concurrency,
+                    'host_concurrency': self.host_concurrency,
+                    'running': self.running,
+                    'queued': sum(queued.values()),
+                    'running_by_type': dict(self.running_by_type),
+                    'queued_by_type': queued,
+                    'running_by_host': dict(self.running_by_host)}
@@ -3,16 +3,35 @@
 import global_env
 import consul
 import docker
-import re
 import time
 import dateutil.parser
 import collections
+import functools
 import logging
 import gevent
+import gevent.event
 import requests
+import metrics
+import backup_catalog
 
 DOCKER_API_TIMEOUT = 10 # seconds
 
+# When the last full snapshot refresh completed
+LAST_UPDATE_TIME = None
+# Consul index of the backup catalog as of the last refresh
+BACKUPS_INDEX = None
+# {backup id: (ModifyIndex, backup)} of the catalog records parsed so far
+PARSED_BACKUPS = {}
+
+# 'global_env' entries that make up the cluster state snapshot
+SNAPSHOT_SOURCES = ('kv', 'settings', 'backups', 'services', 'containers',
+                    'docker_info', 'nodes', 'docker_statuses')
+
+# How many times each 'global_env' snapshot entry has changed
+VERSIONS = collections.Counter()
+# Set and replaced with a fresh one whenever a snapshot entry changes
+CHANGED = gevent.event.Event()
+
 def consul_kv_to_dict(consul_kv_list):
     result = {}
     for item in consul_kv_list:
@@ -31,15 +50,118 @@ def combine_consul_statuses(statuses):
             total = 'warning'
     return total
 
+def replace_snapshot(source, value):
+    """
+    Stores a fresh copy of a 'global_env' snapshot entry. If it is equal to
+    the current one, the current object is kept, so views cached on it stay
+    valid and its version doesn't change.
+    """
+    if getattr(global_env, source) == value:
+        return
+
+    setattr(global_env, source, value)
+    VERSIONS[source] += 1
+
+    notify_change()
+
+def load_snapshot(entries, versions, update_time):
+    """
+    Replaces the snapshot with one built by another process, keeping its
+    versions, so that all processes agree on them.
+    """
+    global LAST_UPDATE_TIME
+
+    changed = False
+    for source, value in entries.items():
+        if VERSIONS[source] != versions.get(source, 0):
+            setattr(global_env, source, value)
+            VERSIONS[source] = versions.get(source, 0)
+            changed = True
+
+    LAST_UPDATE_TIME = update_time
+
+    if changed:
+        notify_change()
+
+def notify_change():
+    global CHANGED
+
+    changed, CHANGED = CHANGED, gevent.event.Event()
+    changed.set()
+
+def wait_for_change(timeout=None):
+    """
+    Blocks until any 'global_env' snapshot entry changes. All waiters are
+    woken by the single change notification.
+    """
+    CHANGED.wait(timeout)
+
+def snapshot_version(*sources):
+    """
+    returns a value that changes whenever any of the given 'global_env'
+    snapshot entries changes
+    """
+    return tuple(VERSIONS[source] for source in sources)
+
+def snapshot_index():
+    """
+    returns the total number of snapshot changes, which only grows
+    """
+    return sum(VERSIONS.values())
+
+def snapshot_cached(*sources):
+    """
+    Caches a view of the cluster state until one of the 'global_env'
+    entries it is built from is replaced by a fresh one. Sense.update()
+    only replaces the entries that have changed since the last refresh,
+    so views are computed at most once per change no matter how many
+    times they are requested.
+
+    Cached views are shared between callers and must not be modified.
+    """
+    def decorator(func):
+        cache = {}
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            current = [getattr(global_env, source) for source in sources]
+            cached_sources = cache.get('sources')
+
+            if cached_sources is None or \
+               any(a is not b for a, b in zip(current, cached_sources)):
+                cache['result'] = func(*args)
+                cache['sources'] = current
+
+            return cache['result']
+
+        return wrapper
+
+    return decorator
+
+
 class Sense(object):
     @classmethod
     def update(cls):
+        global LAST_UPDATE_TIME, BACKUPS_INDEX
+        started = time.time()
+
         consul_obj = consul.Consul(host=global_env.consul_host,
                                    token=global_env.consul_acl_token)
 
         kv = consul_obj.kv.get('tarantool', recurse=True)[1] or []
         settings = consul_obj.kv.get('tarantool_settings', recurse=True)[1] or []
-        backups = consul_obj.kv.get('tarantool_backups', recurse=True)[1] or []
+
+        # The catalog can be large, so it is only fetched when its index
+        # shows that it has changed. Listing keys up to the separator
+        # returns one key however many records there are.
+        backups_index = consul_obj.kv.get(
+            backup_catalog.RECORDS_PREFIX.rstrip('/'), keys=True,
+            separator='/')[0]
+        backups = None
+        if backups_index != BACKUPS_INDEX:
+            backups_index, backups = consul_obj.kv.get(
+                backup_catalog.RECORDS_PREFIX, recurse=True)
+
         service_names = consul_obj.catalog.services()[1].keys()
 
         services = {}
@@ -73,15 +195,21 @@ class Sense(object):
                 docker_info[entry['Node']['Address']] = \
                     docker_obj.info()
 
-        global_env.kv = kv
-        global_env.settings = settings
-        global_env.backups = backups
-        global_env.services = services
-        global_env.containers = containers
-        global_env.docker_info = docker_info
-        global_env.nodes = nodes
+        replace_snapshot('kv', kv)
+        replace_snapshot('settings', settings)
+        if backups_index != BACKUPS_INDEX:
+            replace_snapshot('backups', backups or [])
+            BACKUPS_INDEX = backups_index
+        replace_snapshot('services', services)
+        replace_snapshot('containers', containers)
+        replace_snapshot('docker_info', docker_info)
+        replace_snapshot('nodes', nodes)
+
+        LAST_UPDATE_TIME = time.time()
+        metrics.SENSE_UPDATE_SECONDS.observe(LAST_UPDATE_TIME - started)
 
     @classmethod
+    @snapshot_cached('kv')
     def blueprints(cls):
         """
         returns a list of registered groups:
@@ -97,123 +225,132 @@ class Sense(object):
         """
         tarantool_kv = consul_kv_to_dict(global_env.kv)
 
-        groups = {}
-        for key, value in tarantool_kv.items():
-            match = re.match('tarantool/(.*)/blueprint/type', key)
-            if match:
-                groups[match.group(1)] = {'type': value,
-                                          'instances': {}}
+        fields = collections.defaultdict(dict)
+        instances = collections.defaultdict(dict)
 
         for key, value in tarantool_kv.items():
-            match = re.match('tarantool/(.*)/blueprint/memsize', key)
-            if match:
-                groups[match.group(1)]['memsize'] = int(value)
+            parts = key.split('/')
 
-            match = re.match('tarantool/(.*)/blueprint/creation_time', key)
-            if match:
-                groups[match.group(1)]['creation_time'] = dateutil.parser.parse(value)
+            if len(parts) < 4 or parts[0] != 'tarantool' or \
+               parts[2] != 'blueprint':
+                continue
 
-            match = re.match('tarantool/(.*)/blueprint/name', key)
-            if match:
-                groups[match.group(1)]['name'] = value
+            if len(parts) == 4:
+                fields[parts[1]][parts[3]] = value
+            elif len(parts) == 6 and parts[3] == 'instances' and \
+                 parts[5] == 'addr':
+                instances[parts[1]][parts[4]] = {'addr': value}
 
-            match = re.match('tarantool/(.*)/blueprint/check_period', key)
-            if match:
-                groups[match.group(1)]['check_period'] = int(value)
+        groups = {}
+        for group_id, blueprint in fields.items():
+            if 'type' not in blueprint:
+                continue
 
-        for key, value in tarantool_kv.items():
-            match = re.match('tarantool/(.*)/blueprint/instances/(.*)/addr', key)
-            if match:
-                groups[match.group(1)]['instances'][match.group(2)] = \
-                    {'addr': None}
+            group = {'type': blueprint['type'],
+                     'instances': instances.get(group_id, {})}
 
-        for key, value in tarantool_kv.items():
-            match = re.match('tarantool/(.*)/blueprint/instances/(.*)/addr', key)
-            if match:
-                group = match.group(1)
-                instance_id = match.group(2)
+            if 'memsize' in blueprint:
+                group['memsize'] = int(blueprint['memsize'])
+
+            if 'creation_time' in blueprint:
+                group['creation_time'] = dateutil.parser.parse(
+                    blueprint['creation_time'])
 
-                groups[group]['instances'][instance_id]['addr'] = \
-                    value
+            if 'name' in blueprint:
+                group['name'] = blueprint['name']
 
+            if 'check_period' in blueprint:
+                group['check_period'] = int(blueprint['check_period'])
 
+            groups[group_id] = group
 
         return groups
 
     @classmethod
+    @snapshot_cached('kv')
     def allocations(cls):
         tarantool_kv = consul_kv_to_dict(global_env.kv)
 
         groups = {}
         for key, value in tarantool_kv.items():
-            match = re.match('tarantool/(.*)/allocation/instances/(.*)/host',
-                             key)
-            if match:
-                group = match.group(1)
-                instance_id = match.group(2)
-                if group not in groups:
-                    groups[group] = {'instances': {}}
-                if instance_id not in groups[group]['instances']:
-                    groups[group]['instances'][instance_id] = {}
+            parts = key.split('/')
+
+            if len(parts) != 6 or parts[0] != 'tarantool' or \
+               parts[2] != 'allocation' or parts[3] != 'instances' or \
+               parts[5] != 'host':
+                continue
 
-                groups[group]['instances'][instance_id]['host'] = \
-                    value
+            group = parts[1]
+            instance_id = parts[4]
+            if group not in groups:
+                groups[group] = {'instances': {}}
+            if instance_id not in groups[group]['instances']:
+                groups[group]['instances'][instance_id] = {}
+
+            groups[group]['instances'][instance_id]['host'] = \
+                value
 
         return groups
 
     @classmethod
+    @snapshot_cached('kv')
+    def host_instances(cls):
+        """
+        returns allocated instances grouped by docker host:
+        {
+            '<host addr>': [('<group id>', '<instance num>'), ...]
+        }
+        """
+        hosts = collections.defaultdict(list)
+
+        for group_id, allocation in cls.allocations().items():
+            for instance_num, instance in allocation['instances'].items():
+                host = instance['host'].split(':')[0]
+                hosts[host].append((group_id, instance_num))
+
+        return dict(hosts)
+
+    @classmethod
+    @snapshot_cached('backups')
     def backups(cls):
-        backups_kv = consul_kv_to_dict(global_env.backups)
-
-        backups = collections.defaultdict(dict)
-
-        for key, value in backups_kv.items():
-            match = re.match('tarantool_backups/(.*)/type',
-                             key)
-            if match:
-                backup_id = match.group(1)
-                backups[backup_id]['type'] = value
-
-            match = re.match('tarantool_backups/(.*)/group_id',
-                             key)
-            if match:
-                backup_id = match.group(1)
-                backups[backup_id]['group_id'] = value
-
-            match = re.match('tarantool_backups/(.*)/archive_id',
-                             key)
-            if match:
-                backup_id = match.group(1)
-                backups[backup_id]['archive_id'] = value
-
-            match = re.match('tarantool_backups/(.*)/creation_time',
-                             key)
-            if match:
-                backup_id = match.group(1)
-                backups[backup_id]['creation_time'] = dateutil.parser.parse(value)
-
-            match = re.match('tarantool_backups/(.*)/storage',
-                             key)
-            if match:
-                backup_id = match.group(1)
-                backups[backup_id]['storage'] = value
-
-            match = re.match('tarantool_backups/(.*)/size',
-                             key)
-            if match:
-                backup_id = match.group(1)
-                backups[backup_id]['size'] = int(value)
-
-            match = re.match('tarantool_backups/(.*)/mem_used',
-                             key)
-            if match:
-                backup_id = match.group(1)
-                backups[backup_id]['mem_used'] = int(value)
-
-
-        return dict(backups)
+        """
+        returns {backup id: backup} of the backup catalog. Only records
+        that changed since the last call are parsed.
+        """
+        global PARSED_BACKUPS
+
+        prefix_len = len(backup_catalog.RECORDS_PREFIX)
+        parsed = {}
+
+        for item in global_env.backups:
+            backup_id = item['Key'][prefix_len:]
+            entry = PARSED_BACKUPS.get(backup_id)
+            if entry is None or entry[0] != item['ModifyIndex']:
+                entry = (item['ModifyIndex'],
+                         backup_catalog.parse_record(item['Value']))
+            parsed[backup_id] = entry
+
+        PARSED_BACKUPS = parsed
+        return {backup_id: entry[1] for backup_id, entry in parsed.items()}
+
+    @classmethod
+    @snapshot_cached('backups')
+    def group_backups(cls):
+        """
+        returns {group id: [backup id, ...]} with the backups of each
+        group, oldest first
+        """
+        backups = cls.backups()
+
+        groups = collections.defaultdict(list)
+        for backup_id in sorted(backups,
+                                key=lambda b: backups[b]['creation_time']):
+            groups[backups[backup_id]['group_id']].append(backup_id)
+
+        return dict(groups)
 
     @classmethod
+    @snapshot_cached('services')
     def services(cls):
         """
         returns a list of allocated groups:
@@ -240,6 +377,7 @@ class Sense(object):
                 addr = '%s:%s' % (host, port)
                 node = entry['Node']['Address']
                 mem = 0
+                replication_status = None
 
                 for check in entry['Checks']:
                     if check['Name'] == 'Memory Utilization':
@@ -247,6 +385,10 @@ class Sense(object):
                             mem = int(int(check['Output']) / (1024**2))
                         except ValueError:
                             pass
+                    # The replication check is registered with the service
+                    elif check['CheckID'] == \
+                            'service:' + entry['Service']['ID']:
+                        replication_status = check['Status']
 
                 statuses = [check['Status'] for check in entry['Checks']]
                 status = combine_consul_statuses(statuses)
@@ -260,12 +402,14 @@ class Sense(object):
                     'addr': addr,
                     'port': port,
                     'status': status,
+                    'replication_status': replication_status,
                     'host': node,
                     'mem_used': mem}
 
         return groups
 
     @classmethod
+    @snapshot_cached('containers', 'settings')
     def containers(cls):
         groups = {}
 
@@ -302,6 +446,7 @@ class Sense(object):
         return groups
 
     @classmethod
+    @snapshot_cached('services', 'docker_info', 'docker_statuses')
     def docker_hosts(cls):
         if 'docker' not in global_env.services:
             return []
@@ -342,6 +487,7 @@ class Sense(object):
         return result
 
     @classmethod
+    @snapshot_cached('settings')
     def network_settings(cls):
         tarantool_kv = consul_kv_to_dict(global_env.settings)
         result = {'network_name': None, 'subnet': None}
@@ -362,6 +508,7 @@ class Sense(object):
         return result
 
     @classmethod
+    @snapshot_cached('services', 'nodes')
     def consul_hosts(cls):
         if 'consul' not in global_env.services:
             return []
@@ -389,7 +536,7 @@ class Sense(object):
                                                   index=index)
 
                 if index_new != index and kv:
-                    global_env.kv = kv
+                    replace_snapshot('kv', kv)
             except Exception:
                 time.sleep(10)
 
@@ -405,7 +552,7 @@ class Sense(object):
                                                   index=index)
 
                 if index_new != index and kv:
-                    global_env.kv = kv
+                    replace_snapshot('kv', kv)
             except Exception:
                 time.sleep(10)
 
@@ -459,7 +606,7 @@ class Sense(object):
                     else:
                         docker_status[addr] = 'critical'
 
-                global_env.docker_statuses = docker_status
+                replace_snapshot('docker_statuses', docker_status)
                 time.sleep(10)
             except Exception as ex:
                 logging.exception("Failed to update data from docker")
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+import time
+import logging
+import socket
+import paramiko
+
+# Idle sessions kept open per host. More can be open at a time, the
+# extra ones are closed when they are given back.
+DEFAULT_SIZE = 4
+# Sessions idle for longer than this are closed rather than reused
+IDLE_TIMEOUT = 300  # seconds
+# Sessions idle for longer than this are checked with a round trip
+CHECK_AFTER = 30  # seconds
+KEEPALIVE = 15  # seconds
+CONNECT_TIMEOUT = 30  # seconds
+
+# What is done with a host whose key isn't known: refused, let in with
+# a warning in the log, or let in and remembered
+HOST_KEY_POLICIES = {'reject': paramiko.RejectPolicy,
+                     'warn': paramiko.WarningPolicy,
+                     'accept': paramiko.AutoAddPolicy}
+DEFAULT_HOST_KEY_POLICY = 'reject'
+
+# Errors that mean a session is broken and mustn't be reused. Others,
+# such as a missing file, leave it as good as it was.
+SESSION_ERRORS = (paramiko.SSHException, EOFError, ConnectionError,
+                  socket.timeout)
+
+
+def parse_host(host_string):
+    """
+    splits a fabric style 'user@host:port' into its parts
+    """
+    user, _, host = host_string.rpartition('@')
+    port = 22
+    if host.count(':') == 1:
+        host, port = host.split(':')
+    return user or None, host, int(port)
+
+
+class Session(object):
+    def __init__(self, client):
+        self.client = client
+        self.sftp = client.open_sftp()
+        self.last_used = time.time()
+
+    def is_active(self):
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def close(self):
+        try:
+            self.client.close()
+        except Exception:
+            pass
+
+
+class SFTPSessionPool(object):
+    """
+    Keeps SSH connections to a host open between operations, so that
+    each archive doesn't pay for a key exchange and authentication.
+    Sessions are checked before reuse and dropped on errors.
+
+    Host keys are checked against the system known_hosts and the
+    'known_hosts' file, if given. Accepted keys are saved to the latter.
+    """
+    def __init__(self, host_string, user=None, identity=None, password=None,
+                 size=DEFAULT_SIZE, known_hosts=None,
+                 host_key_policy=DEFAULT_HOST_KEY_POLICY):
+        if host_key_policy not in HOST_KEY_POLICIES:
+            raise RuntimeError("Unknown SSH host key policy '%s', " %
+                               host_key_policy + "expected one of: " +
+                               ', '.join(sorted(HOST_KEY_POLICIES)))
+
+        host_user, self.host, self.port = parse_host(host_string)
+        self.user = user or host_user
+        self.identity = identity
+        self.password = password
+        self.size = size
+        self.known_hosts = known_hosts
+        self.host_key_policy = host_key_policy
+        self.idle = []
+
+    def connect(self):
+        client = paramiko.SSHClient()
+        client.load_system_host_keys()
+        if self.known_hosts:
+            # Created if missing, so that accepted keys can be saved to it
+            open(self.known_hosts, 'a').close()
+            client.load_host_keys(self.known_hosts)
+        client.set_missing_host_key_policy(
+            HOST_KEY_POLICIES[self.host_key_policy]())
+        sock = socket.create_connection((self.host, self.port),
+                                        CONNECT_TIMEOUT)
+        # Requests are small and each waits for its reply, Nagle's
+        # algorithm would hold them back until the previous one is acked
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client.connect(self.host, port=self.port, username=self.user,
+                       password=self.password, key_filename=self.identity,
+                       timeout=CONNECT_TIMEOUT, sock=sock)
+        client.get_transport().set_keepalive(KEEPALIVE)
+
+        return Session(client)
+
+    def healthy(self, session):
+        idle = time.time() - session.last_used
+
+        if idle > IDLE_TIMEOUT or not session.is_active():
+            return False
+
+        if idle > CHECK_AFTER:
+            try:
+                session.sftp.normalize('.')
+            except SESSION_ERRORS:
+                return False
+
+        return True
+
+    def acquire(self):
+        while self.idle:
+            # The most recently used session is the most likely to work
+            session = self.idle.pop()
+            if self.healthy(session):
+                return session
+
+            logging.info("Dropping stale SSH session to '%s'", self.host)
+            session.close()
+
+        return self.connect()
+
+    def release(self, session, broken=False):
+        if broken or len(self.idle) >= self.size or not session.is_active():
+            session.close()
+            return
+
+        session.last_used = time.time()
+        self.idle.append(session)
+
+    def run(self, func):
+        """
+        calls func(sftp) with a pooled SFTP client and returns its result
+        """
+        session = self.acquire()
+        try:
+            result = func(session.sftp)
+        except SESSION_ERRORS:
+            self.release(session, broken=True)
+            raise
+        except BaseException:
+            self.release(session)
+            raise
+
+        self.release(session)
+        return result
+
+    def open(self, path, mode='rb', bufsize=-1):
+        """
+        returns a remote file that gives its session back when closed
+        """
+        session = self.acquire()
+        try:
+            fobj = session.sftp.open(path, mode, bufsize)
+        except BaseException as ex:
+            self.release(session, broken=isinstance(ex, SESSION_ERRORS))
+            raise
+
+        return PooledFile(self, session, fobj, 'r' in mode)
+
+    def close(self):
+        while self.idle:
+            self.idle.pop().close()
+
+
+class PooledFile(object):
+    """
+    A remote file opened through SFTPSessionPool.open(). Reading ahead
+    is on for reads and writes don't wait for acknowledgements, so a
+    transfer isn't bound by the round trip time.
+    """
+    def __init__(self, pool, session, fobj, reading):
+        self.pool = pool
+        self.session = session
+        self.fobj = fobj
+        self.buffer = b''
+        self.broken = False
+        # Replies to read-ahead requests of a file that wasn't read to
+        # the end would still be on their way, so its session is dropped
+        self.unfinished = reading
+
+        if reading:
+            fobj.prefetch()
+        else:
+            fobj.set_pipelined(True)
+
+    def peek(self, size=1):
+        if len(self.buffer) < size:
+            self.buffer += self.call(self.fobj.read, size - len(self.buffer))
+        return self.buffer
+
+    def read(self, size=-1):
+        if self.buffer:
+            if 0 <= size <= len(self.buffer):
+                data, self.buffer = self.buffer[:size], self.buffer[size:]
+                return data
+
+            data, self.buffer = self.buffer, b''
+            return data + self.read(size - len(data) if size >= 0 else -1)
+
+        data = self.call(self.fobj.read, size if size >= 0 else None)
+        if size < 0 or (size and not data):
+            self.unfinished = False
+        return data
+
+    def write(self, data):
+        self.call(self.fobj.write, data)
+        return len(data)
+
+    def flush(self):
+        self.call(self.fobj.flush)
+
+    def call(self, func, *args):
+        try:
+            return func(*args)
+        except SESSION_ERRORS:
+            self.broken = True
+            raise
+
+    def close(self):
+        if self.fobj is None:
+            return
+
+        fobj, self.fobj = self.fobj, None
+        try:
+            fobj.close()
+        except BaseException:
+            # Pipelined writes that failed only show up here
+            self.broken = True
+            raise
+        finally:
+            self.pool.release(self.session, self.broken or self.unfinished)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
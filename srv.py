@@ -6,7 +6,17 @@ monkey.patch_all()
 
 import os
 import sys
+import time
+import shutil
+import socket
+import random
+import hashlib
+import functools
 import uuid
+import json
+import datetime
+import collections
+import dateutil.parser
 import ipaddress
 import memcached
 import tarantino
@@ -20,7 +30,20 @@ import argparse
 import yaml
 import ip_pool
 import backup_storage
+import backup_catalog
+import compression
 import task
+import evacuate
+import reconcile
+import xlog_archive
+import scheduler
+import task_store
+import metrics
+import query
+import workers
+import fileserve
+import formstream
+import offload
 
 import werkzeug
 
@@ -29,6 +52,7 @@ import flask
 from flask import Flask
 from flask import Response
 from flask_restful import reqparse, abort, Api, Resource
+from flask_restful.utils import unpack
 from flask_bootstrap import Bootstrap
 from flask_basicauth import BasicAuth
 
@@ -38,7 +62,132 @@ api = Api(app)
 Bootstrap(app)
 BasicAuth(app)
 
-TASKS = {}
+TASKS = task_store.TaskStore()
+SCHEDULER = scheduler.Scheduler()
+
+# Seconds between keepalive comments on idle task event streams
+TASK_EVENTS_KEEPALIVE = 15
+
+BACKUP_GROUP_TYPES = ('memcached', 'tarantino', 'tarantool')
+# codec -> file extension and mimetype of backup archives
+ARCHIVE_TYPES = {'gzip': ('gz', 'application/gzip'),
+                 'zstd': ('zst', 'application/zstd')}
+
+# Path of the leader's socket in worker processes other than the leader.
+# None if this process handles all requests itself.
+LEADER_SOCKET = None
+# Requests that any worker can serve from its copy of the snapshot. All
+# other requests go to the leader, which runs the scheduler and keeps
+# the tasks.
+LOCAL_ENDPOINTS = {'grouplist', 'group', 'instancelist', 'instance',
+                   'instancebackuplist', 'instancebackup', 'statelist',
+                   'backuplist', 'backup', 'backupdata', 'serverlist',
+                   'list_servers', 'list_groups', 'show_group',
+                   'prometheus_metrics', 'static'}
+
+# URL -> CachedResponse of cacheable GET responses
+RESPONSE_CACHE = collections.OrderedDict()
+RESPONSE_CACHE_SIZE = 256
+
+# Limits of blocking GET requests, same as in Consul
+DEFAULT_WAIT = 300  # seconds
+MAX_WAIT = 600  # seconds
+
+# Lists and dicts with more items than this are serialized off the hub
+OFFLOAD_JSON_ITEMS = 100
+
+
+def task_counts():
+    return collections.Counter((t.task_type, t.status)
+                               for t in TASKS.values())
+
+
+def sense_staleness():
+    if sense.LAST_UPDATE_TIME is None:
+        return None
+    return time.time() - sense.LAST_UPDATE_TIME
+
+
+metrics.Gauge('im_tasks', 'Tasks held in memory by type and status',
+              task_counts, ('type', 'status'))
+metrics.Gauge('im_sense_staleness_seconds',
+              'Time since the last successful snapshot refresh',
+              sense_staleness)
+metrics.Gauge('im_scheduler_running', 'Tasks running in the scheduler',
+              lambda: SCHEDULER.running)
+metrics.Gauge('im_scheduler_queued', 'Tasks waiting in the scheduler queue',
+              lambda: sum(len(q) for q in SCHEDULER.queues.values()))
+metrics.Gauge('im_evacuate_time_to_recover_seconds',
+              'Time the last server evacuation took to heal all groups',
+              lambda: evacuate.LAST_TIME_TO_RECOVER)
+
+
+@api.representation('application/json')
+def output_json(data, code, headers=None):
+    """
+    The flask-restful JSON representation, except that large responses,
+    like the full group list, are serialized in the offload pool
+    """
+    settings = dict(app.config.get('RESTFUL_JSON', {}))
+    if app.debug:
+        settings.setdefault('indent', 4)
+
+    if isinstance(data, (list, dict)) and len(data) > OFFLOAD_JSON_ITEMS:
+        dumped = offload.call(json.dumps, data, **settings)
+    else:
+        dumped = json.dumps(data, **settings)
+
+    response = flask.make_response(dumped + "\n", code)
+    response.headers.extend(headers or {})
+    return response
+
+
+@app.before_request
+def start_request_timer():
+    flask.g.request_started = time.time()
+
+
+@app.after_request
+def observe_request_time(response):
+    if hasattr(flask.g, 'request_started'):
+        metrics.HTTP_REQUEST_SECONDS.observe(
+            time.time() - flask.g.request_started,
+            flask.request.endpoint or 'unknown',
+            flask.request.method,
+            response.status_code)
+
+    return response
+
+
+@app.before_request
+def forward_to_leader():
+    if LEADER_SOCKET is None:
+        return None
+
+    if flask.request.method in ('GET', 'HEAD') and \
+       flask.request.endpoint in LOCAL_ENDPOINTS:
+        return None
+
+    if flask.request.content_length is not None:
+        body = flask.request.stream
+    else:
+        body = flask.request.get_data() or None
+
+    try:
+        status, headers, chunks = workers.forward(
+            LEADER_SOCKET, flask.request.method, flask.request.full_path,
+            flask.request.headers.items(), body)
+    except OSError:
+        logging.exception("Failed to pass request to the leader")
+        abort(503, message="No leader worker available")
+
+    return Response(chunks, status=status, headers=headers)
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(),
+                    mimetype="text/plain; version=0.0.4")
 
 def abort_if_group_doesnt_exist(group_id):
     if group_id not in sense.Sense.blueprints():
@@ -60,6 +209,15 @@ def abort_if_backup_doesnt_exist(backup_id):
         abort(404, message="backup {} doesn't exist".format(backup_id))
 
 
+def group_hosts(group_id):
+    allocation = sense.Sense.allocations().get(group_id, {'instances': {}})
+    return [i['host'] for i in allocation['instances'].values()]
+
+
+INSTANCE_FIELDS = ('id', 'name', 'addr', 'port', 'type', 'host', 'state',
+                   'mem_used')
+
+
 def state_to_dict(state_name):
     if state_name == 'passing':
         return {'id': '1', 'name': 'OK', 'type': 'passing'}
@@ -73,35 +231,22 @@ def state_to_dict(state_name):
 def instance_to_dict(instance_id):
     group_id, instance_num = instance_id.split('_')
 
-    memc = memcached.Memcached.get(group_id)
-    blueprint = memc.blueprint
-    allocation = memc.allocation
-    services = memc.services
-
-    addr = blueprint['instances'][instance_num]['addr']
-    host = allocation['instances'][instance_num]['host']
-    type_str = blueprint['type']
-    name = instance_num
-    instance_id = group_id + '_' + instance_num
-    state = services['instances'][instance_num]['status']
-    port = services['instances'][instance_num]['port']
-    mem_used = services['instances'][instance_num]['mem_used']
-
-    return {'id': instance_id,
-            'name': name,
-            'addr': addr,
-            'port': port,
-            'type': type_str,
-            'host': host,
-            'state': state_to_dict(state),
-            'mem_used': mem_used}
+    for instance in group_to_dict(group_id)['instances']:
+        if instance['name'] == instance_num:
+            return instance_view(instance)
+
+    raise RuntimeError("No such instance: '%s'" % instance_id)
+
+
+def instance_view(instance):
+    return {key: instance[key] for key in INSTANCE_FIELDS}
 
 
 def backup_to_dict(backup_id):
-    backups = sense.Sense.backups()
+    return backup_view(backup_id, sense.Sense.backups()[backup_id])
 
-    backup = backups[backup_id]
 
+def backup_view(backup_id, backup):
     return {'id': backup_id,
             'archive_id': backup['archive_id'],
             'group_id': backup['group_id'],
@@ -109,17 +254,13 @@ def backup_to_dict(backup_id):
             'creation_time': backup['creation_time'].isoformat(),
             'size': backup['size'],
             'mem_used': backup['mem_used'],
-            'storage': backup['storage']}
+            'storage': backup['storage'],
+            'codec': backup['codec'],
+            'compression_level': backup['compression_level'],
+            'parent_id': backup['parent_id']}
 
 
-def group_to_dict(group_id):
-    memc = memcached.Memcached.get(group_id)
-    blueprint = memc.blueprint
-    allocation = memc.allocation
-    services = memc.services
-    containers = sense.Sense.containers().get(group_id,
-                                              {'instances': {}})
-
+def build_group_dict(group_id, blueprint, allocation, services, containers):
     state = 'passing'
 
     states = [i['status'] for i in services['instances'].values()]
@@ -176,6 +317,272 @@ def group_to_dict(group_id):
     return result
 
 
+def group_to_dict(group_id):
+    empty = {'instances': {}}
+
+    return build_group_dict(group_id,
+                            sense.Sense.blueprints()[group_id],
+                            sense.Sense.allocations().get(group_id, empty),
+                            sense.Sense.services().get(group_id, empty),
+                            sense.Sense.containers().get(group_id, empty))
+
+
+@sense.snapshot_cached('kv', 'services', 'containers', 'settings')
+def group_views():
+    """
+    Builds group_to_dict() for every group in one pass over the snapshot.
+    The result is shared until the snapshot changes and must not be
+    modified.
+    """
+    blueprints = sense.Sense.blueprints()
+    allocations = sense.Sense.allocations()
+    services = sense.Sense.services()
+    containers = sense.Sense.containers()
+    empty = {'instances': {}}
+
+    return {group_id: build_group_dict(group_id, blueprint,
+                                       allocations.get(group_id, empty),
+                                       services.get(group_id, empty),
+                                       containers.get(group_id, empty))
+            for group_id, blueprint in blueprints.items()}
+
+
+@sense.snapshot_cached('kv', 'services', 'containers', 'settings')
+def instance_views():
+    """
+    Same as group_views(), but for instance_to_dict()
+    """
+    return {instance['id']: instance_view(instance)
+            for group in group_views().values()
+            for instance in group['instances']}
+
+
+@sense.snapshot_cached('kv', 'services', 'containers', 'settings')
+def group_index():
+    blueprints = sense.Sense.blueprints()
+
+    return query.Index(
+        group_views(),
+        keys={'type': lambda g: [g['type']],
+              'state': lambda g: [g['state']['type']],
+              'host': lambda g: [i['host'] for i in g['instances']]},
+        ordered={'name': lambda g: g['name'],
+                 'creation_time':
+                 lambda g: blueprints[g['id']].get('creation_time')})
+
+
+@sense.snapshot_cached('kv', 'services', 'containers', 'settings')
+def instance_index():
+    return query.Index(
+        instance_views(),
+        keys={'type': lambda i: [i['type']],
+              'state': lambda i: [i['state']['type']],
+              'host': lambda i: [i['host']],
+              'group_id': lambda i: [i['id'].split('_')[0]]})
+
+
+@sense.snapshot_cached('backups')
+def backup_index():
+    backups = sense.Sense.backups()
+
+    return query.Index(
+        {backup_id: backup_view(backup_id, backup)
+         for backup_id, backup in backups.items()},
+        keys={'type': lambda b: [b['type']],
+              'group_id': lambda b: [b['group_id']],
+              'storage': lambda b: [b['storage']]},
+        ordered={'creation_time':
+                 lambda b: backups[b['id']]['creation_time']})
+
+
+def parse_time(value):
+    result = dateutil.parser.parse(value)
+    if result.tzinfo is None:
+        result = result.replace(tzinfo=datetime.timezone.utc)
+    return result
+
+
+def list_parser(keys=(), name_prefix=False, created=False):
+    """
+    Parser of the paging, projection and filter arguments of a list
+    resource. 'keys' are the names of exact-match filters.
+    """
+    parser = reqparse.RequestParser(bundle_errors=True)
+    parser.add_argument('cursor')
+    parser.add_argument('limit', type=int)
+    parser.add_argument('fields')
+
+    for key in keys:
+        parser.add_argument(key)
+
+    if name_prefix:
+        parser.add_argument('name_prefix')
+
+    if created:
+        parser.add_argument('created_after', type=parse_time)
+        parser.add_argument('created_before', type=parse_time)
+
+    return parser
+
+
+def list_response(index, args, keys=()):
+    """
+    Filters, pages and projects a listing. The body has the same shape as
+    an unpaged listing. If there are more entries, the X-Next-Cursor
+    header holds the 'cursor' argument for the next page.
+    """
+    matches = [index.lookup(key, args[key]) for key in keys if args[key]]
+
+    if args.get('name_prefix'):
+        matches.append(index.prefix('name', args['name_prefix']))
+
+    if args.get('created_after') or args.get('created_before'):
+        matches.append(index.range('creation_time', args['created_after'],
+                                   args['created_before']))
+
+    page, next_cursor = index.select(query.intersect(matches),
+                                     args['cursor'], args['limit'])
+
+    fields = set(args['fields'].split(',')) if args['fields'] else None
+    result = {entry_id: query.project(index.entries[entry_id], fields)
+              for entry_id in page}
+
+    headers = {}
+    if next_cursor is not None:
+        headers['X-Next-Cursor'] = next_cursor
+
+    return result, 200, headers
+
+
+def parse_wait(value):
+    """
+    parses durations like '30', '30s' or '5m'
+    """
+    multiplier = 1
+    if value.endswith('m'):
+        multiplier = 60
+        value = value[:-1]
+    elif value.endswith('s'):
+        value = value[:-1]
+
+    wait = float(value) * multiplier
+    if wait < 0:
+        raise ValueError("Wait time can't be negative")
+
+    return min(wait, MAX_WAIT)
+
+
+CachedResponse = collections.namedtuple(
+    'CachedResponse', ['version', 'body', 'headers', 'index'])
+
+
+def cached_response(key, version, func, args, kwargs):
+    """
+    Returns the CachedResponse of 'func' for the given state version,
+    rendering it if the version has changed. Responses other than 200
+    are returned as is and not cached.
+    """
+    cached = RESPONSE_CACHE.get(key)
+
+    if cached is not None and cached.version == version:
+        RESPONSE_CACHE.move_to_end(key)
+        return cached
+
+    data, code, headers = unpack(func(*args, **kwargs))
+    response = api.make_response(data, code, headers)
+    if code != 200:
+        return response
+
+    body = response.get_data()
+    response.set_etag(hashlib.sha1(body).hexdigest())
+
+    # Like ModifyIndex in Consul, the index only moves when the body does
+    if cached is not None and cached.body == body:
+        index = cached.index
+    else:
+        index = sense.snapshot_index()
+
+    cached = CachedResponse(version, body, list(response.headers), index)
+    RESPONSE_CACHE[key] = cached
+    while len(RESPONSE_CACHE) > RESPONSE_CACHE_SIZE:
+        RESPONSE_CACHE.popitem(last=False)
+
+    return cached
+
+
+def conditional_get(*sources, tasks=False):
+    """
+    Makes a GET handler answer with an ETag and honour If-None-Match.
+
+    The response is serialized once per version of the state it is built
+    from: the 'global_env' snapshot entries in 'sources', and the task
+    list if 'tasks' is set. Until that changes, requests for the same URL
+    are answered from the cache. The ETag is a hash of the body, so
+    clients keep getting 304s across changes that don't affect it.
+
+    Handlers built only from the snapshot also support blocking queries
+    modelled on Consul ones. The X-Index header holds the snapshot index
+    at which the body last changed. A request with '?index=N' waits for
+    up to 'wait' (e.g. '30s' or '5m') until the index moves past N, and
+    then returns as usual. Waiters sleep on the single snapshot change
+    notification, so they cost nothing until the state changes.
+    """
+    watch_parser = reqparse.RequestParser(bundle_errors=True)
+    watch_parser.add_argument('index', type=int)
+    watch_parser.add_argument('wait', type=parse_wait)
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (flask.request.path,
+                   tuple(sorted((k, v) for k, v in
+                                flask.request.args.items(multi=True)
+                                if k not in ('index', 'wait'))))
+
+            watch = {'index': None}
+            if not tasks:
+                watch = watch_parser.parse_args()
+
+            if watch['index'] is not None:
+                wait = watch['wait']
+                if wait is None:
+                    wait = DEFAULT_WAIT
+                # Spread out clients that started waiting together
+                wait += random.uniform(0, wait / 16)
+                deadline = time.time() + wait
+
+            while True:
+                version = sense.snapshot_version(*sources)
+                if tasks:
+                    version += TASKS.version()
+
+                cached = cached_response(key, version, func, args, kwargs)
+                if not isinstance(cached, CachedResponse):
+                    return cached
+
+                index = watch['index']
+                # An index from the future means the server has restarted
+                if index is None or cached.index > index or \
+                   index > sense.snapshot_index():
+                    break
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+
+                sense.wait_for_change(remaining)
+
+            response = Response(cached.body, headers=cached.headers)
+            if not tasks:
+                response.headers['X-Index'] = str(cached.index)
+
+            return response.make_conditional(flask.request)
+
+        return wrapper
+
+    return decorator
+
+
 class UpdateImagesTask(task.Task):
     task_type = "update_images"
 
@@ -189,6 +596,7 @@ class UpdateImagesTask(task.Task):
 
 
 class Group(Resource):
+    @conditional_get('kv', 'services', 'containers', 'settings')
     def get(self, group_id):
         abort_if_group_doesnt_exist(group_id)
         return group_to_dict(group_id)
@@ -210,19 +618,22 @@ class Group(Resource):
             TASKS[delete_task.task_id] = delete_task
 
             memc = memcached.Memcached.get(group_id)
-            gevent.spawn(memc.delete, delete_task)
+            SCHEDULER.submit(delete_task, memc.delete, delete_task,
+                             hosts=group_hosts(group_id))
         elif group['type'] == 'tarantino':
             delete_task = tarantino.DeleteTask(group_id)
             TASKS[delete_task.task_id] = delete_task
 
             tar = tarantino.Tarantino.get(group_id)
-            gevent.spawn(tar.delete, delete_task)
+            SCHEDULER.submit(delete_task, tar.delete, delete_task,
+                             hosts=group_hosts(group_id))
         elif group['type'] == 'tarantool':
             delete_task = tarantool.DeleteTask(group_id)
             TASKS[delete_task.task_id] = delete_task
 
             tar = tarantool.Tarantool.get(group_id)
-            gevent.spawn(tar.delete, delete_task)
+            SCHEDULER.submit(delete_task, tar.delete, delete_task,
+                             hosts=group_hosts(group_id))
 
         if args['async']:
             result = {'id': group_id,
@@ -247,6 +658,7 @@ class Group(Resource):
                             location='files')
         parser.add_argument('config_is_dir', type=bool, default=False)
         parser.add_argument('backup_id', type=str)
+        parser.add_argument('replay_xlogs', type=bool, default=False)
         args = parser.parse_args()
 
         blueprints = sense.Sense.blueprints()
@@ -263,15 +675,17 @@ class Group(Resource):
             update_task = memcached.UpdateTask(group_id)
             TASKS[update_task.task_id] = update_task
 
-            gevent.spawn(memc.update,
-                         args['name'],
-                         args['memsize'],
-                         args['password'],
-                         args['docker_image_name'],
-                         args['heal'],
-                         args['backup_id'],
-                         storage,
-                         update_task)
+            SCHEDULER.submit(update_task,
+                             memc.update,
+                             args['name'],
+                             args['memsize'],
+                             args['password'],
+                             args['docker_image_name'],
+                             args['heal'],
+                             args['backup_id'],
+                             storage,
+                             update_task,
+                             hosts=group_hosts(group_id))
 
         elif group['type'] == 'tarantino':
             tar = tarantino.Tarantino.get(group_id)
@@ -284,13 +698,15 @@ class Group(Resource):
                 stream = args['config'].stream
                 config_data = stream.getvalue().decode(encoding='UTF-8')
 
-            gevent.spawn(tar.update,
-                         args['name'],
-                         args['memsize'],
-                         args['password'],
-                         config_data,
-                         args['docker_image_name'],
-                         update_task)
+            SCHEDULER.submit(update_task,
+                             tar.update,
+                             args['name'],
+                             args['memsize'],
+                             args['password'],
+                             config_data,
+                             args['docker_image_name'],
+                             update_task,
+                             hosts=group_hosts(group_id))
         elif group['type'] == 'tarantool':
             tar = tarantool.Tarantool.get(group_id)
 
@@ -304,17 +720,20 @@ class Group(Resource):
                 config_data = stream.getvalue()
                 config_filename = args['config'].filename
 
-            gevent.spawn(tar.update,
-                         args['name'],
-                         args['memsize'],
-                         args['password'],
-                         config_data,
-                         config_filename,
-                         args['docker_image_name'],
-                         args['heal'],
-                         args['backup_id'],
-                         storage,
-                         update_task)
+            SCHEDULER.submit(update_task,
+                             tar.update,
+                             args['name'],
+                             args['memsize'],
+                             args['password'],
+                             config_data,
+                             config_filename,
+                             args['docker_image_name'],
+                             args['heal'],
+                             args['backup_id'],
+                             storage,
+                             update_task,
+                             args['replay_xlogs'],
+                             hosts=group_hosts(group_id))
         else:
             raise RuntimeError("Unknown group type: %s" % group['type'])
 
@@ -329,13 +748,14 @@ class Group(Resource):
 
 
 class GroupList(Resource):
+    filter_keys = ('type', 'state', 'host')
+
+    @conditional_get('kv', 'services', 'containers', 'settings')
     def get(self):
-        blueprints = sense.Sense.blueprints()
+        parser = list_parser(self.filter_keys, name_prefix=True, created=True)
+        args = parser.parse_args()
 
-        result = {}
-        for group_id in blueprints:
-            result[group_id] = group_to_dict(group_id)
-        return result
+        return list_response(group_index(), args, self.filter_keys)
 
     def post(self):
         parser = reqparse.RequestParser(bundle_errors=True)
@@ -356,32 +776,35 @@ class GroupList(Resource):
             create_task = memcached.CreateTask(group_id)
             TASKS[create_task.task_id] = create_task
 
-            gevent.spawn(memcached.Memcached.create,
-                         create_task,
-                         args['name'],
-                         args['memsize'],
-                         args['password'],
-                         10)
+            SCHEDULER.submit(create_task,
+                             memcached.Memcached.create,
+                             create_task,
+                             args['name'],
+                             args['memsize'],
+                             args['password'],
+                             10)
         elif args['type'] == 'tarantino':
             create_task = tarantino.CreateTask(group_id)
             TASKS[create_task.task_id] = create_task
 
-            gevent.spawn(tarantino.Tarantino.create,
-                         create_task,
-                         args['name'],
-                         args['memsize'],
-                         args['password'],
-                         10)
+            SCHEDULER.submit(create_task,
+                             tarantino.Tarantino.create,
+                             create_task,
+                             args['name'],
+                             args['memsize'],
+                             args['password'],
+                             10)
         elif args['type'] == 'tarantool':
             create_task = tarantool.CreateTask(group_id)
             TASKS[create_task.task_id] = create_task
 
-            gevent.spawn(tarantool.Tarantool.create,
-                         create_task,
-                         args['name'],
-                         args['memsize'],
-                         args['password'],
-                         10)
+            SCHEDULER.submit(create_task,
+                             tarantool.Tarantool.create,
+                             create_task,
+                             args['name'],
+                             args['memsize'],
+                             args['password'],
+                             10)
         else:
             raise RuntimeError('No such instance type: %s' % args['type'])
 
@@ -409,19 +832,89 @@ class Task(Resource):
 
         return TASKS[task_id].get_dict(args['index'])
 
+    def delete(self, task_id):
+        if task_id not in TASKS:
+            abort(404, message="task {} doesn't exist".format(task_id))
+
+        task_obj = TASKS[task_id]
+
+        if not SCHEDULER.cancel(task_obj):
+            abort(409, message="task {} has already completed".format(task_id))
+
+        return task_obj.get_dict(), 202
+
+
+class TaskEvents(Resource):
+    def get(self, task_id):
+        parser = reqparse.RequestParser(bundle_errors=True)
+        parser.add_argument('index', type=int)
+        parser.add_argument('Last-Event-ID', type=int, location='headers',
+                            dest='last_event_id')
+
+        args = parser.parse_args()
+
+        if task_id not in TASKS:
+            abort(404, message="task {} doesn't exist".format(task_id))
+
+        task_obj = TASKS[task_id]
+
+        def stream_events(index):
+            while True:
+                obj = task_obj.get_dict(index)
+                index = obj['index']
+
+                yield 'id: %d\ndata: %s\n\n' % (index, json.dumps(obj))
+
+                if obj['status'] != task.STATUS_RUNNING:
+                    return
+
+                while task_obj.wait(index, TASK_EVENTS_KEEPALIVE) == index:
+                    yield ': keepalive\n\n'
+
+        index = args['index'] or args['last_event_id'] or 0
+        return Response(stream_events(index),
+                        mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache",
+                                 "X-Accel-Buffering": "no"})
+
 
 class TaskList(Resource):
+    filter_keys = ('type', 'status', 'group_id')
+
+    @conditional_get(tasks=True)
     def get(self):
+        args = list_parser(self.filter_keys).parse_args()
+
         result = {}
 
-        for task_id, task in TASKS.items():
-            result[task_id] = task.get_dict().copy()
+        if args['status'] == task.STATUS_RUNNING:
+            # Running tasks are never in the LRU of completed ones
+            tasks = [(t.task_id, t) for t in TASKS.active_tasks()]
+        else:
+            tasks = TASKS.items()
+
+        for task_id, task_obj in tasks:
+            # Asking for logs past the last index skips copying them
+            result[task_id] = task_obj.get_dict(task_obj.index)
             del result[task_id]['logs']
 
-        return result
+        index = query.Index(
+            result,
+            keys={'type': lambda t: [t['type']],
+                  'status': lambda t: [t['status']],
+                  'group_id': lambda t: [t['group_id']] if 'group_id' in t
+                                        else []})
+
+        return list_response(index, args, self.filter_keys)
+
+
+class SchedulerStats(Resource):
+    def get(self):
+        return SCHEDULER.stats()
 
 
 class ServerList(Resource):
+    @conditional_get('services', 'docker_info', 'docker_statuses')
     def get(self):
         result = {}
 
@@ -437,7 +930,42 @@ class ServerList(Resource):
         return result
 
 
+class ServerEvacuate(Resource):
+    def post(self, server_addr):
+        parser = reqparse.RequestParser(bundle_errors=True)
+        parser.add_argument('async', type=bool, default=False)
+        parser.add_argument('concurrency', type=int,
+                            default=evacuate.DEFAULT_CONCURRENCY)
+        parser.add_argument('host_concurrency', type=int,
+                            default=evacuate.DEFAULT_HOST_CONCURRENCY)
+        args = parser.parse_args()
+
+        docker_host = evacuate.find_docker_host(server_addr)
+        if not docker_host:
+            abort(404, message="server {} doesn't exist".format(server_addr))
+
+        evacuate_task = evacuate.EvacuateTask(docker_host)
+        TASKS[evacuate_task.task_id] = evacuate_task
+
+        SCHEDULER.submit(evacuate_task,
+                         evacuate.evacuate,
+                         evacuate_task,
+                         docker_host,
+                         args['concurrency'],
+                         args['host_concurrency'],
+                         priority=scheduler.PRIORITY_HIGH)
+
+        if args['async']:
+            result = {'task_id': evacuate_task.task_id}
+            return result, 202
+
+        else:
+            evacuate_task.wait_for_completion()
+            return evacuate_task.get_dict(), 201
+
+
 class Backup(Resource):
+    @conditional_get('backups')
     def get(self, backup_id):
         abort_if_backup_doesnt_exist(backup_id)
         result = {}
@@ -458,7 +986,8 @@ class Backup(Resource):
             abort(500, message="Backup storage not configured")
 
         storage = global_env.backup_storage
-        gevent.spawn(storage.unregister_backup, backup_id, delete_task)
+        SCHEDULER.submit(delete_task,
+                         storage.unregister_backup, backup_id, delete_task)
 
         if args['async']:
             result = {'id': backup_id,
@@ -469,6 +998,61 @@ class Backup(Resource):
             return '', 204
 
 
+def if_range_matches(etag, last_modified):
+    """
+    Checks that the representation a client asks a part of is the one
+    it has already got parts of
+    """
+    if_range = flask.request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        date = if_range.date
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=datetime.timezone.utc)
+        return date == last_modified
+    return True
+
+
+def file_response(path, etag, mimetype, headers):
+    """
+    Serves a file, or the byte range of it asked for with Range. The
+    body is sent with sendfile() where the server supports it.
+    """
+    fobj = open(path, 'rb')
+    stat = os.fstat(fobj.fileno())
+    size = stat.st_size
+    last_modified = datetime.datetime.fromtimestamp(
+        int(stat.st_mtime), datetime.timezone.utc)
+
+    start, end = 0, size
+    status = 200
+    headers = dict(headers, **{'Accept-Ranges': 'bytes'})
+
+    byte_range = flask.request.range
+    # Clients asking for several ranges get the whole file instead
+    if byte_range is not None and len(byte_range.ranges) == 1 and \
+       if_range_matches(etag, last_modified):
+        range_for_length = byte_range.range_for_length(size)
+        if range_for_length is None:
+            fobj.close()
+            return Response(status=416,
+                            headers={'Content-Range': 'bytes */%d' % size})
+
+        start, end = range_for_length
+        status = 206
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end - 1, size)
+
+    response = Response(fileserve.FileRange(fobj, start, end - start),
+                        status=status, headers=headers, mimetype=mimetype,
+                        direct_passthrough=True)
+    response.headers['Content-Length'] = str(end - start)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+
+    return response.make_conditional(flask.request)
+
+
 class BackupData(Resource):
     def get(self, backup_id):
         abort_if_backup_doesnt_exist(backup_id)
@@ -476,60 +1060,116 @@ class BackupData(Resource):
         archive_id = backup['archive_id']
 
         storage = global_env.backup_storage
+        extension, mimetype = ARCHIVE_TYPES[backup['codec']]
+        headers = {"Content-Disposition":
+                   "attachment;filename=backup.tar.%s" % extension}
+
+        path = storage.archive_path(archive_id)
+        if path is not None:
+            # Archives are named by their hash, so it makes a strong ETag
+            return file_response(path, archive_id, mimetype, headers)
+
         fobj = storage.get_archive(archive_id, decompress=False)
 
         def download_backup():
             chunk_size = 8192
-            while True:
-                chunk = fobj.read(chunk_size)
+            try:
+                while True:
+                    chunk = fobj.read(chunk_size)
 
-                if len(chunk) == 0:
-                    return
+                    if len(chunk) == 0:
+                        return
 
-                yield chunk
+                    yield chunk
+            finally:
+                # Remote storages hold a session until the archive is closed
+                fobj.close()
 
+        headers["Content-Length"] = backup['size']
         return Response(download_backup(),
-                        mimetype="application/gzip",
-                        headers={"Content-Disposition":
-                                 "attachment;filename=backup.tar.gz",
-                                 "Content-Length": backup['size']})
+                        mimetype=mimetype,
+                        headers=headers)
 
 
-class BackupList(Resource):
-    def get(self):
-        backups = sense.Sense.backups()
+def discard_upload(storage, digest):
+    """
+    deletes an uploaded archive that won't be registered, unless a
+    backup already uses an archive with the same contents
+    """
+    consul_obj = backup_catalog.connect()
+    if backup_catalog.archive_refs(consul_obj, digest)[1] == 0:
+        storage.delete_archive(digest)
 
-        result = {}
-        for backup_id in backups.keys():
-            result[backup_id] = backup_to_dict(backup_id)
 
-        return result
+class BackupList(Resource):
+    filter_keys = ('type', 'group_id', 'storage')
 
-    def post(self):
-        parser = reqparse.RequestParser(bundle_errors=True)
-        parser.add_argument('async', type=bool, default=False)
-        parser.add_argument('group_id', default='')
-        parser.add_argument('type', required=True)
-        parser.add_argument('file',
-                            type=werkzeug.datastructures.FileStorage,
-                            location='files',
-                            required=True)
+    @conditional_get('backups')
+    def get(self):
+        args = list_parser(self.filter_keys, created=True).parse_args()
 
-        args = parser.parse_args()
+        return list_response(backup_index(), args, self.filter_keys)
 
-        group_id = args['group_id']
-        group_type = args['type']
-        stream = args['file'].stream
+    def post(self):
+        content_type, options = werkzeug.http.parse_options_header(
+            flask.request.headers.get('Content-Type', ''))
+        if content_type != 'multipart/form-data':
+            abort(400, message="Backup must be uploaded as multipart/form-data")
 
         if not global_env.backup_storage:
             abort(500, message="Backup storage not configured")
 
         storage = global_env.backup_storage
 
-        if group_type not in ['memcached', 'tarantino', 'tarantool']:
-            raise RuntimeError("Unknown group type: %s" % group_type)
+        # The form is parsed straight from the request body, so the archive
+        # is hashed, counted, validated and stored in one pass over it
+        # instead of being spooled to a temporary file first.
+        args = dict(flask.request.args.items())
+        archive = None
 
-        digest, total_size = storage.put_archive(stream, compress=False)
+        try:
+            reader = formstream.MultipartReader(flask.request.stream,
+                                                options.get('boundary'))
+            for part in reader.parts():
+                if part.filename is None:
+                    args[part.name] = part.read_value().decode('utf-8')
+                elif part.name == 'file' and archive is None:
+                    # A type known to be wrong saves storing the archive.
+                    # One sent after the file is checked once it's stored.
+                    if 'type' in args and \
+                       args['type'] not in BACKUP_GROUP_TYPES:
+                        break
+
+                    validator = backup_storage.ArchiveValidator(part)
+                    try:
+                        digest, total_size = storage.put_archive(
+                            validator, compress=False)
+                    except compression.DECOMPRESSION_ERRORS:
+                        # Storages that recompress uploads fail on the
+                        # archives that the validator rejects
+                        if validator.validate() is None:
+                            raise
+                        digest, total_size = None, 0
+
+                    # Recompressed archives are in the storage codec
+                    codec = None if storage.recompresses else validator.codec
+                    archive = (digest, total_size, codec,
+                               validator.validate())
+        except formstream.FormError as ex:
+            abort(400, message=str(ex))
+
+        group_id = args.get('group_id', '')
+        group_type = args.get('type')
+
+        if group_type not in BACKUP_GROUP_TYPES:
+            if archive is not None and archive[0] is not None:
+                discard_upload(storage, archive[0])
+            abort(400, message="Unknown group type: %s" % group_type)
+
+        if archive is None:
+            abort(400, message="Missing backup archive in 'file'")
+
+        digest, total_size, codec, error = archive
 
         backup_id = uuid.uuid4().hex
 
@@ -541,6 +1181,10 @@ class BackupList(Resource):
 
             try:
                 upload_task.log("Validating backup")
+                if error is not None:
+                    upload_task.set_status(task.STATUS_CRITICAL, error)
+                    return
+
                 if group_type == 'memcached':
                     backup_is_valid = memcached.backup_is_valid(storage, digest)
                 elif group_type == 'tarantino':
@@ -553,7 +1197,8 @@ class BackupList(Resource):
                                            "Backup is not valid")
                     return
                 storage.register_backup(backup_id, digest, group_id,
-                                        group_type, total_size, 0)
+                                        group_type, total_size, 0,
+                                        codec=codec)
 
                 sense.Sense.update()
                 upload_task.set_status(task.STATUS_SUCCESS)
@@ -562,10 +1207,12 @@ class BackupList(Resource):
                 upload_task.set_status(task.STATUS_CRITICAL, str(ex))
                 raise
 
-        gevent.spawn(upload_backup, upload_task, storage, group_type,
-                     digest, total_size)
+        SCHEDULER.submit(upload_task,
+                         upload_backup, upload_task, storage, group_type,
+                         digest, total_size)
 
-        if args['async']:
+        # Same as the bool argument type of reqparse
+        if bool(args.get('async')):
             result = {'id': upload_task.backup_id,
                       'task_id': upload_task.task_id}
             return result, 202
@@ -590,6 +1237,7 @@ class InstanceBackupList(Resource):
 
         parser = reqparse.RequestParser(bundle_errors=True)
         parser.add_argument('async', type=bool, default=False)
+        parser.add_argument('full', type=bool, default=False)
 
         args = parser.parse_args()
 
@@ -609,17 +1257,22 @@ class InstanceBackupList(Resource):
             TASKS[backup_task.task_id] = backup_task
             memc = memcached.Memcached.get(group_id)
 
-            gevent.spawn(memc.backup,
-                         backup_task,
-                         storage)
+            SCHEDULER.submit(backup_task,
+                             memc.backup,
+                             backup_task,
+                             storage,
+                             hosts=group_hosts(group_id))
         elif group['type'] == 'tarantool':
             backup_task = memcached.BackupTask(group_id, backup_id)
             TASKS[backup_task.task_id] = backup_task
             tar = tarantool.Tarantool.get(group_id)
 
-            gevent.spawn(tar.backup,
-                         backup_task,
-                         storage)
+            SCHEDULER.submit(backup_task,
+                             tar.backup,
+                             backup_task,
+                             storage,
+                             args['full'],
+                             hosts=group_hosts(group_id))
         else:
             raise RuntimeError('Instance type unsupported: %s' % args['type'])
 
@@ -641,6 +1294,7 @@ class StateList(Resource):
 
 
 class Instance(Resource):
+    @conditional_get('kv', 'services', 'containers', 'settings')
     def get(self, instance_id):
         abort_if_instance_doesnt_exist(instance_id)
 
@@ -648,17 +1302,13 @@ class Instance(Resource):
 
 
 class InstanceList(Resource):
-    def get(self):
-        instances = {}
-
-        result = {}
-        for group_id, group in sense.Sense.blueprints().items():
-            for instance_num in group['instances']:
-                instance_id = group_id + '_' + instance_num
+    filter_keys = ('type', 'state', 'host', 'group_id')
 
-                result[instance_id] = instance_to_dict(instance_id)
+    @conditional_get('kv', 'services', 'containers', 'settings')
+    def get(self):
+        args = list_parser(self.filter_keys).parse_args()
 
-        return result
+        return list_response(instance_index(), args, self.filter_keys)
 
 
 def update_images(update_task):
@@ -689,7 +1339,8 @@ class UpdateImages(Resource):
 
         update_task = UpdateImagesTask()
         TASKS[update_task.task_id] = update_task
-        gevent.spawn(update_images, update_task)
+        SCHEDULER.submit(update_task, update_images, update_task,
+                         priority=scheduler.PRIORITY_LOW)
 
         if args['async']:
             result = {'task_id': update_task.task_id}
@@ -716,12 +1367,15 @@ def setup_routes():
 
     api.add_resource(TaskList, '/api/tasks')
     api.add_resource(Task, '/api/tasks/<task_id>')
+    api.add_resource(TaskEvents, '/api/tasks/<task_id>/events')
+    api.add_resource(SchedulerStats, '/api/scheduler')
 
     api.add_resource(BackupList, '/api/backups')
     api.add_resource(Backup, '/api/backups/<backup_id>')
     api.add_resource(BackupData, '/api/backups/<backup_id>/data')
 
     api.add_resource(ServerList, '/api/servers')
+    api.add_resource(ServerEvacuate, '/api/servers/<server_addr>/evacuate')
 
     api.add_resource(UpdateImages, '/api/update_images')
 
@@ -755,16 +1409,14 @@ def list_servers():
 @app.route('/groups', methods=['GET'])
 @app.route('/', methods=['GET'])
 def list_groups():
-    blueprints = sense.Sense.blueprints()
     services = sense.Sense.services()
     result = {}
-    for group_id in blueprints:
-        result[group_id] = group_to_dict(group_id)
+    for group_id, group in group_views().items():
         mem = 0
         if group_id in services:
             mem = max([i['mem_used']
                        for i in services[group_id]['instances'].values()])
-        result[group_id]['mem_used'] = mem
+        result[group_id] = dict(group, mem_used=mem)
 
     return flask.render_template('group_list.html', groups=result.values())
 
@@ -887,7 +1539,16 @@ def get_config(config_file):
             'CREATE_NETWORK_AUTOMATICALLY', 'GATEWAY_IP',
             'BACKUP_STORAGE_TYPE', 'BACKUP_BASE_DIR',
             'BACKUP_HOST', 'BACKUP_IDENTITY', 'BACKUP_USER',
-            'SSL_KEYFILE', 'SSL_CERTFILE']
+            'BACKUP_SSH_KNOWN_HOSTS', 'BACKUP_SSH_HOST_KEY_POLICY',
+            'BACKUP_COMPRESSION', 'BACKUP_COMPRESSION_LEVEL',
+            'BACKUP_S3_BUCKET', 'BACKUP_S3_ENDPOINT', 'BACKUP_S3_REGION',
+            'BACKUP_S3_ACCESS_KEY', 'BACKUP_S3_SECRET_KEY',
+            'BACKUP_S3_CONCURRENCY',
+            'BACKUP_MAX_CHAIN_LENGTH', 'XLOG_ARCHIVE_INTERVAL',
+            'SSL_KEYFILE', 'SSL_CERTFILE', 'RECONCILE_INTERVAL',
+            'SCHEDULER_CONCURRENCY', 'SCHEDULER_HOST_CONCURRENCY',
+            'TASK_ARCHIVE_PATH', 'TASK_ARCHIVE_SIZE', 'TASK_CACHE_SIZE',
+            'TASK_CACHE_MEMORY', 'TASK_LOG_SIZE', 'TASK_TIMEOUT', 'WORKERS', 'LEADER_KEY']
 
     for opt in opts:
         if opt in os.environ:
@@ -900,6 +1561,8 @@ def main():
     # Don't spam with HTTP connection logs from 'requests' module
     logging.getLogger("requests").setLevel(logging.WARNING)
 
+    metrics.instrument_clients()
+
     logging.basicConfig(format='%(levelname)s: %(message)s',
                         level=logging.INFO)
 
@@ -957,10 +1620,51 @@ def main():
         backup_config = {'base_dir': cfg.get('BACKUP_BASE_DIR', None),
                          'host': cfg.get('BACKUP_HOST', None),
                          'user': cfg.get('BACKUP_USER', None),
-                         'identity': cfg.get('BACKUP_IDENTITY', None)}
+                         'identity': cfg.get('BACKUP_IDENTITY', None),
+                         'known_hosts': cfg.get('BACKUP_SSH_KNOWN_HOSTS',
+                                                None),
+                         'host_key_policy':
+                         cfg.get('BACKUP_SSH_HOST_KEY_POLICY', None),
+                         'compression': cfg.get('BACKUP_COMPRESSION', None),
+                         'compression_level':
+                         cfg.get('BACKUP_COMPRESSION_LEVEL', None),
+                         'bucket': cfg.get('BACKUP_S3_BUCKET', None),
+                         'endpoint': cfg.get('BACKUP_S3_ENDPOINT', None),
+                         'region': cfg.get('BACKUP_S3_REGION', None),
+                         'access_key': cfg.get('BACKUP_S3_ACCESS_KEY', None),
+                         'secret_key': cfg.get('BACKUP_S3_SECRET_KEY', None),
+                         'concurrency': cfg.get('BACKUP_S3_CONCURRENCY',
+                                                None)}
         global_env.backup_storage = backup_storage.create(
             cfg['BACKUP_STORAGE_TYPE'], backup_config)
 
+    if 'BACKUP_MAX_CHAIN_LENGTH' in cfg:
+        tarantool.MAX_BACKUP_CHAIN_LENGTH = int(cfg['BACKUP_MAX_CHAIN_LENGTH'])
+
+    if 'TASK_LOG_SIZE' in cfg:
+        task.LOG_SIZE = int(cfg['TASK_LOG_SIZE'])
+
+    if 'TASK_ARCHIVE_PATH' in cfg:
+        TASKS.archive_path = os.path.expanduser(cfg['TASK_ARCHIVE_PATH'])
+
+    if 'TASK_ARCHIVE_SIZE' in cfg:
+        TASKS.max_archive_size = int(cfg['TASK_ARCHIVE_SIZE'])
+
+    if 'TASK_CACHE_SIZE' in cfg:
+        TASKS.max_count = int(cfg['TASK_CACHE_SIZE'])
+
+    if 'TASK_CACHE_MEMORY' in cfg:
+        TASKS.max_memory = int(cfg['TASK_CACHE_MEMORY'])
+
+    if 'SCHEDULER_CONCURRENCY' in cfg:
+        SCHEDULER.concurrency = int(cfg['SCHEDULER_CONCURRENCY'])
+
+    if 'SCHEDULER_HOST_CONCURRENCY' in cfg:
+        SCHEDULER.host_concurrency = int(cfg['SCHEDULER_HOST_CONCURRENCY'])
+
+    if 'TASK_TIMEOUT' in cfg:
+        SCHEDULER.task_timeout = int(cfg['TASK_TIMEOUT']) or None
+
     ssl_args = {}
 
     if 'SSL_KEYFILE' in cfg:
@@ -977,21 +1681,139 @@ def main():
 
     setup_routes()
 
-    gevent.spawn(sense.Sense.timer_update)
-    gevent.spawn(ip_pool.ip_cache_invalidation_loop)
+    # Automatic repairs are off unless asked for
+    reconcile_interval = int(cfg.get('RECONCILE_INTERVAL', 0))
+    xlog_archive_interval = int(cfg.get('XLOG_ARCHIVE_INTERVAL', 0))
+    num_workers = int(cfg.get('WORKERS', 1))
+
+    if num_workers > 1:
+        leader_key = cfg.get('LEADER_KEY', 'taas/leader')
+        run_workers(num_workers, leader_key, listen_addr, listen_port,
+                    ssl_args, reconcile_interval, xlog_archive_interval)
+        return
+
+    start_background_loops()
+    start_cluster_loops(reconcile_interval, xlog_archive_interval)
 
     if listen_addr.startswith('unix:/'):
         listen_on = (listen_addr,)
     else:
         listen_on = (listen_addr, int(listen_port))
 
-    http_server = WSGIServer(listen_on, app, **ssl_args)
+    http_server = WSGIServer(listen_on, app,
+                             handler_class=fileserve.SendfileHandler,
+                             **ssl_args)
 
     logging.info("Listening on: %s", listen_on)
 
     http_server.serve_forever()
 
 
+def start_background_loops():
+    try:
+        backup_catalog.migrate()
+    except Exception:
+        logging.exception("Failed to move backups to the backup catalog")
+
+    gevent.spawn(sense.Sense.timer_update)
+    gevent.spawn(ip_pool.ip_cache_invalidation_loop)
+
+
+def start_cluster_loops(reconcile_interval, xlog_archive_interval):
+    """
+    Starts the loops that act on all groups, which only one server in the
+    cluster should run
+    """
+    if reconcile_interval > 0:
+        reconciler = reconcile.Reconciler(TASKS, SCHEDULER,
+                                          interval=reconcile_interval)
+        gevent.spawn(reconciler.run)
+
+    if xlog_archive_interval > 0 and global_env.backup_storage:
+        archiver = xlog_archive.XlogArchiver(TASKS,
+                                             global_env.backup_storage,
+                                             xlog_archive_interval)
+        gevent.spawn(archiver.run)
+
+
+def run_workers(num_workers, leader_key, listen_addr, listen_port, ssl_args,
+                reconcile_interval, xlog_archive_interval):
+    """
+    Serves requests from several processes sharing one listening socket.
+
+    One of the workers holds a leader lock of this host in Consul. It
+    refreshes the snapshot and publishes it for the others, runs the
+    scheduler, and keeps the tasks. The others serve read requests from
+    the published snapshot and pass the rest to the leader over a unix
+    socket. If the leader exits, another worker takes over.
+
+    The leader of one host in the cluster also takes the cluster-wide
+    lock under 'leader_key' and runs the reconciler and the xlog archiver.
+    """
+    listener = workers.listen(listen_addr, listen_port)
+    state_dir = workers.state_dir()
+    snapshot_path = os.path.join(state_dir, workers.SNAPSHOT_FILE)
+    leader_socket = os.path.join(state_dir, workers.LEADER_SOCKET)
+
+    def lead(follower):
+        global LEADER_SOCKET
+
+        lock = workers.LeaderLock(leader_key + '/' + socket.gethostname())
+        lock.acquire()
+
+        logging.info("Worker %d is the leader", os.getpid())
+        follower.kill()
+        LEADER_SOCKET = None
+
+        start_background_loops()
+        if reconcile_interval > 0 or xlog_archive_interval > 0:
+            gevent.spawn(lead_cluster)
+        gevent.spawn(workers.publish_loop, snapshot_path)
+        WSGIServer(workers.listen('unix://' + leader_socket), app).start()
+
+        lock.hold()
+
+        # Tasks of this worker can't be handed over, so the supervisor
+        # starts a fresh one in its place
+        logging.error("Worker %d lost the leader lock, exiting", os.getpid())
+        os._exit(1)
+
+    def lead_cluster():
+        lock = workers.LeaderLock(leader_key)
+        lock.acquire()
+
+        logging.info("Worker %d is the cluster leader", os.getpid())
+        start_cluster_loops(reconcile_interval, xlog_archive_interval)
+
+        lock.hold()
+
+        # Repairs in progress can't be handed over either
+        logging.error("Worker %d lost the cluster leader lock, exiting",
+                      os.getpid())
+        os._exit(1)
+
+    def worker():
+        global LEADER_SOCKET
+        LEADER_SOCKET = leader_socket
+
+        gevent.spawn(workers.watch_parent)
+        follower = gevent.spawn(workers.follow_loop, snapshot_path)
+        gevent.spawn(lead, follower)
+
+        http_server = WSGIServer(listener, app,
+                                 handler_class=fileserve.SendfileHandler,
+                                 **ssl_args)
+        http_server.serve_forever()
+
+    logging.info("Listening on: %s with %d workers",
+                 (listen_addr, listen_port), num_workers)
+
+    try:
+        workers.run(num_workers, worker)
+    finally:
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+
 
 if __name__ == '__main__':
     main()
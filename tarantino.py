@@ -17,6 +17,7 @@ import json
 import task
 import tarfile
 import io
+import offload
 
 
 def tar_string(filename, data):
@@ -79,6 +80,7 @@ class Tarantino(group.Group):
 
             create_task.log("Creating group '%s'", group_id)
 
+            create_task.begin_stage("blueprint")
             ip1 = ip_pool.allocate_ip()
             creation_time = datetime.datetime.now(
                 datetime.timezone.utc).isoformat()
@@ -96,15 +98,18 @@ class Tarantino(group.Group):
 
             tar = Tarantino(global_env.consul_host, group_id)
 
+            create_task.begin_stage("allocate")
             create_task.log("Allocating instance to physical nodes")
 
             tar.allocate()
             Sense.update()
 
+            create_task.begin_stage("register")
             create_task.log("Registering services")
             tar.register()
             Sense.update()
 
+            create_task.begin_stage("create_containers")
             create_task.log("Creating containers")
             tar.create_containers(password)
             Sense.update()
@@ -124,15 +129,19 @@ class Tarantino(group.Group):
         try:
             group_id = self.group_id
 
+            delete_task.begin_stage("unallocate")
             delete_task.log("Unallocating instance")
             self.unallocate()
 
+            delete_task.begin_stage("unregister")
             delete_task.log("Unregistering services")
             self.unregister()
 
+            delete_task.begin_stage("remove_containers")
             delete_task.log("Removing containers")
             self.remove_containers()
 
+            delete_task.begin_stage("remove_blueprint")
             delete_task.log("Removing blueprint")
             self.remove_blueprint()
 
@@ -483,7 +492,8 @@ class Tarantino(group.Group):
             docker_obj = docker.Client(base_url=docker_addr,
                                        tls=global_env.docker_tls_config)
 
-            buf = io.BytesIO(tar_string('service.json', config_str))
+            buf = io.BytesIO(offload.call(tar_string, 'service.json',
+                                          config_str))
             status = docker_obj.put_archive(self.group_id + '_' + instance_num,
                                             '/opt/tarantool',
                                             buf)
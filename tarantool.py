@@ -22,6 +22,14 @@ import io
 import shutil
 import os
 import yaml
+import offload
+import backup_storage
+
+# How long to wait for a started instance to report that it is up
+INSTANCE_UP_TIMEOUT = 1800  # seconds
+# Most backups that a restore may have to go through, the full one
+# included. Backups are incremental until their chain reaches it.
+MAX_BACKUP_CHAIN_LENGTH = 7
 
 def splitext(path):
     for ext in ['.tar.gz', '.tar.bz2']:
@@ -29,6 +37,38 @@ def splitext(path):
             return path[:-len(ext)], path[-len(ext):]
     return os.path.splitext(path)
 
+
+def config_archive(config_data, config_filename):
+    """
+    returns a tar archive with the application config to put into
+    an instance container
+    """
+    config_ext = splitext(config_filename)[1]
+    if config_ext in ('.tar.gz', '.tgz'):
+        return gzip.decompress(config_data)
+
+    bio = io.BytesIO()
+    tar = tarfile.TarFile(fileobj=bio, mode='w')
+    tarinfo = tarfile.TarInfo(name='app.lua')
+    tarinfo.size = len(config_data)
+    tar.addfile(tarinfo, fileobj=io.BytesIO(config_data))
+
+    bio.seek(0)
+    return bio
+
+
+def config_password(archive):
+    """
+    returns the password from a tar archive holding config.yml
+    """
+    tar = tarfile.open(fileobj=io.BytesIO(archive))
+
+    fobj = tar.extractfile('config.yml')
+    config = yaml.load(fobj)
+    if 'TARANTOOL_USER_PASSWORD' in config:
+        return config['TARANTOOL_USER_PASSWORD']
+    return None
+
 class TarantoolTask(task.Task):
     tarantool_task_type = None
     def __init__(self, group_id):
@@ -75,6 +115,7 @@ class Tarantool(group.Group):
 
             create_task.log("Creating group '%s'", group_id)
 
+            create_task.begin_stage("blueprint")
             ip1 = ip_pool.allocate_ip()
             ip2 = ip_pool.allocate_ip()
             creation_time = datetime.datetime.now(datetime.timezone.utc).isoformat()
@@ -91,21 +132,26 @@ class Tarantool(group.Group):
 
             tar = Tarantool(global_env.consul_host, group_id)
 
+            create_task.begin_stage("allocate")
             create_task.log("Allocating instance to physical nodes")
 
             tar.allocate()
             Sense.update()
 
+            create_task.begin_stage("register")
             create_task.log("Registering services")
             tar.register()
             Sense.update()
 
+            create_task.begin_stage("create_containers")
             create_task.log("Creating containers")
             tar.create_containers(password)
             Sense.update()
 
+            create_task.begin_stage("wait_for_instances")
             create_task.log("Enabling replication")
             tar.wait_for_instances(create_task)
+            create_task.begin_stage("enable_replication")
             tar.enable_replication()
 
             create_task.log("Completed creating group")
@@ -123,15 +169,19 @@ class Tarantool(group.Group):
         try:
             group_id = self.group_id
 
+            delete_task.begin_stage("remove_containers")
             delete_task.log("Removing containers")
             self.remove_containers()
 
+            delete_task.begin_stage("unregister")
             delete_task.log("Unregistering services")
             self.unregister()
 
+            delete_task.begin_stage("unallocate")
             delete_task.log("Unallocating instance")
             self.unallocate()
 
+            delete_task.begin_stage("remove_blueprint")
             delete_task.log("Removing blueprint")
             self.remove_blueprint()
 
@@ -166,7 +216,8 @@ class Tarantool(group.Group):
             raise
 
     def update(self, name, memsize, password, config_data, config_filename,
-               docker_image_name, heal, backup_id, storage, update_task):
+               docker_image_name, heal, backup_id, storage, update_task,
+               replay_xlogs=False):
         try:
             if heal:
                 self.heal(update_task)
@@ -195,7 +246,7 @@ class Tarantool(group.Group):
                 self.upgrade(update_task)
 
             if backup_id:
-                self.restore(backup_id, storage, update_task)
+                self.restore(backup_id, storage, update_task, replay_xlogs)
 
             Sense.update()
             update_task.set_status(task.STATUS_SUCCESS)
@@ -205,7 +256,7 @@ class Tarantool(group.Group):
 
             raise
 
-    def heal(self, update_task):
+    def heal(self, update_task, host=None):
         blueprint = self.blueprint
         allocation = self.allocation
         containers = self.containers
@@ -227,15 +278,25 @@ class Tarantool(group.Group):
         if password is not None:
             update_task.log("Will set password for %s", instance_num)
 
+        update_task.begin_stage("heal_unregister")
         update_task.log("Unregistering container %s", instance_num)
         self.unregister_instance(instance_num)
 
+        update_task.begin_stage("heal_disconnect")
         update_task.log("Disconnecting container %s", instance_num)
         self.disconnect_instance(instance_num)
 
+        if host:
+            update_task.begin_stage("heal_reallocate")
+            update_task.log("Moving container %s to '%s'", instance_num, host)
+            self.reallocate_instance(instance_num, host)
+            Sense.update()
+
+        update_task.begin_stage("heal_copy_code")
         code_link = self.get_instance_current_code(other_instance_num)
         code = self.get_instance_code(other_instance_num, code_link)
 
+        update_task.begin_stage("heal_create_container")
         update_task.log("Creating container %s", instance_num)
         self.create_container(instance_num, other_instance_num,
                               password=password)
@@ -243,9 +304,11 @@ class Tarantool(group.Group):
         Sense.update()
 
         if code_link:
+            update_task.begin_stage("heal_restore_code")
             update_task.log('Recovering code: %s', code_link)
             self.set_instance_code(instance_num, code, code_link)
 
+        update_task.begin_stage("heal_register")
         update_task.log("Registring container %s", instance_num)
         self.register_instance(instance_num)
 
@@ -318,7 +381,7 @@ class Tarantool(group.Group):
         self.unregister_instance("1")
         self.unregister_instance("2")
 
-    def backup(self, backup_task, storage):
+    def backup(self, backup_task, storage, full=False):
         try:
             services = self.services
             backup_id = backup_task.backup_id
@@ -345,17 +408,10 @@ class Tarantool(group.Group):
             docker_obj = docker.Client(base_url=docker_addr,
                                        tls=global_env.docker_tls_config)
 
-            cmd = 'ls /var/lib/tarantool'
-            exec_id = docker_obj.exec_create(self.group_id + '_' + instance_num,
-                                             cmd)
-            out = docker_obj.exec_start(exec_id)
-            ret = docker_obj.exec_inspect(exec_id)
-
-            if ret['ExitCode'] != 0:
-                raise RuntimeError("Failed to list snapshots for container " +
-                                   instance_id)
+            backup_task.begin_stage("list_files")
+            file_sizes = self.list_data_files(docker_obj, instance_num)
 
-            files = list(filter(None, out.decode('utf-8').split('\n')))
+            files = list(file_sizes)
             snapshots = [f for f in files if f.endswith('.snap')]
             snapshot_lsns = sorted([os.path.splitext(s)[0] for s in snapshots])
             xlogs = [f for f in files if f.endswith('.xlog')]
@@ -378,6 +434,19 @@ class Tarantool(group.Group):
             files_to_backup = [latest_snapshot_lsn + '.snap']
             files_to_backup += [xlog + '.xlog' for xlog in xlogs_to_backup]
 
+            parent_id = None
+            if not full:
+                parent_id, chain_files = self.backup_parent(storage,
+                                                            file_sizes)
+
+            if parent_id is not None:
+                # The newest xlog of the chain may have grown since
+                newest_xlog = max(f for f in chain_files if f.endswith('.xlog'))
+                files_to_backup = [f for f in files_to_backup
+                                   if f not in chain_files or f == newest_xlog]
+                backup_task.log("Backing up incrementally on top of '%s'",
+                                parent_id)
+
             backup_task.log("Backing up data: %s", ', '.join(files_to_backup))
 
             cmd = 'ls /opt/deploy'
@@ -398,10 +467,47 @@ class Tarantool(group.Group):
             else:
                 backup_task.log("No code to back up")
 
+            backup_task.begin_stage("prepare")
             tmp_backup_dir = '/var/lib/tarantool/backup-' + uuid.uuid4().hex
 
-            for dirname in ["%s", "%s/code", "%s/data"]:
-                cmd = "mkdir -p '%s'" % (dirname % tmp_backup_dir)
+            try:
+                for dirname in ["%s", "%s/code", "%s/data"]:
+                    cmd = "mkdir -p '%s'" % (dirname % tmp_backup_dir)
+                    exec_id = docker_obj.exec_create(
+                        self.group_id + '_' + instance_num, cmd)
+                    out = docker_obj.exec_start(exec_id)
+                    ret = docker_obj.exec_inspect(exec_id)
+
+                    if ret['ExitCode'] != 0:
+                        raise RuntimeError(
+                            "Failed to create temp dir '%s' for container '%s'" %
+                            (dirname % tmp_backup_dir, instance_id))
+
+                for file_to_backup in files_to_backup:
+                    cmd = "ln /var/lib/tarantool/%s %s/data/%s" % (
+                        file_to_backup, tmp_backup_dir, file_to_backup)
+                    exec_id = docker_obj.exec_create(
+                        self.group_id + '_' + instance_num, cmd)
+                    out = docker_obj.exec_start(exec_id)
+                    ret = docker_obj.exec_inspect(exec_id)
+
+                    if ret['ExitCode'] != 0:
+                        raise RuntimeError(
+                            "Failed to hardlink data file: " + out.decode('utf-8'))
+
+                for code_directory in code_directories:
+                    cmd = "cp -a /opt/deploy/%s %s/code/%s" % (
+                        code_directory, tmp_backup_dir, code_directory)
+                    exec_id = docker_obj.exec_create(
+                        self.group_id + '_' + instance_num, cmd)
+                    out = docker_obj.exec_start(exec_id)
+                    ret = docker_obj.exec_inspect(exec_id)
+
+                    if ret['ExitCode'] != 0:
+                        raise RuntimeError(
+                            "Failed copy code dir: " + out.decode('utf-8'))
+
+                cmd = "cp -dp /opt/tarantool %s/current" % tmp_backup_dir
                 exec_id = docker_obj.exec_create(
                     self.group_id + '_' + instance_num, cmd)
                 out = docker_obj.exec_start(exec_id)
@@ -409,86 +515,203 @@ class Tarantool(group.Group):
 
                 if ret['ExitCode'] != 0:
                     raise RuntimeError(
-                        "Failed to create temp dir '%s' for container '%s'" %
-                        (dirname % tmp_backup_dir, instance_id))
+                        "Failed copy code symlink: " + out.decode('utf-8'))
+
+                backup_task.begin_stage("stream_archive")
+                backup_task.check_cancelled()
+                strm, _ = docker_obj.get_archive(instance_id, tmp_backup_dir+'/.')
+                archive_id, size = storage.put_archive(
+                    task.CancellableStream(strm, backup_task))
+            finally:
+                self.remove_temp_dir(docker_obj, instance_num,
+                                     tmp_backup_dir)
+
+            backup_task.begin_stage("register_backup")
+            mem_used = services['instances'][instance_num]['mem_used']
+            storage.register_backup(backup_id, archive_id, group_id,
+                                    'tarantool', size, mem_used,
+                                    parent_id=parent_id,
+                                    files={f: file_sizes[f]
+                                           for f in files_to_backup})
 
-            for file_to_backup in files_to_backup:
-                cmd = "ln /var/lib/tarantool/%s %s/data/%s" % (
-                    file_to_backup, tmp_backup_dir, file_to_backup)
-                exec_id = docker_obj.exec_create(
-                    self.group_id + '_' + instance_num, cmd)
-                out = docker_obj.exec_start(exec_id)
-                ret = docker_obj.exec_inspect(exec_id)
+            Sense.update()
 
-                if ret['ExitCode'] != 0:
-                    raise RuntimeError(
-                        "Failed to hardlink data file: " + out.decode('utf-8'))
+            backup_task.set_status(task.STATUS_SUCCESS)
+        except Exception as ex:
+            logging.exception("Failed to backup '%s'", group_id)
+            backup_task.set_status(task.STATUS_CRITICAL, str(ex))
 
-            for code_directory in code_directories:
-                cmd = "cp -a /opt/deploy/%s %s/code/%s" % (
-                    code_directory, tmp_backup_dir, code_directory)
-                exec_id = docker_obj.exec_create(
-                    self.group_id + '_' + instance_num, cmd)
-                out = docker_obj.exec_start(exec_id)
-                ret = docker_obj.exec_inspect(exec_id)
+    def list_data_files(self, docker_obj, instance_num):
+        """
+        returns {name: size} of the files in the data dir of an instance
+        """
+        instance_id = self.group_id + '_' + instance_num
 
-                if ret['ExitCode'] != 0:
-                    raise RuntimeError(
-                        "Failed copy code dir: " + out.decode('utf-8'))
+        cmd = "sh -c 'cd /var/lib/tarantool && stat -c \"%n %s\" *'"
+        exec_id = docker_obj.exec_create(instance_id, cmd)
+        out = docker_obj.exec_start(exec_id)
+        ret = docker_obj.exec_inspect(exec_id)
+
+        if ret['ExitCode'] != 0:
+            raise RuntimeError("Failed to list snapshots for container " +
+                               instance_id)
+
+        file_sizes = {}
+        for line in filter(None, out.decode('utf-8').split('\n')):
+            name, size = line.rsplit(' ', 1)
+            file_sizes[name] = int(size)
+
+        return file_sizes
+
+    def archive_xlogs(self, storage, xlogs, start):
+        """
+        Archives the xlogs that tarantool has closed, starting with the
+        one named 'start', so that restores can replay them. 'xlogs' are
+        the records of the xlogs archived so far. Returns the names of
+        the newly archived ones.
+        """
+        instance_num = '1'
+        instance_id = self.group_id + '_' + instance_num
+        docker_host = self.allocation['instances'][instance_num]['host']
 
-            cmd = "cp -dp /opt/tarantool %s/current" % tmp_backup_dir
-            exec_id = docker_obj.exec_create(
-                self.group_id + '_' + instance_num, cmd)
-            out = docker_obj.exec_start(exec_id)
-            ret = docker_obj.exec_inspect(exec_id)
+        docker_addr = None
+        for host in Sense.docker_hosts():
+            if host['addr'].split(':')[0] == docker_host or \
+               host['consul_host'] == docker_host:
+                docker_addr = host['addr']
 
-            if ret['ExitCode'] != 0:
-                raise RuntimeError(
-                    "Failed copy code symlink: " + out.decode('utf-8'))
+        if not docker_addr:
+            raise RuntimeError("No such Docker host: '%s'" % docker_host)
+
+        docker_obj = docker.Client(base_url=docker_addr,
+                                   tls=global_env.docker_tls_config)
+
+        file_sizes = self.list_data_files(docker_obj, instance_num)
+        # All but the newest xlog are closed and won't change any more
+        on_disk = sorted(f for f in file_sizes if f.endswith('.xlog'))
+
+        archived = []
+        for name, next_name in zip(on_disk, on_disk[1:]):
+            if name < start:
+                continue
+
+            record = xlogs.get(name)
+            if record is not None and record['size'] == file_sizes[name]:
+                continue
+
+            if record is not None:
+                # The instance was restored and its history forked here:
+                # archived xlogs after this one are of the old history
+                for other in sorted(xlogs):
+                    if other >= name:
+                        storage.unregister_xlog(self.group_id, other,
+                                                xlogs.pop(other))
 
-            strm, _ = docker_obj.get_archive(instance_id, tmp_backup_dir+'/.')
+            strm, _ = docker_obj.get_archive(instance_id,
+                                             '/var/lib/tarantool/' + name)
             archive_id, size = storage.put_archive(strm)
+            storage.register_xlog(self.group_id, name, archive_id,
+                                  file_sizes[name], next_name)
+            xlogs[name] = {'archive_id': archive_id, 'size': file_sizes[name],
+                           'next': next_name}
+            archived.append(name)
+
+        return archived
+
+    def backup_parent(self, storage, file_sizes):
+        """
+        Picks the backup that an incremental backup of the instance with
+        data files 'file_sizes' can build on: the latest one of the group,
+        unless its chain is at the length limit. Returns its id and the
+        {name: size} of data files in its chain, or (None, {}) if a full
+        backup has to be made.
+        """
+        if MAX_BACKUP_CHAIN_LENGTH < 2:
+            return None, {}
+
+        backups = Sense.backups()
+        candidates = [backup_id for backup_id in
+                      Sense.group_backups().get(self.group_id, [])
+                      if backups[backup_id]['type'] == 'tarantool' and
+                      backups[backup_id]['storage'] ==
+                      storage.backup_storage_type and
+                      backups[backup_id]['files'] is not None]
+        if not candidates:
+            return None, {}
+
+        # Backups of a group are listed oldest first
+        parent_id = candidates[-1]
+        try:
+            chain = backup_storage.backup_chain(backups, parent_id,
+                                                MAX_BACKUP_CHAIN_LENGTH)
+        except RuntimeError:
+            return None, {}
 
-            cmd = "rm -rf /var/lib/tarantool/backup-*"
-            exec_id = docker_obj.exec_create(self.group_id + '_' + instance_num,
-                                             cmd)
-            out = docker_obj.exec_start(exec_id)
-            ret = docker_obj.exec_inspect(exec_id)
+        # A full backup starts a new chain, so restores never need more
+        # than MAX_BACKUP_CHAIN_LENGTH archives
+        if len(chain) >= MAX_BACKUP_CHAIN_LENGTH:
+            return None, {}
 
-            if ret['ExitCode'] != 0:
-                raise RuntimeError(
-                    "Failed to remove temp backup dir for container " +
-                    instance_id)
+        chain_files = backup_storage.chain_files(backups, chain)
 
-            mem_used = services['instances'][instance_num]['mem_used']
-            storage.register_backup(backup_id, archive_id, group_id,
-                                    'memcached', size, mem_used)
+        xlogs = [f for f in chain_files if f.endswith('.xlog')]
+        if not xlogs:
+            return None, {}
 
-            Sense.update()
+        # Files of the same name but of another size mean that the
+        # instance was restored from some other backup since
+        newest_xlog = max(xlogs)
+        for name, size in chain_files.items():
+            if name != newest_xlog and name in file_sizes and \
+               file_sizes[name] != size:
+                return None, {}
 
-            backup_task.set_status(task.STATUS_SUCCESS)
-        except Exception as ex:
-            logging.exception("Failed to backup '%s'", group_id)
-            backup_task.set_status(task.STATUS_CRITICAL, str(ex))
+        return parent_id, chain_files
 
-    def restore(self, backup_id, storage, restore_task):
+    def restore(self, backup_id, storage, restore_task, replay_xlogs=False):
         blueprint = self.blueprint
         services = self.services
         group_id = self.group_id
 
         restore_task.log("Restoring group '%s'", group_id)
 
-        backup = Sense.backups()[backup_id]
-        archive_id = backup['archive_id']
-        mem_used = backup['mem_used']
+        backups = Sense.backups()
+        mem_used = backups[backup_id]['mem_used']
 
         try:
+            # An incremental backup is restored by unpacking the archives
+            # of its chain in order, later files replacing earlier ones
+            chain = backup_storage.backup_chain(backups, backup_id)
+            archive_ids = [backups[b]['archive_id'] for b in chain]
+            if len(chain) > 1:
+                restore_task.log("Restoring backup chain: %s",
+                                 ', '.join(chain))
+
+            # Archived xlogs bring the data up to the latest one archived
+            replay_ids = []
+            if replay_xlogs:
+                backup_group_id = backups[backup_id]['group_id']
+                xlogs = backup_storage.archived_xlogs(
+                    backup_group_id).get(backup_group_id, {})
+                replay = backup_storage.replay_xlogs(
+                    xlogs, backup_storage.chain_files(backups, chain))
+                replay_ids = [xlogs[name]['archive_id'] for name in replay]
+
+                if replay:
+                    restore_task.log("Replaying archived xlogs up to '%s'",
+                                     replay[-1])
+                else:
+                    restore_task.log("No archived xlogs to replay")
+
+            data_dirs = len(archive_ids) + (1 if replay_ids else 0)
+
             for instance_num in ('1', '2'):
                 allocation = self.allocation
                 instance_id = self.group_id + '_' + instance_num
                 docker_host = allocation['instances'][instance_num]['host']
                 docker_hosts = Sense.docker_hosts()
 
+                restore_task.check_cancelled()
                 restore_task.log("Restoring instance: '%s'", instance_id)
 
                 docker_addr = None
@@ -507,129 +730,156 @@ class Tarantool(group.Group):
                     err = ("Backed up instance used {} MiB of RAM, but " +
                            "instance {} only has {} MiB max").format(
                                mem_used, group_id, blueprint['memsize'])
-                    restore_task.set_status(task.STATUS_CRITICAL, err)
-                    return
+                    raise RuntimeError(err)
 
+                restore_task.begin_stage("restore_prepare")
                 tmp_restore_dir = '/var/lib/tarantool/restore-' + uuid.uuid4().hex
 
-                cmd = "mkdir '%s'" % tmp_restore_dir
-                exec_id = docker_obj.exec_create(
-                    self.group_id + '_' + instance_num, cmd)
-                out = docker_obj.exec_start(exec_id)
-                ret = docker_obj.exec_inspect(exec_id)
-
-                if ret['ExitCode'] != 0:
-                    raise RuntimeError(
-                        "Failed to create temp restore dir for container " +
-                        instance_id + ": " + out.decode('utf-8'))
-
-                stream = storage.get_archive(archive_id)
-
-                docker_obj.put_archive(instance_id, tmp_restore_dir, stream)
-
-                cmd = "sh -c 'rm -rf /var/lib/tarantool/*.snap'"
-                exec_id = docker_obj.exec_create(
-                    self.group_id + '_' + instance_num, cmd)
-                out = docker_obj.exec_start(exec_id)
-                ret = docker_obj.exec_inspect(exec_id)
-
-                if ret['ExitCode'] != 0:
-                    raise RuntimeError(
-                        "Failed to remove existing snap files of " +
-                        instance_id + ": " + out.decode('utf-8'))
-
-                cmd = "sh -c 'rm -rf /var/lib/tarantool/*.xlog'"
-                exec_id = docker_obj.exec_create(
-                    self.group_id + '_' + instance_num, cmd)
-                out = docker_obj.exec_start(exec_id)
-                ret = docker_obj.exec_inspect(exec_id)
-
-                if ret['ExitCode'] != 0:
-                    raise RuntimeError(
-                        "Failed to remove existing xlog files of " +
-                        instance_id + ": " + out.decode('utf-8'))
-
-                cmd = "ln -snf / /opt/tarantool"
-                exec_id = docker_obj.exec_create(
-                    self.group_id + '_' + instance_num, cmd)
-                out = docker_obj.exec_start(exec_id)
-                ret = docker_obj.exec_inspect(exec_id)
-
-                if ret['ExitCode'] != 0:
-                    raise RuntimeError(
-                        "Failed to re-point working dir " +
-                        instance_id + ": " + out.decode('utf-8'))
-
-                cmd = "sh -c 'rm -rf /opt/deploy/*'"
-                exec_id = docker_obj.exec_create(
-                    self.group_id + '_' + instance_num, cmd)
-                out = docker_obj.exec_start(exec_id)
-                ret = docker_obj.exec_inspect(exec_id)
-
-                if ret['ExitCode'] != 0:
-                    raise RuntimeError(
-                        "Failed to remove existing code files of " +
-                        instance_id + ": " + out.decode('utf-8'))
-
-                cmd = "sh -c 'mv %s/data/* /var/lib/tarantool'" % \
-                      tmp_restore_dir
-                exec_id = docker_obj.exec_create(
-                    self.group_id + '_' + instance_num, cmd)
-                out = docker_obj.exec_start(exec_id)
-                ret = docker_obj.exec_inspect(exec_id)
-
-                if ret['ExitCode'] != 0:
-                    raise RuntimeError(
-                        "Failed to restore data of " +
-                        instance_id + ": " + out.decode('utf-8'))
-
-                cmd = "sh -c 'mv %s/code/* /opt/deploy'" % \
-                      tmp_restore_dir
-                exec_id = docker_obj.exec_create(
-                    self.group_id + '_' + instance_num, cmd)
-                out = docker_obj.exec_start(exec_id)
-                ret = docker_obj.exec_inspect(exec_id)
-
-                if ret['ExitCode'] != 0:
-                    raise RuntimeError(
-                        "Failed to restore code of " +
-                        instance_id + ": " + out.decode('utf-8'))
-
-                _, stat = docker_obj.get_archive(instance_id,
-                                                 '%s/current' % tmp_restore_dir)
-                code_link = stat['linkTarget']
-
-                cmd = "ln -snf '%s' /opt/tarantool" % code_link
-                exec_id = docker_obj.exec_create(
-                    self.group_id + '_' + instance_num, cmd)
-                out = docker_obj.exec_start(exec_id)
-                ret = docker_obj.exec_inspect(exec_id)
-
-                if ret['ExitCode'] != 0:
-                    raise RuntimeError(
-                        "Failed to restore current code link of " +
-                        instance_id + ": " + out.decode('utf-8'))
-
-                cmd = "rm -rf '%s'" % tmp_restore_dir
-                exec_id = docker_obj.exec_create(
-                    self.group_id + '_' + instance_num, cmd)
-                out = docker_obj.exec_start(exec_id)
-                ret = docker_obj.exec_inspect(exec_id)
-
-                if ret['ExitCode'] != 0:
-                    raise RuntimeError(
-                        "Failed to remove tmp restore dir of " +
-                        instance_id + ": " + out.decode('utf-8'))
-
+                try:
+                    cmd = "mkdir -p " + ' '.join(
+                        "'%s/%d/data'" % (tmp_restore_dir, index)
+                        for index in range(data_dirs))
+                    exec_id = docker_obj.exec_create(
+                        self.group_id + '_' + instance_num, cmd)
+                    out = docker_obj.exec_start(exec_id)
+                    ret = docker_obj.exec_inspect(exec_id)
+
+                    if ret['ExitCode'] != 0:
+                        raise RuntimeError(
+                            "Failed to create temp restore dir for container " +
+                            instance_id + ": " + out.decode('utf-8'))
+
+                    restore_task.begin_stage("restore_stream_archive")
+                    for index, archive_id in enumerate(archive_ids):
+                        stream = task.CancellableStream(
+                            storage.get_archive(archive_id), restore_task)
+                        try:
+                            docker_obj.put_archive(
+                                instance_id,
+                                '%s/%d' % (tmp_restore_dir, index), stream)
+                        finally:
+                            stream.close()
+
+                    # Xlogs are unpacked after the chain, so they replace
+                    # the partial copies of the ones being written to
+                    for archive_id in replay_ids:
+                        stream = task.CancellableStream(
+                            storage.get_archive(archive_id), restore_task)
+                        try:
+                            docker_obj.put_archive(
+                                instance_id, '%s/%d/data' % (
+                                    tmp_restore_dir, len(archive_ids)),
+                                stream)
+                        finally:
+                            stream.close()
+
+                    # Code comes from the latest backup only
+                    latest_dir = '%s/%d' % (tmp_restore_dir,
+                                            len(archive_ids) - 1)
+
+                    restore_task.begin_stage("restore_replace_files")
+                    cmd = "sh -c 'rm -rf /var/lib/tarantool/*.snap'"
+                    exec_id = docker_obj.exec_create(
+                        self.group_id + '_' + instance_num, cmd)
+                    out = docker_obj.exec_start(exec_id)
+                    ret = docker_obj.exec_inspect(exec_id)
+
+                    if ret['ExitCode'] != 0:
+                        raise RuntimeError(
+                            "Failed to remove existing snap files of " +
+                            instance_id + ": " + out.decode('utf-8'))
+
+                    cmd = "sh -c 'rm -rf /var/lib/tarantool/*.xlog'"
+                    exec_id = docker_obj.exec_create(
+                        self.group_id + '_' + instance_num, cmd)
+                    out = docker_obj.exec_start(exec_id)
+                    ret = docker_obj.exec_inspect(exec_id)
+
+                    if ret['ExitCode'] != 0:
+                        raise RuntimeError(
+                            "Failed to remove existing xlog files of " +
+                            instance_id + ": " + out.decode('utf-8'))
+
+                    cmd = "ln -snf / /opt/tarantool"
+                    exec_id = docker_obj.exec_create(
+                        self.group_id + '_' + instance_num, cmd)
+                    out = docker_obj.exec_start(exec_id)
+                    ret = docker_obj.exec_inspect(exec_id)
+
+                    if ret['ExitCode'] != 0:
+                        raise RuntimeError(
+                            "Failed to re-point working dir " +
+                            instance_id + ": " + out.decode('utf-8'))
+
+                    cmd = "sh -c 'rm -rf /opt/deploy/*'"
+                    exec_id = docker_obj.exec_create(
+                        self.group_id + '_' + instance_num, cmd)
+                    out = docker_obj.exec_start(exec_id)
+                    ret = docker_obj.exec_inspect(exec_id)
+
+                    if ret['ExitCode'] != 0:
+                        raise RuntimeError(
+                            "Failed to remove existing code files of " +
+                            instance_id + ": " + out.decode('utf-8'))
+
+                    for index in range(data_dirs):
+                        cmd = "sh -c 'mv -f %s/%d/data/* /var/lib/tarantool'" % \
+                              (tmp_restore_dir, index)
+                        exec_id = docker_obj.exec_create(
+                            self.group_id + '_' + instance_num, cmd)
+                        out = docker_obj.exec_start(exec_id)
+                        ret = docker_obj.exec_inspect(exec_id)
+
+                        if ret['ExitCode'] != 0:
+                            raise RuntimeError(
+                                "Failed to restore data of " +
+                                instance_id + ": " + out.decode('utf-8'))
+
+                    cmd = "sh -c 'mv %s/code/* /opt/deploy'" % \
+                          latest_dir
+                    exec_id = docker_obj.exec_create(
+                        self.group_id + '_' + instance_num, cmd)
+                    out = docker_obj.exec_start(exec_id)
+                    ret = docker_obj.exec_inspect(exec_id)
+
+                    if ret['ExitCode'] != 0:
+                        raise RuntimeError(
+                            "Failed to restore code of " +
+                            instance_id + ": " + out.decode('utf-8'))
+
+                    _, stat = docker_obj.get_archive(instance_id,
+                                                     '%s/current' % latest_dir)
+                    code_link = stat['linkTarget']
+
+                    cmd = "ln -snf '%s' /opt/tarantool" % code_link
+                    exec_id = docker_obj.exec_create(
+                        self.group_id + '_' + instance_num, cmd)
+                    out = docker_obj.exec_start(exec_id)
+                    ret = docker_obj.exec_inspect(exec_id)
+
+                    if ret['ExitCode'] != 0:
+                        raise RuntimeError(
+                            "Failed to restore current code link of " +
+                            instance_id + ": " + out.decode('utf-8'))
+                finally:
+                    self.remove_temp_dir(docker_obj, instance_num,
+                                         tmp_restore_dir)
+
+                restore_task.begin_stage("restart")
                 restore_task.log("Restarting instance: '%s'", instance_id)
                 docker_obj.restart(container=instance_id)
 
+            restore_task.begin_stage("wait_for_instances")
             restore_task.log("Enabling replication")
             self.wait_for_instances(restore_task)
+            restore_task.begin_stage("enable_replication")
             self.enable_replication()
-        except Exception as ex:
+
+            restore_task.log("Completed restoring group")
+        except Exception:
+            # Restore runs as a step of update(), which sets the status
             logging.exception("Failed to restore backup '%s'", group_id)
-            restore_task.set_status(task.STATUS_CRITICAL, str(ex))
+            raise
 
     def create_containers(self, password):
         self.create_container("1", None, password)
@@ -680,6 +930,7 @@ class Tarantool(group.Group):
 
             cmd = "tarantool_is_up"
             attempts = 0
+            started = time.time()
             while True:
                 exec_id = docker_obj.exec_create(instance_id,
                                                  cmd)
@@ -687,16 +938,22 @@ class Tarantool(group.Group):
 
                 for line in stream:
                     logging.info("Exec: %s", str(line))
+                    wait_task.check_cancelled()
 
                 ret = docker_obj.exec_inspect(exec_id)
 
                 if ret['ExitCode'] == 0:
                     break
 
+                if time.time() - started > INSTANCE_UP_TIMEOUT:
+                    raise RuntimeError(
+                        "Instance '%s' didn't go up in %d seconds" %
+                        (instance_id, INSTANCE_UP_TIMEOUT))
+
                 wait_task.log("Waiting for '%s' to go up. Attempt %d.",
                               instance_id, attempts)
 
-                time.sleep(1)
+                wait_task.sleep(1)
                 attempts += 1
 
 
@@ -1159,18 +1416,7 @@ class Tarantool(group.Group):
 
     def update_instance_config(self, instance_num,
                                config_data, config_filename):
-        config_ext = splitext(config_filename)[1]
-        if config_ext in ('.tar.gz', '.tgz'):
-            tar = gzip.decompress(config_data)
-        else:
-            bio = io.BytesIO()
-            tar = tarfile.TarFile(fileobj=bio, mode='w')
-            tarinfo = tarfile.TarInfo(name='app.lua')
-            tarinfo.size = len(config_data)
-            tar.addfile(tarinfo, fileobj=io.BytesIO(config_data))
-
-            bio.seek(0)
-            tar = bio
+        tar = offload.call(config_archive, config_data, config_filename)
 
         containers = self.containers
 
@@ -1316,14 +1562,7 @@ class Tarantool(group.Group):
                                                     '/etc/tarantool/config.yml')
                 bio = io.BytesIO()
                 shutil.copyfileobj(strm, bio)
-                bio.seek(0)
-                tar = tarfile.open(fileobj=bio)
-
-                fobj = tar.extractfile('config.yml')
-                config = yaml.load(fobj)
-                if 'TARANTOOL_USER_PASSWORD' in config:
-                    return config['TARANTOOL_USER_PASSWORD']
-                return None
+                return offload.call(config_password, bio.getvalue())
             except docker.errors.NotFound:
                 return None
 
@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 
 import uuid
+import time
 import datetime
 import gevent
 import logging
+import metrics
 
 STATUS_RUNNING = "running"
 STATUS_SUCCESS = "success"
@@ -13,16 +15,106 @@ STATUS_CRITICAL = "error"
 
 STATUSES = [STATUS_SUCCESS, STATUS_WARNING, STATUS_CRITICAL, STATUS_RUNNING]
 
+
+class TaskCancelled(Exception):
+    """
+    Raised inside a task's code at a cancellation point once the task has
+    been cancelled or has run past its deadline.
+    """
+    pass
+
+# Rough memory cost of a log entry besides its message, in bytes
+LOG_ENTRY_OVERHEAD = 400
+
+# How many log entries a task retains. Older ones are overwritten.
+LOG_SIZE = 10000
+
+
+class LogBuffer(object):
+    """
+    Ring buffer of log entries. Entries are appended with increasing
+    'index' values, so entries past a given index can be found with a
+    binary search and sliced without scanning the older ones.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.entries = []
+        self.start = 0
+
+    def append(self, entry):
+        if len(self.entries) < self.size:
+            self.entries.append(entry)
+        else:
+            self.entries[self.start] = entry
+            self.start = (self.start + 1) % self.size
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, pos):
+        return self.entries[(self.start + pos) % len(self.entries)]
+
+    def __iter__(self):
+        for pos in range(len(self.entries)):
+            yield self[pos]
+
+    def since(self, index):
+        """
+        returns a list of entries with 'index' greater than the given one
+        """
+        low, high = 0, len(self.entries)
+        while low < high:
+            mid = (low + high) // 2
+            if self[mid]['index'] <= index:
+                low = mid + 1
+            else:
+                high = mid
+
+        return [self[pos] for pos in range(low, len(self.entries))]
+
+
+class CancellableStream(object):
+    """
+    Wraps a file-like object so that every read is a cancellation point
+    of the task it belongs to. Iterating yields fixed-size chunks, which
+    is what HTTP clients do when the stream is used as a request body.
+    """
+    chunk_size = 1024 ** 2
+
+    def __init__(self, fobj, task_obj):
+        self.fobj = fobj
+        self.task = task_obj
+
+    def read(self, size=-1):
+        self.task.check_cancelled()
+        return self.fobj.read(size)
+
+    def __iter__(self):
+        return iter(lambda: self.read(self.chunk_size), b"")
+
+    def close(self):
+        if hasattr(self.fobj, 'close'):
+            self.fobj.close()
+
+
 class Task(object):
     def __init__(self, task_type):
         self.task_id = uuid.uuid4().hex
         self.task_type = task_type
         self.index = 0
-        self.logs = []
+        self.logs = LogBuffer(LOG_SIZE)
         self.progress = 0
         self.status = STATUS_RUNNING
         self.message = ""
         self.event = gevent.event.Event()
+        self.queued_time = None
+        self.started_time = None
+        # Seconds the task may run once started, None for no limit
+        self.timeout = None
+        self.deadline = None
+        self.cancel_reason = None
+        self.cancel_event = gevent.event.Event()
+        self.stages = []
 
     def log(self, msg, *args, **kwargs):
         progress = kwargs.get('progress', None)
@@ -46,18 +138,86 @@ class Task(object):
         })
         self.notify()
 
+    def mark_queued(self):
+        self.queued_time = time.time()
+
+    def mark_started(self):
+        self.started_time = time.time()
+        if self.timeout:
+            self.deadline = self.started_time + self.timeout
+
+    def begin_stage(self, name):
+        """
+        Ends the current stage of the task, if any, and starts timing a
+        new one. The last stage ends when the task completes.
+        """
+        self.end_stage()
+        self.stages.append({"name": name,
+                            "start": time.time(),
+                            "duration": None})
+
+    def end_stage(self):
+        if not self.stages or self.stages[-1]['duration'] is not None:
+            return
+
+        stage = self.stages[-1]
+        stage['duration'] = time.time() - stage['start']
+        metrics.TASK_STAGE_SECONDS.observe(stage['duration'],
+                                           self.task_type, stage['name'])
+
+    def cancel(self, reason="Task cancelled"):
+        if self.cancel_reason is not None or self.status != STATUS_RUNNING:
+            return
+
+        self.cancel_reason = reason
+        self.log("Cancelling task: %s", reason)
+        self.cancel_event.set()
+
+    def is_cancelled(self):
+        if self.cancel_reason is None and self.deadline is not None and \
+           time.time() > self.deadline:
+            self.cancel("Deadline exceeded")
+
+        return self.cancel_reason is not None
+
+    def check_cancelled(self):
+        """
+        A cancellation point: raises TaskCancelled if the task should stop
+        """
+        if self.is_cancelled():
+            raise TaskCancelled(self.cancel_reason)
+
+    def sleep(self, seconds):
+        """
+        Like time.sleep(), but wakes up early and raises TaskCancelled
+        when the task is cancelled or reaches its deadline
+        """
+        if self.deadline is not None:
+            seconds = max(0, min(seconds, self.deadline - time.time()))
+
+        self.cancel_event.wait(seconds)
+        self.check_cancelled()
+
+    def is_queued(self):
+        return self.queued_time is not None and self.started_time is None
+
+    def get_wait_time(self):
+        if self.queued_time is None:
+            return 0
+        return (self.started_time or time.time()) - self.queued_time
+
+    def approx_size(self):
+        return LOG_ENTRY_OVERHEAD * (len(self.logs) + 1) + \
+            sum(len(entry['message']) for entry in self.logs)
+
     def get_index(self):
         return self.index
 
     def get_dict(self, index = None):
-        logs = None
         if index:
-            logs = []
-            for log in self.logs:
-                if log['index'] > index:
-                    logs.append(log)
+            logs = self.logs.since(index)
         else:
-            logs = self.logs
+            logs = list(self.logs)
 
         obj = {"id": self.task_id,
                "type": self.task_type,
@@ -65,15 +225,21 @@ class Task(object):
                "message": self.message,
                "index": self.index,
                "progress": self.progress,
+               "queued": self.is_queued(),
+               "wait_time": self.get_wait_time(),
+               "deadline": self.deadline,
+               "cancelled": self.cancel_reason is not None,
+               "stages": [dict(stage) for stage in self.stages],
                "logs": logs}
 
         return obj
 
     def wait(self, index, timeout=None):
+        event = self.event
         if self.index != index:
             return self.index
 
-        self.event.wait(timeout)
+        event.wait(timeout)
 
         return self.index
 
@@ -84,8 +250,11 @@ class Task(object):
             index = self.wait(index, timeout)
 
     def notify(self):
-        self.event.set()
-        self.event.clear()
+        # Waiters keep the event they started waiting on, so it is replaced
+        # rather than cleared right after being set, which could lose a
+        # wakeup for a waiter that hasn't been scheduled yet.
+        event, self.event = self.event, gevent.event.Event()
+        event.set()
 
     def set_status(self, status, message=None):
         if status not in STATUSES:
@@ -93,6 +262,9 @@ class Task(object):
 
         self.status = status
 
+        if status != STATUS_RUNNING:
+            self.end_stage()
+
         if message is not None:
             self.message = message
 
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import logging
+import collections
+import task
+
+DEFAULT_MAX_COUNT = 1000  # completed tasks kept in memory
+DEFAULT_MAX_MEMORY = 64 * 1024 ** 2  # bytes
+DEFAULT_MAX_ARCHIVE_SIZE = 256 * 1024 ** 2  # bytes
+
+
+class ArchivedTask(object):
+    """
+    A completed task loaded back from the archive. It behaves like a
+    finished task.Task for the purposes of the task API.
+    """
+    def __init__(self, obj, size):
+        self.obj = obj
+        self.size = size
+        self.task_id = obj['id']
+        self.task_type = obj['type']
+        self.status = obj['status']
+        self.index = obj['index']
+        self.group_id = obj.get('group_id', None)
+
+    def get_dict(self, index=None):
+        obj = dict(self.obj)
+        if index:
+            obj['logs'] = [log for log in obj['logs'] if log['index'] > index]
+        return obj
+
+    def wait(self, index, timeout=None):
+        return self.index
+
+    def wait_for_completion(self, timeout=None):
+        pass
+
+    def approx_size(self):
+        return self.size
+
+
+class TaskStore(object):
+    """
+    Keeps running tasks in memory and completed ones in an LRU bounded by
+    count and approximate memory. Tasks pushed out of the LRU are appended
+    to an archive file, one JSON object per line, and read back only when
+    someone asks for them. Without an archive they are dropped.
+
+    When the archive grows past max_archive_size, it is renamed with a
+    '.1' suffix, replacing the previous one, and a new one is started.
+
+    Implements enough of the dict protocol to replace a plain dict of
+    task_id -> task.
+    """
+    def __init__(self, max_count=DEFAULT_MAX_COUNT,
+                 max_memory=DEFAULT_MAX_MEMORY, archive_path=None,
+                 max_archive_size=DEFAULT_MAX_ARCHIVE_SIZE):
+        self.max_count = max_count
+        self.max_memory = max_memory
+        self.archive_path = archive_path
+        self.max_archive_size = max_archive_size
+
+        self.active = {}
+        self.completed = collections.OrderedDict()
+        self.completed_memory = 0
+        # task_id -> (path, offset) in the archive, built on first lookup
+        self.archive_index = None
+        # bumped whenever a task is added to or dropped from the listing
+        self.generation = 0
+
+    def __setitem__(self, task_id, task_obj):
+        self.collect()
+        self.active[task_id] = task_obj
+        self.generation += 1
+
+    def __getitem__(self, task_id):
+        task_obj = self.get(task_id)
+        if task_obj is None:
+            raise KeyError(task_id)
+        return task_obj
+
+    def __contains__(self, task_id):
+        return self.get(task_id) is not None
+
+    def __len__(self):
+        return len(self.active) + len(self.completed)
+
+    def get(self, task_id, default=None):
+        if task_id in self.active:
+            return self.active[task_id]
+
+        if task_id in self.completed:
+            self.completed.move_to_end(task_id)
+            return self.completed[task_id]
+
+        task_obj = self.load(task_id)
+        if task_obj is None:
+            return default
+
+        self.add_completed(task_obj)
+        self.evict()
+        return task_obj
+
+    def items(self):
+        self.collect()
+        return list(self.active.items()) + list(self.completed.items())
+
+    def values(self):
+        return [task_obj for _, task_obj in self.items()]
+
+    def version(self):
+        """
+        returns a value that changes whenever a task is added, dropped,
+        logs something or changes status
+        """
+        self.collect()
+        return (self.generation,
+                sum(task_obj.index for task_obj in self.active.values()))
+
+    def active_tasks(self):
+        return [task_obj for task_obj in self.active.values()
+                if task_obj.status == task.STATUS_RUNNING]
+
+    def collect(self):
+        """
+        Moves tasks that have finished from the active set to the LRU
+        """
+        finished = [task_id for task_id, task_obj in self.active.items()
+                    if task_obj.status != task.STATUS_RUNNING]
+
+        for task_id in finished:
+            self.add_completed(self.active.pop(task_id))
+
+        self.evict()
+
+    def add_completed(self, task_obj):
+        self.completed[task_obj.task_id] = task_obj
+        self.completed_memory += task_obj.approx_size()
+        self.generation += 1
+
+    def evict(self):
+        while self.completed and \
+              (len(self.completed) > self.max_count or
+               self.completed_memory > self.max_memory):
+            _, task_obj = self.completed.popitem(last=False)
+            self.completed_memory -= task_obj.approx_size()
+            self.generation += 1
+
+            if not isinstance(task_obj, ArchivedTask):
+                self.archive(task_obj)
+
+    def archive(self, task_obj):
+        if not self.archive_path:
+            return
+
+        line = (json.dumps(task_obj.get_dict()) + '\n').encode('utf-8')
+
+        try:
+            with open(self.archive_path, 'ab') as fobj:
+                offset = fobj.tell()
+                fobj.write(line)
+        except OSError:
+            logging.exception("Failed to archive task '%s'", task_obj.task_id)
+            return
+
+        if self.archive_index is not None:
+            self.archive_index[task_obj.task_id] = (self.archive_path, offset)
+
+        if offset + len(line) > self.max_archive_size:
+            self.rotate()
+
+    def rotate(self):
+        rotated_path = self.archive_path + '.1'
+
+        try:
+            os.replace(self.archive_path, rotated_path)
+        except OSError:
+            logging.exception("Failed to rotate task archive '%s'",
+                              self.archive_path)
+            return
+
+        if self.archive_index is not None:
+            self.archive_index = {
+                task_id: (rotated_path, offset)
+                for task_id, (path, offset) in self.archive_index.items()
+                if path == self.archive_path}
+
+    def load_index(self):
+        self.archive_index = {}
+
+        # The rotated archive first, so that newer entries win
+        for path in (self.archive_path + '.1', self.archive_path):
+            if not os.path.exists(path):
+                continue
+
+            with open(path, 'rb') as fobj:
+                offset = 0
+                for line in fobj:
+                    try:
+                        task_id = json.loads(line.decode('utf-8'))['id']
+                        self.archive_index[task_id] = (path, offset)
+                    except ValueError:
+                        logging.warning("Skipping corrupt task archive " +
+                                        "entry in '%s' at offset %d",
+                                        path, offset)
+                    offset += len(line)
+
+    def load(self, task_id):
+        if not self.archive_path:
+            return None
+
+        if self.archive_index is None:
+            self.load_index()
+
+        if task_id not in self.archive_index:
+            return None
+
+        path, offset = self.archive_index[task_id]
+        try:
+            with open(path, 'rb') as fobj:
+                fobj.seek(offset)
+                line = fobj.readline()
+        except FileNotFoundError:
+            # Rotated away since the index was built
+            return None
+
+        return ArchivedTask(json.loads(line.decode('utf-8')), len(line))
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import errno
+import pickle
+import signal
+import socket
+import logging
+import tempfile
+import http.client
+import consul
+import global_env
+import sense
+
+LEADER_TTL = 15  # seconds a leader session lives without being renewed
+LEADER_RETRY = 5  # seconds between attempts to become the leader
+SNAPSHOT_POLL_INTERVAL = 0.5  # seconds
+# The snapshot is republished at least this often, to keep its age fresh
+SNAPSHOT_PUBLISH_INTERVAL = 10  # seconds
+WORKER_RESTART_DELAY = 1  # seconds
+PROXY_CHUNK_SIZE = 64 * 1024
+
+SNAPSHOT_FILE = 'snapshot.pickle'
+LEADER_SOCKET = 'leader.sock'
+
+# Headers that only make sense for one connection, see RFC 7230
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-authenticate',
+                      'proxy-authorization', 'te', 'trailer',
+                      'transfer-encoding', 'upgrade'}
+
+
+def listen(addr, port=None, backlog=1024):
+    """
+    Creates a listening socket that worker processes can share. 'addr'
+    is either a host name or 'unix://<path>'.
+    """
+    if addr.startswith('unix://'):
+        path = addr[len('unix://'):]
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+    else:
+        family, socktype, proto, _, sockaddr = socket.getaddrinfo(
+            addr or None, port, 0, socket.SOCK_STREAM, 0,
+            socket.AI_PASSIVE)[0]
+        sock = socket.socket(family, socktype, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(sockaddr)
+
+    sock.listen(backlog)
+    return sock
+
+
+def state_dir():
+    """
+    returns a new private directory for the snapshot shared by workers,
+    in memory if possible
+    """
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    return tempfile.mkdtemp(prefix='taas-', dir=base)
+
+
+def run(num_workers, worker_func):
+    """
+    Forks 'num_workers' processes running worker_func() and replaces
+    those that exit. Workers are stopped when the supervisor is.
+    """
+    children = set()
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            try:
+                worker_func()
+            except Exception:
+                logging.exception("Worker %d failed", os.getpid())
+            finally:
+                os._exit(1)
+
+        children.add(pid)
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(num_workers):
+        spawn()
+
+    while True:
+        try:
+            pid, status = os.wait()
+        except OSError as ex:
+            if ex.errno == errno.EINTR:
+                continue
+            raise
+
+        if pid not in children:
+            continue
+
+        children.discard(pid)
+        logging.warning("Worker %d exited with status %d, restarting it",
+                        pid, status)
+        time.sleep(WORKER_RESTART_DELAY)
+        spawn()
+
+
+def watch_parent():
+    """
+    Stops a worker whose supervisor is gone
+    """
+    parent = os.getppid()
+    while os.getppid() == parent:
+        time.sleep(1)
+
+    logging.warning("Supervisor exited, stopping worker %d", os.getpid())
+    os._exit(0)
+
+
+class LeaderLock(object):
+    """
+    A lock in Consul KV held by one worker at a time through a session
+    with a TTL. If the holder dies, Consul releases the lock when the
+    session expires, and another worker takes it over.
+    """
+    def __init__(self, key, ttl=LEADER_TTL):
+        self.key = key
+        self.ttl = ttl
+        self.session_id = None
+
+    def consul(self):
+        return consul.Consul(host=global_env.consul_host,
+                             token=global_env.consul_acl_token)
+
+    def acquire(self):
+        """
+        blocks until the lock is taken
+        """
+        while True:
+            try:
+                consul_obj = self.consul()
+                if self.session_id is None:
+                    self.session_id = consul_obj.session.create(
+                        name='taas-leader', behavior='delete',
+                        ttl=self.ttl)
+                else:
+                    consul_obj.session.renew(self.session_id)
+
+                if consul_obj.kv.put(self.key, str(os.getpid()),
+                                     acquire=self.session_id):
+                    return
+            except consul.NotFound:
+                self.session_id = None
+            except Exception:
+                logging.exception("Failed to take leader lock '%s'", self.key)
+
+            time.sleep(LEADER_RETRY)
+
+    def hold(self):
+        """
+        Keeps the session alive. Returns when it can't be renewed before
+        the TTL runs out, which means the lock may be taken by someone else.
+        """
+        renewed = time.time()
+        while time.time() - renewed < self.ttl:
+            time.sleep(self.ttl / 3.0)
+            try:
+                if self.consul().session.renew(self.session_id) is None:
+                    return
+                renewed = time.time()
+            except consul.NotFound:
+                return
+            except Exception:
+                logging.exception("Failed to renew leader session")
+
+
+def publish_snapshot(path):
+    """
+    Writes the snapshot for other workers to pick up. The file is
+    replaced atomically, so readers never see it half-written.
+    """
+    state = {'entries': {source: getattr(global_env, source)
+                         for source in sense.SNAPSHOT_SOURCES},
+             'versions': dict(sense.VERSIONS),
+             'update_time': sense.LAST_UPDATE_TIME}
+
+    tmp_path = '%s.%d' % (path, os.getpid())
+    with open(tmp_path, 'wb') as fobj:
+        pickle.dump(state, fobj, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def publish_loop(path):
+    while True:
+        try:
+            publish_snapshot(path)
+        except Exception:
+            logging.exception("Failed to publish snapshot")
+            time.sleep(1)
+            continue
+
+        sense.wait_for_change(SNAPSHOT_PUBLISH_INTERVAL)
+
+
+def follow_loop(path):
+    """
+    Loads the snapshot published by the leader whenever it changes
+    """
+    loaded = None
+
+    while True:
+        try:
+            stat = os.stat(path)
+            current = (stat.st_ino, stat.st_mtime_ns)
+
+            if current != loaded:
+                with open(path, 'rb') as fobj:
+                    state = pickle.load(fobj)
+
+                sense.load_snapshot(state['entries'], state['versions'],
+                                    state['update_time'])
+                loaded = current
+        except FileNotFoundError:
+            pass
+        except Exception:
+            logging.exception("Failed to load snapshot")
+
+        time.sleep(SNAPSHOT_POLL_INTERVAL)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+def forward(socket_path, method, path, headers, body):
+    """
+    Passes an HTTP request to the leader listening on 'socket_path'.
+    Returns the status, headers and a generator of body chunks, which
+    passes streamed responses through as they arrive.
+    """
+    conn = UnixHTTPConnection(socket_path)
+    conn.request(method, path, body=body,
+                 headers={k: v for k, v in headers
+                          if k.lower() not in HOP_BY_HOP_HEADERS})
+    response = conn.getresponse()
+
+    def chunks():
+        try:
+            while True:
+                chunk = response.read1(PROXY_CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+        finally:
+            conn.close()
+
+    headers = [(k, v) for k, v in response.getheaders()
+               if k.lower() not in HOP_BY_HOP_HEADERS]
+
+    return response.status, headers, chunks()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import time
+import logging
+import gevent.pool
+import backup_storage
+import tarantool
+from sense import Sense
+
+DEFAULT_CONCURRENCY = 4  # groups archived at the same time
+
+
+class XlogArchiver(object):
+    """
+    Copies xlogs of tarantool groups to backup storage as tarantool
+    closes them, so that a restore can replay what happened after the
+    backup instead of losing it. Only groups with at least one backup
+    are archived: replay needs a snapshot to start from.
+    """
+    def __init__(self, tasks, storage, interval,
+                 concurrency=DEFAULT_CONCURRENCY):
+        self.tasks = tasks
+        self.storage = storage
+        self.interval = interval
+        self.concurrency = concurrency
+
+    def busy_groups(self):
+        return set(getattr(t, 'group_id', None)
+                   for t in self.tasks.active_tasks())
+
+    def sweep(self):
+        blueprints = Sense.blueprints()
+        backups = Sense.backups()
+        archived = backup_storage.archived_xlogs()
+
+        # For each group, the newest xlog of each backup chain
+        starts = {}
+        for backup_id, backup in backups.items():
+            if backup['type'] != 'tarantool' or backup['files'] is None:
+                continue
+
+            try:
+                chain = backup_storage.backup_chain(backups, backup_id)
+            except RuntimeError:
+                continue
+
+            xlogs = [f for f in backup_storage.chain_files(backups, chain)
+                     if f.endswith('.xlog')]
+            if xlogs:
+                starts.setdefault(backup['group_id'], []).append(
+                    (backup['creation_time'], max(xlogs)))
+
+        for group_id, xlogs in archived.items():
+            self.prune(group_id, xlogs, starts.get(group_id, []))
+
+        busy = self.busy_groups()
+        pool = gevent.pool.Pool(self.concurrency)
+
+        for group_id, group_starts in starts.items():
+            blueprint = blueprints.get(group_id)
+            if blueprint is None or blueprint['type'] != 'tarantool' or \
+               group_id in busy:
+                continue
+
+            # Xlogs before the latest backup are in that backup already
+            start = max(group_starts)[1]
+            pool.spawn(self.archive, group_id, archived.get(group_id, {}),
+                       start)
+
+        pool.join()
+
+    def prune(self, group_id, xlogs, starts):
+        """
+        Removes archived xlogs that no backup of the group can replay
+        """
+        oldest = min(name for _, name in starts) if starts else None
+
+        try:
+            for name in sorted(xlogs):
+                if oldest is not None and name >= oldest:
+                    break
+
+                logging.info("Removing archived xlog '%s' of group '%s'",
+                             name, group_id)
+                self.storage.unregister_xlog(group_id, name, xlogs.pop(name))
+        except Exception:
+            logging.exception("Failed to remove archived xlogs of group '%s'",
+                              group_id)
+
+    def archive(self, group_id, xlogs, start):
+        try:
+            group = tarantool.Tarantool.get(group_id)
+            for name in group.archive_xlogs(self.storage, xlogs, start):
+                logging.info("Archived xlog '%s' of group '%s'",
+                             name, group_id)
+        except Exception:
+            logging.exception("Failed to archive xlogs of group '%s'",
+                              group_id)
+
+    def run(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception:
+                logging.exception("Failed to archive xlogs")
+
+            time.sleep(self.interval)